@@ -5,20 +5,416 @@ Ollama AI 模型管理器 - 整合版（带询问安装）
 """
 
 import os
+import re
 import sys
+import csv
+import json
+import argparse
+import shlex
+import signal
+import socket
+import socketserver
+import sqlite3
+import shutil
 import subprocess
 import platform
+import queue
+import math
+import random
 import time
+import struct
+import tarfile
+import tempfile
+import functools
+import itertools
+import contextlib
+import hashlib
+import threading
+import unicodedata
+import bisect
+import difflib
+import concurrent.futures
+import http.client
+import http.server
+import urllib.error
+import urllib.parse
+import urllib.request
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime
 
+# numpy 为可选依赖，仅本地知识库检索需要
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+# fcntl 仅 Unix 提供，用于跨进程文件锁
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # 全局变量
 HAS_PSUTIL = False
 PSUTIL_VERSION = None
 
+# 管理器自身的数据目录（状态、缓存等）
+MANAGER_DIR = os.path.join(os.path.expanduser("~"), ".ollama_manager")
+
 # ============ 第一部分：基础函数 ============
 def clear_screen():
-    """清屏"""
-    os.system('cls' if os.name == 'nt' else 'clear')
+    """清屏（非 Windows 直接输出 ANSI 控制序列，不再启动 clear 进程）"""
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        sys.stdout.write("\033[H\033[2J\033[3J")
+        sys.stdout.flush()
+
+def get_manager_dir():
+    """获取管理器数据目录（不存在则创建）"""
+    os.makedirs(MANAGER_DIR, exist_ok=True)
+    return MANAGER_DIR
+
+def load_json_file(path, default=None):
+    """读取 JSON 文件，失败时返回默认值"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_json_file(path, data):
+    """原子地写入 JSON 文件（先写同目录下的唯一临时文件再替换，多个进程同时写也不会互相覆盖内容）"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                    prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+@contextlib.contextmanager
+def file_lock(path):
+    """跨进程排他锁（flock 锁文件 path）；没有 fcntl 的平台（Windows）不加锁"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# ------------ 配置与状态缓存 ------------
+CONFIG_FILE = "config.json"
+STATE_FILE = "state.json"
+
+# 配置文件中缺少的项使用这些默认值；环境变量 OLLAMA_HOST / OLLAMA_MODELS 优先于配置文件
+DEFAULT_CONFIG = {
+    "hosts": ["127.0.0.1:11434"],   # 第一个为默认服务地址，其余用于监控
+    "models_dir": "",               # 为空时使用默认位置
+    "timeouts": {
+        "version": 5,        # ollama --version
+        "list": 10,          # 获取模型列表
+        "delete": 30,        # 删除模型
+        "api": 30,           # 普通 API 请求
+        "stream": 300,       # 流式对话
+        "generate": 600,     # 非流式生成
+        "embed": 120,        # 向量请求
+        "diagnostics": 2,    # 并行诊断总期限
+        "stop_grace": 5,     # 停止服务时的优雅退出期限
+    },
+    "concurrency": {
+        "embed_batch_size": 32,
+        "embed_requests": 4,
+        "verify_workers": 0,     # 数据块校验线程数，0 表示按 CPU 数量
+        "max_in_flight": 0,      # 每个模型同时发给服务的推理请求数，0 表示按 OLLAMA_NUM_PARALLEL（未设置时为 1）
+        "interactive_reserve": 1,  # 为对话保留的名额，批量任务不会占满（上限为 1 时不保留）
+    },
+    "pinned_models": [],            # 固定模型：删除前额外确认，可一键预加载
+    "hardware": {
+        "memory_bandwidth_gbps": 0,  # 内存带宽，0 表示按核心数估算
+        "reserve_gb": 2.0,           # 留给系统和其他程序的内存
+        "min_tokens_per_second": 5,  # 低于此速度视为较慢
+    },
+    "gc": {
+        "min_age_hours": 6,          # 清理时跳过最近修改的文件（可能正在下载）
+    },
+    "watch": {
+        "poll_interval": 5,          # 不支持 inotify 时检查模型清单变化的间隔（秒）
+    },
+    "pull": {
+        "bandwidth_limit_mbps": 0,   # 计划下载队列的默认带宽上限，0 表示不限
+    },
+    "render": {
+        "frame_ms": 16,              # 流式输出最多每隔多少毫秒写一次终端，0 表示逐个写出
+        "max_buffer_bytes": 4096,    # 缓冲超过该字节数时立即写出
+    },
+    "registry_cache": {
+        "upstream": "https://registry.ollama.ai",
+        "dir": "",                   # 为空时使用 ~/.ollama_manager/registry_cache
+        "max_gb": 200,               # 超过后淘汰最久未使用的数据块
+        "manifest_ttl": 300,         # 按标签请求的清单缓存时间（秒）
+    },
+    "daemon": {
+        "socket": "",                # 为空时使用 ~/.ollama_manager/manager.sock
+        "socket_mode": "600",        # 套接字权限（八进制），共享给其他用户时可改为 660
+        "use": True,                 # 守护进程运行时，菜单和命令行通过它访问服务
+        "status_interval": 5,        # 守护进程检查服务状态的间隔（秒）
+    },
+}
+
+_config = None
+_state = None
+
+def _merge_config(defaults, overrides):
+    """递归合并配置，只接受默认配置中已有的键"""
+    merged = {}
+    for key, default in defaults.items():
+        value = overrides.get(key, default) if isinstance(overrides, dict) else default
+        if isinstance(default, dict):
+            merged[key] = _merge_config(default, value)
+        else:
+            merged[key] = value
+    return merged
+
+def get_config(reload=False):
+    """读取配置文件（带缓存）"""
+    global _config
+    if _config is None or reload:
+        user_config = load_json_file(os.path.join(MANAGER_DIR, CONFIG_FILE), {})
+        _config = _merge_config(DEFAULT_CONFIG, user_config)
+    return _config
+
+def get_timeout(name):
+    """获取指定操作的超时时间（秒）"""
+    return get_config()["timeouts"][name]
+
+def load_state():
+    """读取状态缓存（可执行文件路径、版本等）"""
+    global _state
+    if _state is None:
+        _state = load_json_file(os.path.join(MANAGER_DIR, STATE_FILE), {})
+    return _state
+
+def save_state():
+    """写入状态缓存，失败时忽略（缓存不影响功能）"""
+    try:
+        save_json_file(os.path.join(get_manager_dir(), STATE_FILE), load_state())
+    except OSError:
+        pass
+
+# ------------ 耗时追踪 ------------
+TRACE_MAX_SPANS = 5000      # 保留最近的明细条数
+TRACE_MAX_SAMPLES = 1000    # 每个操作保留的耗时样本数
+
+_TRACE_LOCAL = threading.local()
+_TRACE_LOCK = threading.Lock()
+TRACE_SPANS = deque(maxlen=TRACE_MAX_SPANS)   # (完整路径, 名称, 开始时间, 耗时, 是否出错)
+TRACE_STATS = {}                              # 名称 -> 聚合统计
+TRACE_TREE = {}                               # 完整路径 -> [次数, 总耗时]
+
+def record_span(name, duration, error=False, parent_path=None):
+    """记录一个已结束的操作耗时"""
+    path = f"{parent_path} > {name}" if parent_path else name
+    with _TRACE_LOCK:
+        TRACE_SPANS.append((path, name, time.time() - duration, duration, error))
+        stats = TRACE_STATS.get(name)
+        if stats is None:
+            stats = TRACE_STATS[name] = {
+                "count": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                "samples": deque(maxlen=TRACE_MAX_SAMPLES),
+            }
+        stats["count"] += 1
+        stats["errors"] += int(error)
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+        stats["samples"].append(duration)
+        node = TRACE_TREE.setdefault(path, [0, 0.0])
+        node[0] += 1
+        node[1] += duration
+
+def current_span_path():
+    """当前线程正在执行的操作路径"""
+    stack = getattr(_TRACE_LOCAL, "stack", None)
+    return " > ".join(stack) if stack else None
+
+@contextlib.contextmanager
+def trace_span(name):
+    """记录代码块耗时（单调时钟），支持嵌套"""
+    stack = getattr(_TRACE_LOCAL, "stack", None)
+    if stack is None:
+        stack = _TRACE_LOCAL.stack = []
+    parent_path = " > ".join(stack) if stack else None
+    stack.append(name)
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        stack.pop()
+        record_span(name, time.perf_counter() - started, error, parent_path)
+
+def traced(name=None):
+    """装饰器：记录函数每次调用的耗时"""
+    def decorator(func):
+        span_name = name or func.__name__
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def run_command(cmd, **kwargs):
+    """执行外部命令（subprocess.run 的包装），并记录耗时"""
+    with trace_span("exec " + " ".join(cmd[:2])):
+        return subprocess.run(cmd, **kwargs)
+
+# ------------ 指标统计 ------------
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TPS_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+QUEUE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 名称 -> (类型, 说明, 直方图分桶)
+METRIC_DEFINITIONS = {
+    "ollama_manager_request_duration_seconds": (
+        "histogram", "Latency of inference requests sent by the manager.", LATENCY_BUCKETS),
+    "ollama_manager_tokens_per_second": (
+        "histogram", "Generation speed reported by the server (eval_count / eval_duration).",
+        TPS_BUCKETS),
+    "ollama_manager_requests_total": (
+        "counter", "Inference requests sent by the manager.", None),
+    "ollama_manager_queue_wait_seconds": (
+        "histogram", "Time inference requests waited in the manager's scheduler before being sent.",
+        QUEUE_BUCKETS),
+    "ollama_manager_queue_depth": (
+        "gauge", "Inference requests waiting in the manager's scheduler.", None),
+    "ollama_manager_in_flight_requests": (
+        "gauge", "Inference requests currently sent to the server, per model.", None),
+    "ollama_manager_pull_duration_seconds": (
+        "histogram", "Wall time of model pulls.", (10, 30, 60, 120, 300, 600, 1800, 3600)),
+    "ollama_manager_pull_bytes_total": (
+        "counter", "Size of successfully pulled models.", None),
+    "ollama_manager_pull_throughput_bytes_per_second": (
+        "gauge", "Model size divided by pull duration for the last pull of each model.", None),
+    "ollama_manager_registry_cache_requests_total": (
+        "counter", "Registry cache requests by kind and result (hit, miss, shared, stale).", None),
+    "ollama_manager_registry_cache_upstream_bytes_total": (
+        "counter", "Bytes downloaded from the upstream registry by the cache.", None),
+    "ollama_manager_registry_cache_served_bytes_total": (
+        "counter", "Blob bytes served to clients by the cache.", None),
+    "ollama_manager_registry_cache_evictions_total": (
+        "counter", "Blobs evicted from the registry cache to stay under its size limit.", None),
+}
+
+_METRICS_LOCK = threading.Lock()
+METRIC_VALUES = {}   # (名称, 标签元组) -> 数值或直方图状态
+
+def _metric_key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+def metric_inc(name, labels=None, value=1.0):
+    """计数器加值"""
+    key = _metric_key(name, labels)
+    with _METRICS_LOCK:
+        METRIC_VALUES[key] = METRIC_VALUES.get(key, 0.0) + value
+
+def metric_set(name, value, labels=None):
+    """设置仪表值"""
+    with _METRICS_LOCK:
+        METRIC_VALUES[_metric_key(name, labels)] = float(value)
+
+def metric_observe(name, value, labels=None):
+    """直方图记录一个观测值"""
+    buckets = METRIC_DEFINITIONS[name][2]
+    key = _metric_key(name, labels)
+    with _METRICS_LOCK:
+        state = METRIC_VALUES.get(key)
+        if state is None:
+            state = METRIC_VALUES[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                state["buckets"][i] += 1
+        state["sum"] += value
+        state["count"] += 1
+
+def observe_inference(path, model, seconds, result=None, error=False):
+    """记录一次推理请求的延迟和生成速度"""
+    labels = {"model": model or "", "endpoint": path}
+    metric_inc("ollama_manager_requests_total",
+               dict(labels, status="error" if error else "ok"))
+    if error:
+        return
+    metric_observe("ollama_manager_request_duration_seconds", seconds, labels)
+    if result:
+        tps = tokens_per_second(result.get("eval_count"), result.get("eval_duration"))
+        if tps:
+            metric_observe("ollama_manager_tokens_per_second", tps, {"model": model or ""})
+
+def _format_labels(labels):
+    """格式化标签，如 {model="llama3.2",endpoint="/api/chat"}"""
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def render_metrics(extra=None):
+    """以 Prometheus 文本格式输出所有指标
+    
+    extra 为抓取时临时采集的指标: {名称: (类型, 说明, [(标签字典, 数值), ...])}
+    """
+    with _METRICS_LOCK:
+        snapshot = {key: (dict(value, buckets=list(value["buckets"]))
+                          if isinstance(value, dict) else value)
+                    for key, value in METRIC_VALUES.items()}
+    
+    lines = []
+    for name, (kind, help_text, buckets) in METRIC_DEFINITIONS.items():
+        series = sorted((labels, value) for (n, labels), value in snapshot.items() if n == name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind == "histogram":
+                for bound, count in zip(buckets, value["buckets"]):
+                    le = labels + (("le", _format_value(bound)),)
+                    lines.append(f"{name}_bucket{_format_labels(le)} {count}")
+                inf = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_format_labels(inf)} {value['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    
+    for name, (kind, help_text, series) in (extra or {}).items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
 
 def print_header():
     """打印程序头"""
@@ -29,28 +425,621 @@ def print_header():
     print(f"时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 60)
 
+@traced()
 def check_ollama():
     """检查 Ollama 是否安装"""
-    try:
-        result = subprocess.run(
-            ["ollama", "--version"],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.returncode == 0:
-            version = result.stdout.strip() if result.stdout else "已安装"
-            return True, version
-        else:
-            return False, "命令执行失败"
-    except FileNotFoundError:
+    binary = resolve_ollama_binary()
+    if not binary:
         return False, "未安装"
+    try:
+        version, _ = get_ollama_version(binary)
+        return True, version
     except subprocess.TimeoutExpired:
         return True, "检查超时"
+    except RuntimeError:
+        return False, "命令执行失败"
     except Exception as e:
         return False, f"错误: {str(e)[:30]}"
 
+# ------------ 环境诊断 ------------
+OLLAMA_VERSION_RE = re.compile(r'version is\s+(\S+)')
+
+def _path_env_key():
+    """当前 PATH 的摘要，PATH 变化时缓存的可执行文件路径失效"""
+    return hashlib.sha1(os.environ.get("PATH", "").encode('utf-8')).hexdigest()
+
+def resolve_ollama_binary():
+    """在进程内按 PATH 查找 ollama 可执行文件（不再调用 which/where）
+    
+    结果保存在状态缓存中，PATH 未变化且文件仍存在时直接使用。
+    """
+    cached = load_state().get("binary") or {}
+    if (cached.get("path_env") == _path_env_key() and cached.get("path")
+            and os.path.isfile(cached["path"])):
+        return cached["path"]
+    binary = shutil.which("ollama")
+    if binary:
+        load_state()["binary"] = {"path_env": _path_env_key(), "path": binary}
+        save_state()
+    return binary
+
+def get_ollama_version(binary, timeout=None):
+    """获取 ollama 版本，返回 (版本, 是否来自缓存)
+    
+    以可执行文件路径和修改时间为键缓存，升级 Ollama 后自动失效。
+    超时抛出 subprocess.TimeoutExpired，命令失败抛出 RuntimeError。
+    """
+    mtime_ns = os.stat(binary).st_mtime_ns
+    cached = load_state().get("binary") or {}
+    if (cached.get("path") == binary and cached.get("mtime_ns") == mtime_ns
+            and cached.get("version")):
+        return cached["version"], True
+    
+    result = run_command([binary, "--version"], capture_output=True, text=True,
+                         timeout=timeout or get_timeout("version"))
+    if result.returncode != 0:
+        raise RuntimeError((result.stderr or result.stdout).strip()[:100])
+    # 服务未运行时输出为 "Warning: client version is x.y.z"，统一成同一格式
+    match = OLLAMA_VERSION_RE.search(result.stdout)
+    version = f"ollama version is {match.group(1)}" if match else (result.stdout.strip() or "已安装")
+    
+    load_state()["binary"] = {"path_env": _path_env_key(), "path": binary,
+                              "mtime_ns": mtime_ns, "version": version}
+    save_state()
+    return version, False
+
+def get_common_install_paths():
+    """Ollama 的常见安装位置"""
+    if platform.system() == "Windows":
+        return [
+            r"C:\Program Files\Ollama",
+            r"C:\Program Files (x86)\Ollama",
+            os.path.join(os.environ.get('ProgramFiles', ''), "Ollama"),
+            os.path.join(os.environ.get('ProgramFiles(x86)', ''), "Ollama"),
+            os.path.join(os.environ.get('LOCALAPPDATA', ''), "Programs", "Ollama"),
+            os.path.join(os.environ.get('APPDATA', ''), "Local", "Programs", "Ollama"),
+        ]
+    elif platform.system() == "Darwin":  # macOS
+        return [
+            "/usr/local/bin",
+            "/opt/homebrew/bin",
+            "/Applications/Ollama.app/Contents/MacOS",
+            os.path.expanduser("~/.local/bin"),
+            os.path.expanduser("~/Applications/Ollama.app/Contents/MacOS"),
+        ]
+    else:  # Linux
+        return [
+            "/usr/local/bin",
+            "/usr/bin",
+            "/bin",
+            "/opt/ollama",
+            os.path.expanduser("~/.local/bin"),
+            os.path.expanduser("~/bin"),
+        ]
+
+def _probe_version(binary, timeout):
+    if not binary:
+        return False, "找不到 ollama 命令"
+    try:
+        version, cached = get_ollama_version(binary, timeout)
+        return True, version + (" (缓存)" if cached else "")
+    except subprocess.TimeoutExpired:
+        return None, "命令超时"
+    except RuntimeError as e:
+        return False, f"命令返回错误: {str(e)[:50]}"
+
+def _probe_server(timeout):
+    up, version = check_server_alive(timeout)
+    if up:
+        return True, f"{get_ollama_base_url()} 响应正常 (服务版本 {version})"
+    return False, f"{get_ollama_base_url()} 无响应"
+
+def _probe_models(timeout):
+    models = ollama_api("/api/tags", timeout=timeout).get("models", [])
+    return True, f"找到 {len(models)} 个模型" if models else "连接成功，但无模型"
+
+def _probe_process(timeout):
+    if is_ollama_running():
+        return True, "Ollama 服务进程正在运行"
+    return False, "未发现 Ollama 服务进程"
+
+def _probe_install_locations(timeout):
+    exe_name = "ollama.exe" if platform.system() == "Windows" else "ollama"
+    for path in get_common_install_paths():
+        if os.path.exists(os.path.join(path, exe_name)):
+            return True, f"找到: {path}"
+    return None, "未在常见位置找到"
+
+def run_diagnostics(deadline=None):
+    """在同一个总期限内并发执行各项诊断
+    
+    返回 [(名称, 状态, 说明, 耗时秒), ...]，状态为 True/False/None(警告)。
+    超过期限仍未完成的诊断项标记为超时，不再等待。
+    """
+    deadline = deadline or get_timeout("diagnostics")
+    started = time.monotonic()
+    binary = resolve_ollama_binary()
+    results = [("可执行文件", bool(binary), binary or "PATH 中找不到 ollama",
+                time.monotonic() - started)]
+    
+    probes = [
+        ("版本", lambda: _probe_version(binary, deadline)),
+        ("服务接口", lambda: _probe_server(deadline)),
+        ("模型列表", lambda: _probe_models(deadline)),
+        ("服务进程", lambda: _probe_process(deadline)),
+        ("常见安装位置", lambda: _probe_install_locations(deadline)),
+    ]
+    
+    def timed(func):
+        probe_started = time.monotonic()
+        try:
+            ok, detail = func()
+        except OllamaAPIError as e:
+            ok, detail = False, str(e)[:80]
+        except Exception as e:
+            ok, detail = False, f"检查失败: {str(e)[:60]}"
+        return ok, detail, time.monotonic() - probe_started
+    
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(probes))
+    futures = [(name, executor.submit(timed, func)) for name, func in probes]
+    remaining = max(0.0, deadline - (time.monotonic() - started))
+    concurrent.futures.wait([future for _, future in futures], timeout=remaining)
+    # 不等待超时的诊断项，它们的子进程/请求自带超时会自行结束
+    executor.shutdown(wait=False)
+    
+    for name, future in futures:
+        if future.done():
+            results.append((name,) + future.result())
+        else:
+            results.append((name, None, f"超过 {deadline:.0f} 秒未完成", deadline))
+    return results
+
+def print_diagnostics(results):
+    """打印诊断结果"""
+    icons = {True: "✅", False: "❌", None: "⚠️ "}
+    for name, ok, detail, seconds in results:
+        print(f"   {icons[ok]} {name:<8} {detail}  ({seconds * 1000:.0f} ms)")
+
+# ------------ 请求调度 ------------
+# 优先级从高到低；对话等有人在等的请求为 interactive，向量化、建索引等批量任务为 batch
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+_REQUEST_LOCAL = threading.local()
+
+def current_priority():
+    """当前线程发出的推理请求的优先级"""
+    return getattr(_REQUEST_LOCAL, "priority", PRIORITY_INTERACTIVE)
+
+@contextlib.contextmanager
+def queue_listener(callback):
+    """在代码块内，当前线程的推理请求进入和离开调度队列时调用 callback(是否在排队)"""
+    previous = getattr(_REQUEST_LOCAL, "queue_listener", None)
+    _REQUEST_LOCAL.queue_listener = callback
+    try:
+        yield
+    finally:
+        _REQUEST_LOCAL.queue_listener = previous
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """在代码块内以指定优先级发送推理请求（只作用于当前线程）"""
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"未知优先级: {priority}")
+    previous = current_priority()
+    _REQUEST_LOCAL.priority = priority
+    try:
+        yield
+    finally:
+        _REQUEST_LOCAL.priority = previous
+
+class RequestScheduler:
+    """推理请求调度：每个模型同时在途的请求数不超过服务的并行数，名额空出时优先分给对话
+    
+    服务端对超出并行数的请求按到达顺序排队，批量任务一次提交很多请求时，
+    对话请求要排在它们后面。这里在本地排队，按 (优先级, 到达顺序) 放行，
+    并给对话保留名额，批量任务只能使用其余的名额。
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._in_flight = {}     # 模型 -> 在途请求数
+        self._waiting = []       # [(优先级序号, 到达序号, 模型)]
+        self._seq = 0
+    
+    @staticmethod
+    def limit():
+        """每个模型的在途请求上限"""
+        configured = get_config()["concurrency"]["max_in_flight"]
+        if configured:
+            return max(1, int(configured))
+        try:
+            return max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", "") or 1))
+        except ValueError:
+            return 1
+    
+    def _limit_for(self, priority, limit):
+        if priority == PRIORITY_INTERACTIVE or limit <= 1:
+            return limit
+        return max(1, limit - get_config()["concurrency"]["interactive_reserve"])
+    
+    def _can_run(self, entry):
+        rank, _, model = entry
+        limit = self.limit()
+        if self._in_flight.get(model, 0) >= self._limit_for(PRIORITY_CLASSES[rank], limit):
+            return False
+        # 同一模型排在前面的请求先走
+        return all(other >= entry for other in self._waiting if other[2] == model)
+    
+    def _update_gauges(self, model):
+        metric_set("ollama_manager_in_flight_requests", self._in_flight.get(model, 0), {"model": model})
+        for rank, priority in enumerate(PRIORITY_CLASSES):
+            metric_set("ollama_manager_queue_depth",
+                       sum(1 for entry in self._waiting if entry[0] == rank), {"priority": priority})
+    
+    def acquire(self, model, priority=None):
+        """等待名额，返回排队时间（秒）"""
+        priority = priority or current_priority()
+        model = model or ""
+        listener = getattr(_REQUEST_LOCAL, "queue_listener", None)
+        started = time.perf_counter()
+        with self._cond:
+            self._seq += 1
+            entry = (PRIORITY_CLASSES.index(priority), self._seq, model)
+            self._waiting.append(entry)
+            self._update_gauges(model)
+            queued = False
+            try:
+                while not self._can_run(entry):
+                    if listener and not queued:
+                        queued = True
+                        listener(True)
+                    self._cond.wait()
+            finally:
+                if queued:
+                    listener(False)
+                self._waiting.remove(entry)
+                # 自己离开队列后，排在后面的请求可能可以运行了
+                self._cond.notify_all()
+            self._in_flight[model] = self._in_flight.get(model, 0) + 1
+            self._update_gauges(model)
+        waited = time.perf_counter() - started
+        metric_observe("ollama_manager_queue_wait_seconds", waited,
+                       {"model": model, "priority": priority})
+        return waited
+    
+    def release(self, model):
+        model = model or ""
+        with self._cond:
+            self._in_flight[model] -= 1
+            self._update_gauges(model)
+            self._cond.notify_all()
+    
+    @contextlib.contextmanager
+    def slot(self, model, priority=None):
+        self.acquire(model, priority)
+        try:
+            yield
+        finally:
+            self.release(model)
+    
+    def snapshot(self):
+        """在途和排队情况: {模型: {"in_flight", "waiting"}}"""
+        with self._cond:
+            models = set(self._in_flight) | {entry[2] for entry in self._waiting}
+            return {model: {"in_flight": self._in_flight.get(model, 0),
+                            "waiting": sum(1 for entry in self._waiting if entry[2] == model)}
+                    for model in models}
+
+REQUEST_SCHEDULER = RequestScheduler()
+
+# ------------ Ollama HTTP API ------------
+
+# 推理类接口（耗时包含模型加载和生成）
+INFERENCE_PATHS = ("/api/chat", "/api/generate", "/api/embed", "/api/embeddings",
+                   "/v1/chat/completions", "/v1/completions", "/v1/embeddings")
+
+# 每个线程复用自己的 keep-alive 连接，避免每个请求都重新建立 TCP 连接
+_HTTP_LOCAL = threading.local()
+# 守护进程为每个客户端连接开一个线程，线程随客户端断开而结束，
+# 所以响应读完后把连接还到按地址共享的空闲池，供其他线程复用
+_SHARED_HTTP_POOL = {}
+_SHARED_HTTP_LOCK = threading.Lock()
+SHARED_HTTP_POOL_SIZE = 8       # 每个地址最多保留的空闲连接数
+
+class OllamaAPIError(Exception):
+    """Ollama HTTP API 调用失败"""
+
+def get_ollama_base_url(host=None):
+    """获取服务地址：OLLAMA_HOST 环境变量优先，其次为配置文件中的第一个地址"""
+    host = (host or os.environ.get("OLLAMA_HOST", "").strip()
+            or (get_config()["hosts"] or DEFAULT_CONFIG["hosts"])[0])
+    if "://" not in host:
+        host = "http://" + host
+    parsed = urllib.parse.urlsplit(host)
+    scheme = parsed.scheme or "http"
+    hostname = parsed.hostname or "127.0.0.1"
+    # 监听所有地址时，客户端连接本机
+    if hostname == "0.0.0.0":
+        hostname = "127.0.0.1"
+    elif hostname == "::":
+        hostname = "::1"
+    port = parsed.port or (443 if scheme == "https" else 11434)
+    if ":" in hostname:
+        hostname = f"[{hostname}]"
+    return f"{scheme}://{hostname}:{port}"
+
+def _get_http_connection(base_url, timeout):
+    """获取当前线程到指定地址的连接"""
+    pool = getattr(_HTTP_LOCAL, "pool", None)
+    if pool is None:
+        pool = _HTTP_LOCAL.pool = {}
+    conn = pool.get(base_url)
+    if conn is None and _DAEMON_MODE:
+        with _SHARED_HTTP_LOCK:
+            idle = _SHARED_HTTP_POOL.get(base_url)
+            if idle:
+                conn = pool[base_url] = idle.pop()
+    if conn is None:
+        parsed = urllib.parse.urlsplit(base_url)
+        conn_class = (http.client.HTTPSConnection if parsed.scheme == "https"
+                      else http.client.HTTPConnection)
+        conn = conn_class(parsed.hostname, parsed.port, timeout=timeout)
+        pool[base_url] = conn
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+    return conn
+
+def _release_http_connection(base_url):
+    """响应已读完：守护进程中把连接放回共享空闲池，其他情况下线程继续持有"""
+    if not _DAEMON_MODE:
+        return
+    pool = getattr(_HTTP_LOCAL, "pool", None)
+    conn = pool.pop(base_url, None) if pool else None
+    if conn is None:
+        return
+    with _SHARED_HTTP_LOCK:
+        idle = _SHARED_HTTP_POOL.setdefault(base_url, [])
+        if len(idle) < SHARED_HTTP_POOL_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+def _drop_http_connection(base_url):
+    """关闭并丢弃当前线程的连接（出错或响应未读完时）"""
+    pool = getattr(_HTTP_LOCAL, "pool", None)
+    if pool and base_url in pool:
+        try:
+            pool.pop(base_url).close()
+        except Exception:
+            pass
+
+def ollama_request(path, payload=None, method=None, timeout=None, base_url=None):
+    """发送 API 请求，返回尚未读取的响应对象"""
+    timeout = timeout or get_timeout("api")
+    base_url = base_url or get_ollama_base_url()
+    method = method or ("POST" if payload is not None else "GET")
+    body = json.dumps(payload).encode('utf-8') if payload is not None else None
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    
+    # 复用的连接可能已被服务端关闭，此时换新连接重试一次
+    for attempt in range(2):
+        conn = _get_http_connection(base_url, timeout)
+        reused = conn.sock is not None
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            break
+        except (http.client.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError, http.client.CannotSendRequest) as e:
+            _drop_http_connection(base_url)
+            if attempt or not reused:
+                raise OllamaAPIError(f"连接失败: {e}") from e
+        except (OSError, http.client.HTTPException) as e:
+            _drop_http_connection(base_url)
+            raise OllamaAPIError(f"连接失败: {e}") from e
+    
+    if response.status >= 400:
+        raw = response.read()
+        _release_http_connection(base_url)
+        try:
+            message = json.loads(raw).get("error") or raw.decode('utf-8', errors='replace')
+        except ValueError:
+            message = raw.decode('utf-8', errors='replace')
+        raise OllamaAPIError(f"HTTP {response.status}: {message.strip()[:200]}")
+    return response
+
+def ollama_api(path, payload=None, method=None, timeout=None, base_url=None):
+    """调用 API 并返回解析后的 JSON"""
+    base_url = base_url or get_ollama_base_url()
+    client = get_daemon_client()
+    if client is not None:
+        try:
+            return daemon_api(client, path, payload, method, timeout, base_url)
+        except DaemonUnavailable:
+            _daemon_probe["failed_at"] = time.monotonic()
+    model = (payload or {}).get("model")
+    slot = REQUEST_SCHEDULER.slot(model) if path in INFERENCE_PATHS else contextlib.nullcontext()
+    with slot:
+        return _ollama_api_direct(path, payload, method, timeout, base_url, model)
+
+def _ollama_api_direct(path, payload, method, timeout, base_url, model):
+    """直接向服务发送请求（推理请求已取得调度名额）"""
+    started = time.perf_counter()
+    try:
+        with trace_span(f"api {path}"):
+            response = ollama_request(path, payload, method, timeout, base_url)
+            try:
+                raw = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                _drop_http_connection(base_url)
+                raise OllamaAPIError(f"读取响应失败: {e}") from e
+            _release_http_connection(base_url)
+        try:
+            result = json.loads(raw) if raw else {}
+        except ValueError as e:
+            raise OllamaAPIError("响应不是有效的 JSON") from e
+    except OllamaAPIError:
+        if path in INFERENCE_PATHS:
+            observe_inference(path, model, 0.0, error=True)
+        raise
+    if path in INFERENCE_PATHS:
+        observe_inference(path, model, time.perf_counter() - started, result)
+    return result
+
+def ollama_api_stream(path, payload, timeout=None, base_url=None):
+    """调用流式 API，逐条产出 NDJSON 消息"""
+    base_url = base_url or get_ollama_base_url()
+    client = get_daemon_client()
+    if client is not None:
+        try:
+            yield from daemon_stream(client, path, payload, timeout, base_url)
+            return
+        except DaemonUnavailable:
+            _daemon_probe["failed_at"] = time.monotonic()
+    timeout = timeout or get_timeout("stream")
+    # 名额一直占用到流结束（或调用方停止迭代）
+    scheduled = path in INFERENCE_PATHS
+    if scheduled:
+        REQUEST_SCHEDULER.acquire(payload.get("model"))
+    # 生成器会跨越调用方的代码执行，所以不压入追踪栈，结束时单独记录
+    parent_path = current_span_path()
+    started = time.perf_counter()
+    try:
+        response = ollama_request(path, payload, "POST", timeout, base_url)
+    except OllamaAPIError:
+        if scheduled:
+            REQUEST_SCHEDULER.release(payload.get("model"))
+        record_span(f"api {path} (stream)", time.perf_counter() - started, True, parent_path)
+        observe_inference(path, payload.get("model"), 0.0, error=True)
+        raise
+    finished = False
+    last_message = None
+    try:
+        while True:
+            line = response.readline()
+            if not line:
+                finished = True
+                break
+            line = line.strip()
+            if not line:
+                continue
+            message = json.loads(line)
+            if message.get("error"):
+                raise OllamaAPIError(message["error"])
+            last_message = message
+            yield message
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        raise OllamaAPIError(f"读取流式响应失败: {e}") from e
+    finally:
+        if scheduled:
+            REQUEST_SCHEDULER.release(payload.get("model"))
+        # 提前结束（出错或调用方停止迭代）时响应未读完，连接不能复用
+        if not finished:
+            _drop_http_connection(base_url)
+        else:
+            _release_http_connection(base_url)
+        duration = time.perf_counter() - started
+        record_span(f"api {path} (stream)", duration, not finished, parent_path)
+        if path in INFERENCE_PATHS:
+            observe_inference(path, payload.get("model"), duration,
+                              last_message if finished else None, error=not finished)
+
+def generate_text(model, prompt, options=None, keep_alive=None, timeout=None, base_url=None):
+    """调用 /api/generate（非流式），返回响应及本地测得的耗时（秒）"""
+    payload = {"model": model, "prompt": prompt, "stream": False}
+    if options:
+        payload["options"] = options
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    started = time.perf_counter()
+    result = ollama_api("/api/generate", payload, timeout=timeout or get_timeout("generate"),
+                        base_url=base_url)
+    result["wall_seconds"] = time.perf_counter() - started
+    return result
+
+def tokens_per_second(count, duration_ns):
+    """根据 API 返回的计数和纳秒耗时计算 tokens/秒"""
+    return count / (duration_ns / 1e9) if count and duration_ns else 0.0
+
+def embed_texts(model, texts, timeout=None, base_url=None):
+    """调用 /api/embed 批量生成向量"""
+    result = ollama_api("/api/embed", {"model": model, "input": list(texts)},
+                        timeout=timeout or get_timeout("embed"), base_url=base_url)
+    embeddings = result.get("embeddings") or []
+    if len(embeddings) != len(texts):
+        raise OllamaAPIError(f"返回向量数量不符: 期望 {len(texts)}，实际 {len(embeddings)}")
+    return embeddings
+
+# ------------ 流式输出缓冲 ------------
+class TokenRenderer:
+    """把流式输出的 token 合并后按帧写入终端
+    
+    每个 token 单独 write + flush 在每秒数百 token 时会拖慢读取（SSH 下尤其明显）。
+    这里累积到一帧的时间或一定字节数才写一次；后台线程保证停顿时缓冲内容最迟一帧后显示，
+    结束时（包括中断）立即写出剩余内容。frame_ms 为 0 时退回逐个写出。
+    """
+    
+    def __init__(self, stream=None, frame_ms=None, max_bytes=None):
+        settings = get_config()["render"]
+        self.stream = stream or sys.stdout
+        self.interval = (settings["frame_ms"] if frame_ms is None else frame_ms) / 1000.0
+        self.max_bytes = max_bytes or settings["max_buffer_bytes"]
+        self.writes = 0
+        self._parts = []
+        self._size = 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+    
+    def write(self, text):
+        if not text:
+            return
+        with self._lock:
+            self._parts.append(text)
+            self._size += len(text)
+            now = time.monotonic()
+            if self._size >= self.max_bytes or now - self._last >= self.interval:
+                self._flush_locked(now)
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._flush_loop, name="token-renderer", daemon=True)
+            self._thread.start()
+    
+    def _flush_locked(self, now=None):
+        if self._parts:
+            self.stream.write("".join(self._parts))
+            self.stream.flush()
+            self.writes += 1
+            self._parts, self._size = [], 0
+        self._last = now or time.monotonic()
+    
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+    
+    def _flush_loop(self):
+        # 模型停顿时把已缓冲的内容写出，不等下一个 token
+        while not self._closed.wait(self.interval):
+            with self._lock:
+                if self._parts and time.monotonic() - self._last >= self.interval:
+                    self._flush_locked()
+    
+    def close(self):
+        self._closed.set()
+        self.flush()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
 # ============ 第二部分：初始化检查 ============
+@traced()
 def initialize_program():
     """初始化程序 - 检查并询问是否安装"""
     clear_screen()
@@ -188,7 +1177,7 @@ def try_install_psutil():
         print(f"尝试方法 {i}/{len(methods)}: {method_name}")
         
         try:
-            result = subprocess.run(
+            result = run_command(
                 cmd,
                 capture_output=True,
                 text=True,
@@ -244,6 +1233,7 @@ def show_manual_installation_guide():
     input("\n按回车键返回...")
 
 # ============ 第三部分：主菜单系统 ============
+@traced("menu.print_menu")
 def print_menu():
     """打印主菜单"""
     clear_screen()
@@ -274,11 +1264,230 @@ def print_menu():
     print(" 7. 🔍 检查系统状态")
     print(" 8. 📁 打开模型文件夹")
     print(" 9. ⚙️  系统设置")
+    print("10. 🧰 高级工具")
+    print("11. 🖥️  全屏界面 (实时状态)")
     print(" 0. 🚪 退出程序")
     print()
     print("=" * 40)
 
+# ------------ 全屏界面 (curses) ------------
+TUI_REFRESH_SECONDS = 2.0
+
+def clip_display(text, width):
+    """按显示宽度截断字符串"""
+    result, used = "", 0
+    for ch in text:
+        w = 2 if unicodedata.east_asian_width(ch) in ('W', 'F') else 1
+        if used + w > width:
+            break
+        result += ch
+        used += w
+    return result
+
+class TuiApp:
+    """curses 全屏界面：面板只画一次，之后只重绘内容有变化的面板
+    
+    服务状态由后台线程定期刷新，模型列表每次绘制时读取模型清单监视的快照；
+    输入不阻塞，每 100ms 检查一次各面板内容，状态和时钟照常刷新。选择功能时临时退出全屏运行原有界面。
+    """
+    
+    ACTIONS = [
+        ("启动 Ollama 服务", "start_service"),
+        ("停止 Ollama 服务", "stop_service"),
+        ("查看模型列表", "list_models"),
+        ("与模型对话", "chat_with_model"),
+        ("下载新模型", "download_model"),
+        ("删除模型", "delete_model"),
+        ("检查系统状态", "check_system_status"),
+        ("系统设置", "system_settings"),
+        ("高级工具", "advanced_tools"),
+    ]
+    
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.selected = 0
+        self.message = "方向键选择，回车执行，数字键直接选择，q 退出"
+        self.status = {"up": None, "version": "", "loaded": [], "memory": (None, None)}
+        self.inventory = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last = {}
+        self.windows = {}
+    
+    # ---- 数据 ----
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            status = get_server_status()
+            with self._lock:
+                self.status = {"up": status["up"], "version": status["version"],
+                               "loaded": status["loaded"], "memory": get_memory_info()}
+            self._stop.wait(TUI_REFRESH_SECONDS)
+    
+    # ---- 布局与绘制 ----
+    def layout(self):
+        """按终端大小创建各个面板"""
+        import curses
+        height, width = self.stdscr.getmaxyx()
+        menu_width = min(30, max(20, width // 3))
+        body = max(height - 5, 3)
+        self.windows = {
+            "header": curses.newwin(3, width, 0, 0),
+            "menu": curses.newwin(body, menu_width, 3, 0),
+            "status": curses.newwin(min(8, body), width - menu_width, 3, menu_width),
+            "models": curses.newwin(max(body - 8, 1), width - menu_width, 3 + min(8, body), menu_width),
+            "footer": curses.newwin(2, width, height - 2, 0),
+        }
+        self._last = {}
+        self.stdscr.erase()
+        self.stdscr.noutrefresh()
+    
+    def panel_lines(self):
+        """生成每个面板的内容，返回 {面板: (标题, 行列表)}"""
+        with self._lock:
+            status = dict(self.status)
+        header = [f"Ollama AI 模型管理器 v2.0    {platform.system()} {platform.release()}    "
+                  f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"]
+        menu = [f"{'>' if i == self.selected else ' '} {i + 1}. {label}"
+                for i, (label, _) in enumerate(self.ACTIONS)]
+        
+        if status["up"] is None:
+            server = "检查中..."
+        else:
+            server = f"运行中 (v{status['version']})" if status["up"] else "未运行"
+        total, available = status["memory"]
+        memory = f"{format_bytes(available)} 可用 / {format_bytes(total)}" if total else "未知"
+        status_lines = [f"服务: {server}  {get_ollama_base_url()}", f"内存: {memory}",
+                        f"已加载模型: {len(status['loaded'])}"]
+        for model in status["loaded"][:4]:
+            status_lines.append(f"  {model.get('name', '')}  {format_bytes(model.get('size', 0))}")
+        
+        models = self.inventory.snapshot() if self.inventory else {}
+        model_lines = [f"{name}  {format_bytes(entry['size'])}" for name, entry in sorted(models.items())]
+        return {
+            "header": ("", header),
+            "menu": ("菜单", menu),
+            "status": ("状态", status_lines),
+            "models": (f"已安装模型 ({len(models)})", model_lines or ["(无)"]),
+            "footer": ("", [self.message]),
+        }
+    
+    def draw_panel(self, name, title, lines):
+        """内容与上次相同时跳过；否则只重绘这一个面板"""
+        import curses
+        if self._last.get(name) == (title, lines):
+            return
+        self._last[name] = (title, lines)
+        window = self.windows[name]
+        height, width = window.getmaxyx()
+        window.erase()
+        top = 0
+        if title:
+            window.box()
+            window.addstr(0, 2, clip_display(f" {title} ", width - 4), curses.A_BOLD)
+            top, left, inner = 1, 2, width - 4
+            rows = height - 2
+        else:
+            left, inner, rows = 1, width - 2, height
+        for i, line in enumerate(lines[:rows]):
+            attr = curses.A_REVERSE if name == "menu" and i == self.selected else curses.A_NORMAL
+            try:
+                window.addstr(top + i, left, clip_display(line, inner), attr)
+            except curses.error:
+                pass
+        window.noutrefresh()
+    
+    def render(self):
+        for name, (title, lines) in self.panel_lines().items():
+            self.draw_panel(name, title, lines)
+        import curses
+        curses.doupdate()
+    
+    # ---- 交互 ----
+    def run_action(self, index):
+        """临时退出全屏运行原有的交互界面，结束后恢复"""
+        import curses
+        label, function_name = self.ACTIONS[index]
+        curses.def_prog_mode()
+        curses.endwin()
+        try:
+            globals()[function_name]()
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print(f"\n❌ 发生错误: {str(e)}")
+            input("\n按回车键继续...")
+        curses.reset_prog_mode()
+        self.stdscr.clear()
+        self.layout()
+        self.message = f"已返回: {label}"
+    
+    def run(self):
+        import curses
+        curses.curs_set(0)
+        self.stdscr.timeout(100)   # 非阻塞输入：100ms 内没有按键就继续刷新
+        self.stdscr.keypad(True)
+        try:
+            self.inventory = get_model_inventory()
+        except OSError:
+            self.inventory = None
+        threading.Thread(target=self._refresh_loop, name="tui-refresh", daemon=True).start()
+        self.layout()
+        try:
+            while True:
+                self.render()
+                key = self.stdscr.getch()
+                if key == -1:
+                    continue
+                if key in (ord('q'), ord('Q'), 27):
+                    return
+                if key == curses.KEY_RESIZE:
+                    self.layout()
+                elif key in (curses.KEY_UP, ord('k')):
+                    self.selected = (self.selected - 1) % len(self.ACTIONS)
+                elif key in (curses.KEY_DOWN, ord('j')):
+                    self.selected = (self.selected + 1) % len(self.ACTIONS)
+                elif key in (curses.KEY_ENTER, 10, 13):
+                    self.run_action(self.selected)
+                elif ord('1') <= key < ord('1') + len(self.ACTIONS):
+                    self.selected = key - ord('1')
+                    self.run_action(self.selected)
+        finally:
+            self._stop.set()
+
+def run_tui():
+    """启动全屏界面；没有 curses 时返回 False（Windows 需要 pip install windows-curses）"""
+    try:
+        import curses
+    except ImportError:
+        return False
+    curses.wrapper(lambda stdscr: TuiApp(stdscr).run())
+    return True
+
+@traced("menu.tui")
+def tui_menu():
+    """从主菜单进入全屏界面"""
+    try:
+        if not run_tui():
+            print("❌ 当前环境没有 curses 模块")
+            if platform.system() == "Windows":
+                print("   可以运行 pip install windows-curses 后重试")
+            input("\n按回车键返回...")
+    except Exception as e:
+        print(f"\n❌ 全屏界面出错: {str(e)}")
+        input("\n按回车键返回...")
+
 # ============ 第四部分：核心功能函数 ============
+# 下载界面中的推荐模型
+RECOMMENDED_MODELS = [
+    ("llama3.2:1b", "1B参数，最小最快"),
+    ("phi3:mini", "3.8B，性能优秀（推荐）"),
+    ("qwen2.5:0.5b", "0.5B，中文优化最小"),
+    ("llama3.2", "8B，标准版本"),
+    ("mistral", "7B，法语优化"),
+    ("gemma2:2b", "2B，谷歌轻量版"),
+]
+
+@traced("menu.start_service")
 def start_service():
     """启动 Ollama 服务"""
     clear_screen()
@@ -296,24 +1505,35 @@ def start_service():
     print()
     
     try:
-        if platform.system() == "Windows":
-            subprocess.Popen(
-                ["start", "cmd", "/k", "ollama serve"],
-                shell=True
-            )
-        else:
-            subprocess.Popen(
-                ["xterm", "-e", "ollama serve"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
+        with trace_span("exec ollama serve"):
+            if platform.system() == "Windows":
+                subprocess.Popen(
+                    ["start", "cmd", "/k", "ollama serve"],
+                    shell=True
+                )
+            else:
+                # 同时把服务输出追加到日志文件，供日志分析使用
+                log_path = get_server_log_path()
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+                subprocess.Popen(
+                    ["xterm", "-e", "sh", "-c",
+                     f"ollama serve 2>&1 | tee -a {shlex.quote(log_path)}"],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
         
         print("✅ 服务启动命令已发送")
         print("正在等待服务初始化...")
         
-        for i in range(5, 0, -1):
-            print(f"等待 {i} 秒...", end='\r')
-            time.sleep(1)
+        with trace_span("wait service startup"):
+            for i in range(5, 0, -1):
+                print(f"等待 {i} 秒...", end='\r')
+                time.sleep(1)
+        
+        # 记录实际监听端口的服务进程，停止服务时只针对它
+        server_pids = find_listening_pids(get_server_port())
+        if len(server_pids) == 1:
+            save_tracked_server_pid(server_pids.pop())
         
         print("\n\n✅ Ollama 服务应该已经启动")
         print("如果遇到问题，请手动检查服务窗口")
@@ -327,6 +1547,7 @@ def start_service():
     
     input("\n按回车键返回菜单...")
 
+@traced()
 def is_ollama_running():
     """检查 Ollama 是否在运行"""
     if HAS_PSUTIL:
@@ -341,14 +1562,14 @@ def is_ollama_running():
     # 备用检查方法（不使用 psutil）
     try:
         if platform.system() == "Windows":
-            result = subprocess.run(
+            result = run_command(
                 ["tasklist", "/fi", "imagename eq ollama.exe"],
                 capture_output=True,
                 text=True
             )
             return "ollama.exe" in result.stdout
         else:
-            result = subprocess.run(
+            result = run_command(
                 ["pgrep", "-f", "ollama"],
                 capture_output=True,
                 text=True
@@ -357,6 +1578,7 @@ def is_ollama_running():
     except:
         return False
 
+@traced("menu.stop_service")
 def stop_service():
     """停止 Ollama 服务"""
     clear_screen()
@@ -368,16 +1590,27 @@ def stop_service():
         input("\n按回车键返回菜单...")
         return
     
+    # 只停止实际的服务进程及其子进程（runner），不按名称误杀其他进程
+    root_pids = find_server_pids()
     stopped = False
     
-    # 如果有 psutil，使用更优雅的方式
-    if HAS_PSUTIL:
-        stopped = stop_with_psutil()
+    if not root_pids:
+        print(f"  未找到监听端口 {get_server_port()} 的服务进程")
     else:
-        # 使用系统命令
-        stopped = stop_with_system_commands()
+        pids = collect_process_tree(root_pids)
+        print(f"  服务进程: {', '.join(map(str, sorted(root_pids)))}"
+              f"（含子进程共 {len(pids)} 个）")
+        started = time.monotonic()
+        if HAS_PSUTIL:
+            # 如果有 psutil，使用更优雅的方式
+            stopped = stop_with_psutil(pids)
+        else:
+            # 使用系统命令
+            stopped = stop_with_system_commands(pids)
+        print(f"  用时 {time.monotonic() - started:.1f} 秒")
     
     if stopped:
+        clear_tracked_server_pid()
         print("\n✅ Ollama 服务已停止")
     else:
         print("\n⚠️  无法自动停止服务")
@@ -393,66 +1626,284 @@ def stop_service():
     
     input("\n按回车键返回菜单...")
 
-def stop_with_psutil():
-    """使用 psutil 停止服务"""
+# ------------ 服务进程定位 ------------
+SERVER_PID_FILE = "server.pid"
+
+def get_server_port():
+    """服务监听的端口"""
+    return urllib.parse.urlsplit(get_ollama_base_url()).port
+
+def _process_name(pid):
+    """获取进程名，失败时返回空字符串"""
+    if HAS_PSUTIL:
+        try:
+            import psutil
+            return psutil.Process(pid).name()
+        except Exception:
+            return ""
     try:
-        import psutil
-        stopped_count = 0
-        
-        for proc in psutil.process_iter(['name', 'pid']):
-            try:
-                if proc.info['name'] and 'ollama' in proc.info['name'].lower():
-                    print(f"  正在停止进程 {proc.info['pid']}...")
-                    proc.terminate()
-                    try:
-                        proc.wait(timeout=3)
-                    except:
-                        proc.kill()
-                    stopped_count += 1
-            except:
-                continue
-        
-        return stopped_count > 0
-    except Exception as e:
-        print(f"  使用 psutil 失败: {str(e)}")
-        return False
+        with open(f"/proc/{pid}/comm", 'r') as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    try:
+        result = run_command(["ps", "-p", str(pid), "-o", "comm="],
+                             capture_output=True, text=True, timeout=3)
+        return os.path.basename(result.stdout.strip())
+    except Exception:
+        return ""
 
-def stop_with_system_commands():
-    """使用系统命令停止服务"""
-    system = platform.system()
+def _linux_listening_pids(port):
+    """通过 /proc 查找监听端口的进程（无需 psutil）"""
+    inodes = set()
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table, 'r') as f:
+                next(f, None)
+                for line in f:
+                    fields = line.split()
+                    # 状态 0A 表示 LISTEN
+                    if (len(fields) > 9 and fields[3] == "0A"
+                            and int(fields[1].rsplit(":", 1)[1], 16) == port):
+                        inodes.add(f"socket:[{fields[9]}]")
+        except OSError:
+            continue
     
-    try:
-        if system == "Windows":
-            print("  尝试 taskkill...")
-            result = subprocess.run(
-                ["taskkill", "/f", "/im", "ollama.exe"],
-                capture_output=True,
-                timeout=5
-            )
-            
-            if result.returncode != 0:
-                print("  尝试 WMIC...")
-                subprocess.run(
-                    ["wmic", "process", "where", "name='ollama.exe'", "delete"],
-                    capture_output=True,
-                    timeout=5
-                )
-            
-        elif system == "Darwin":  # macOS
-            print("  尝试 pkill...")
-            subprocess.run(["pkill", "-f", "ollama"], timeout=5)
-            
-        else:  # Linux
-            print("  尝试 pkill...")
-            subprocess.run(["pkill", "ollama"], timeout=5)
-            subprocess.run(["killall", "ollama"], timeout=5)
+    pids = set()
+    if not inodes:
+        return pids
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        fd_dir = f"/proc/{entry}/fd"
+        try:
+            for fd in os.listdir(fd_dir):
+                if os.readlink(os.path.join(fd_dir, fd)) in inodes:
+                    pids.add(int(entry))
+                    break
+        except OSError:
+            continue
+    return pids
+
+def find_listening_pids(port):
+    """查找监听指定 TCP 端口的进程 PID"""
+    if HAS_PSUTIL:
+        try:
+            import psutil
+            pids = {conn.pid for conn in psutil.net_connections(kind='tcp')
+                    if conn.status == psutil.CONN_LISTEN and conn.laddr
+                    and conn.laddr.port == port and conn.pid}
+            if pids:
+                return pids
+        except Exception:
+            # 部分系统需要管理员权限才能列出所有连接
+            pass
+    
+    system = platform.system()
+    try:
+        if system == "Linux":
+            return _linux_listening_pids(port)
+        elif system == "Darwin":
+            result = run_command(["lsof", "-nP", f"-iTCP:{port}", "-sTCP:LISTEN", "-t"],
+                                 capture_output=True, text=True, timeout=5)
+            return {int(line) for line in result.stdout.split() if line.isdigit()}
+        elif system == "Windows":
+            result = run_command(["netstat", "-ano", "-p", "tcp"],
+                                 capture_output=True, text=True, timeout=5)
+            pids = set()
+            for line in result.stdout.splitlines():
+                fields = line.split()
+                if (len(fields) >= 5 and fields[3].upper() == "LISTENING"
+                        and fields[1].rsplit(":", 1)[-1] == str(port)):
+                    pids.add(int(fields[4]))
+            return pids
+    except Exception:
+        pass
+    return set()
+
+def save_tracked_server_pid(pid):
+    """记录服务进程 PID，停止服务时优先使用"""
+    save_json_file(os.path.join(get_manager_dir(), SERVER_PID_FILE),
+                   {"pid": pid, "port": get_server_port(), "saved_at": time.time()})
+
+def clear_tracked_server_pid():
+    """删除已记录的服务进程 PID"""
+    try:
+        os.remove(os.path.join(MANAGER_DIR, SERVER_PID_FILE))
+    except OSError:
+        pass
+
+def find_server_pids():
+    """定位服务进程：优先使用已记录的 PID，否则查找监听端口的进程"""
+    tracked = load_json_file(os.path.join(MANAGER_DIR, SERVER_PID_FILE))
+    if tracked and tracked.get("port") == get_server_port():
+        pid = tracked.get("pid")
+        # PID 可能已被其他进程复用，需确认仍是 ollama
+        if pid and 'ollama' in _process_name(pid).lower():
+            return {pid}
+    return {pid for pid in find_listening_pids(get_server_port())
+            if 'ollama' in _process_name(pid).lower()}
+
+def _child_pid_map():
+    """构建 父PID -> [子PID] 映射（无 psutil 时使用）"""
+    children = {}
+    if os.path.isdir("/proc"):
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", 'r') as f:
+                    # 进程名可能包含空格和括号，从最后一个 ')' 之后解析
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        return children
+    try:
+        result = run_command(["ps", "-A", "-o", "pid=,ppid="],
+                             capture_output=True, text=True, timeout=5)
+        for line in result.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+                children.setdefault(int(fields[1]), []).append(int(fields[0]))
+    except Exception:
+        pass
+    return children
+
+def collect_process_tree(root_pids):
+    """返回根进程及其所有子孙进程的 PID 集合"""
+    pids = set(root_pids)
+    if HAS_PSUTIL:
+        try:
+            import psutil
+            for pid in root_pids:
+                try:
+                    pids.update(child.pid for child in psutil.Process(pid).children(recursive=True))
+                except psutil.Error:
+                    continue
+            return pids
+        except Exception:
+            pass
+    if platform.system() == "Windows":
+        # taskkill /T 会自行处理子进程
+        return pids
+    
+    children = _child_pid_map()
+    queue = list(root_pids)
+    while queue:
+        for child in children.get(queue.pop(), []):
+            if child not in pids:
+                pids.add(child)
+                queue.append(child)
+    return pids
+
+def stop_with_psutil(pids):
+    """使用 psutil 同时终止整棵进程树，统一等待后只强杀未退出的进程"""
+    try:
+        import psutil
+        procs = []
+        for pid in pids:
+            try:
+                procs.append(psutil.Process(pid))
+            except psutil.Error:
+                continue
+        
+        for proc in procs:
+            try:
+                proc.terminate()
+            except psutil.Error:
+                continue
+        _, alive = psutil.wait_procs(procs, timeout=get_timeout("stop_grace"))
         
+        for proc in alive:
+            print(f"  进程 {proc.pid} 未响应，强制结束...")
+            try:
+                proc.kill()
+            except psutil.Error:
+                continue
+        _, alive = psutil.wait_procs(alive, timeout=2)
+        return not alive
+    except Exception as e:
+        print(f"  使用 psutil 失败: {str(e)}")
+        return False
+
+def _pid_alive(pid):
+    """检查进程是否仍在运行（僵尸进程视为已退出）"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
         return True
+
+def _wait_pids_exit(pids, timeout):
+    """在同一个期限内等待所有进程退出，返回仍存活的 PID"""
+    deadline = time.monotonic() + timeout
+    alive = set(pids)
+    while alive and time.monotonic() < deadline:
+        time.sleep(0.1)
+        alive = {pid for pid in alive if _pid_alive(pid)}
+    return alive
+
+def _windows_wait_pids_exit(pids, timeout):
+    """Windows 上用 tasklist 等待进程退出（os.kill 在 Windows 上会直接结束进程），返回仍存活的 PID"""
+    deadline = time.monotonic() + timeout
+    alive = set(pids)
+    while alive:
+        result = run_command(["tasklist", "/fo", "csv", "/nh"],
+                             capture_output=True, text=True, timeout=5)
+        running = {int(row[1]) for row in csv.reader(result.stdout.splitlines())
+                   if len(row) > 1 and row[1].isdigit()}
+        alive &= running
+        if not alive or time.monotonic() >= deadline:
+            break
+        time.sleep(0.2)
+    return alive
+
+def stop_with_system_commands(pids):
+    """使用系统命令/信号停止指定进程"""
+    system = platform.system()
+    
+    try:
+        if system == "Windows":
+            # /T 结束整个进程树；先尝试正常结束，超时后再加 /F
+            for pid in pids:
+                run_command(["taskkill", "/T", "/PID", str(pid)], capture_output=True, timeout=5)
+            alive = _windows_wait_pids_exit(pids, get_timeout("stop_grace"))
+            for pid in alive:
+                print(f"  进程 {pid} 未响应，强制结束...")
+                result = run_command(["taskkill", "/F", "/T", "/PID", str(pid)],
+                                     capture_output=True, text=True, timeout=5)
+                if result.returncode != 0:
+                    print(f"  taskkill 失败: {(result.stderr or result.stdout).strip()}")
+            # 与其他平台一样，以进程确实退出为准（taskkill 可能因权限不足失败）
+            return not _windows_wait_pids_exit(alive, 2)
+        
+        # macOS / Linux：一次性向整棵进程树发送 SIGTERM
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                continue
+        alive = _wait_pids_exit(pids, get_timeout("stop_grace"))
+        for pid in alive:
+            print(f"  进程 {pid} 未响应，强制结束...")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                continue
+        return not _wait_pids_exit(alive, 2)
         
     except Exception as e:
         print(f"  系统命令失败: {str(e)}")
         return False
 
+@traced("menu.list_models")
 def list_models():
     """列出所有模型"""
     clear_screen()
@@ -460,12 +1911,12 @@ def list_models():
     print("\n📋 获取模型列表...\n")
     
     try:
-        result = subprocess.run(
+        result = run_command(
             ["ollama", "list"],
             capture_output=True,
             text=True,
             encoding='utf-8',
-            timeout=10
+            timeout=get_timeout("list")
         )
         
         if result.returncode == 0 and result.stdout:
@@ -494,6 +1945,7 @@ def list_models():
     
     input("\n按回车键返回菜单...")
 
+@traced("menu.chat_with_model")
 def chat_with_model():
     """与模型对话"""
     clear_screen()
@@ -503,11 +1955,11 @@ def chat_with_model():
     # 先获取模型列表
     print("正在获取可用模型...")
     try:
-        result = subprocess.run(
+        result = run_command(
             ["ollama", "list"],
             capture_output=True,
             text=True,
-            timeout=8
+            timeout=get_timeout("list")
         )
         
         if result.returncode == 0 and result.stdout:
@@ -534,6 +1986,36 @@ def chat_with_model():
         input("\n按回车键返回菜单...")
         return
     
+    # 可选：基于本地文档文件夹的检索增强对话
+    rag_index = None
+    if HAS_NUMPY:
+        folder = input("知识库文件夹 (直接回车不使用): ").strip()
+        if folder:
+            if not os.path.isdir(folder):
+                print("❌ 文件夹不存在")
+                input("\n按回车键返回菜单...")
+                return
+            try:
+                print("\n正在检查知识库索引...\n")
+                rag_index = update_rag_index(folder, DEFAULT_EMBED_MODEL)
+            except (OllamaAPIError, OSError) as e:
+                print(f"❌ 索引更新失败: {str(e)}")
+                input("\n按回车键返回菜单...")
+                return
+    
+    if rag_index is not None:
+        print(f"\n📚 已启用知识库: {rag_index.folder}")
+        print("  • 每个问题都会检索相关片段并注入提示词")
+        print("  • 输入 '/bye' 或 '/exit' 退出对话")
+        print("=" * 60)
+        try:
+            rag_chat(model_name, rag_index)
+        except KeyboardInterrupt:
+            print("\n\n🛑 对话被用户中断")
+        print("\n" + "=" * 60)
+        input("\n按回车键返回菜单...")
+        return
+    
     clear_screen()
     print_header()
     print(f"\n🤖 正在启动 {model_name} 对话...")
@@ -547,7 +2029,7 @@ def chat_with_model():
     
     try:
         # 直接运行对话
-        process = subprocess.run(
+        process = run_command(
             ["ollama", "run", model_name],
             text=True,
             encoding='utf-8'
@@ -567,6 +2049,7 @@ def chat_with_model():
     print("\n" + "=" * 60)
     input("\n按回车键返回菜单...")
 
+@traced("menu.download_model")
 def download_model():
     """下载新模型"""
     clear_screen()
@@ -575,31 +2058,43 @@ def download_model():
     
     print("推荐模型列表（模型名的后缀表示有多少个指令，指令越多，功能越强）:")
     print("-" * 50)
-    print(" 1. llama3.2:1b     - 1B参数，最小最快")
-    print(" 2. phi3:mini       - 3.8B，性能优秀（推荐）")
-    print(" 3. qwen2.5:0.5b    - 0.5B，中文优化最小")
-    print(" 4. llama3.2        - 8B，标准版本")
-    print(" 5. mistral         - 7B，法语优化")
-    print(" 6. gemma2:2b       - 2B，谷歌轻量版")
+    for i, (name, description) in enumerate(RECOMMENDED_MODELS, 1):
+        print(f" {i}. {name:<15} - {description}")
     print(" 7. 输入自定义模型   - 若不知道其他模型，请访问 https://ollama.com/library 后将您要下载的模型的完整名称填写到下方")
+    print(" 8. 搜索模型目录     - 在离线目录中按名称、前缀或近似拼写查找")
+    print(" 9. 按本机硬件推荐   - 根据内存和 CPU 核心数筛选能流畅运行的模型")
     print("-" * 50)
     print()
     
-    choice = input("请选择 (1-7): ").strip()
+    choice = input("请选择 (1-9): ").strip()
     
-    model_map = {
-        '1': 'llama3.2:1b',
-        '2': 'phi3:mini',
-        '3': 'qwen2.5:0.5b',
-        '4': 'llama3.2',
-        '5': 'mistral',
-        '6': 'gemma2:2b'
-    }
+    model_map = {str(i): name for i, (name, _) in enumerate(RECOMMENDED_MODELS, 1)}
     
     if choice in model_map:
         model_name = model_map[choice]
     elif choice == '7':
         model_name = input("\n请输入完整的模型名称: ").strip()
+        if model_name and not catalog_contains(model_name):
+            # 目录中找不到时给出近似名称，避免拼写错误浪费一次下载
+            print(f"\n⚠️  目录中没有 '{model_name}'，您是不是要找:")
+            suggestion = pick_from_catalog(model_name)
+            if suggestion:
+                model_name = suggestion
+            elif input(f"仍然下载 '{model_name}'? (y/N): ").strip().lower() != 'y':
+                return
+    elif choice == '8':
+        query = input("\n搜索模型: ").strip()
+        print()
+        model_name = pick_from_catalog(query) if query else None
+        if not model_name:
+            input("\n按回车键返回菜单...")
+            return
+    elif choice == '9':
+        print()
+        model_name = pick_recommended_model()
+        if not model_name:
+            input("\n按回车键返回菜单...")
+            return
     else:
         print("❌ 无效选择")
         input("\n按回车键返回菜单...")
@@ -610,6 +2105,19 @@ def download_model():
         input("\n按回车键返回菜单...")
         return
     
+    if not confirm_model_fit(model_name):
+        return
+    
+    if input("\n直接回车立即下载，输入 s 加入计划下载队列 (夜间/限速): ").strip().lower() == 's':
+        try:
+            window = input("时间窗口 (如 01:00-06:00，直接回车不限): ").strip()
+            job = get_pull_scheduler().add(model_name, window)
+            print(f"✅ 已加入队列，任务 #{job['id']}。在 高级工具 → 计划下载队列 中开始处理")
+        except (ValueError, OSError) as e:
+            print(f"❌ 加入队列失败: {str(e)}")
+        input("\n按回车键返回菜单...")
+        return
+    
     clear_screen()
     print_header()
     print(f"\n⬇️  正在下载模型: {model_name}")
@@ -623,29 +2131,32 @@ def download_model():
     
     try:
         # 显示实时进度
-        process = subprocess.Popen(
-            ["ollama", "pull", model_name],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            encoding='utf-8'
-        )
+        pull_started = time.perf_counter()
+        with trace_span("exec ollama pull"):
+            process = subprocess.Popen(
+                ["ollama", "pull", model_name],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                encoding='utf-8'
+            )
         
-        print("下载进度:")
-        print("-" * 40)
+            print("下载进度:")
+            print("-" * 40)
         
-        # 读取输出
-        for line in process.stdout:
-            line = line.strip()
-            if line:
-                print(f"  {line}")
+            # 读取输出
+            for line in process.stdout:
+                line = line.strip()
+                if line:
+                    print(f"  {line}")
         
-        process.wait()
+            process.wait()
         
         if process.returncode == 0:
             print("-" * 40)
             print(f"\n🎉 下载完成! 模型 '{model_name}' 已成功安装")
+            record_pull_metrics(model_name, time.perf_counter() - pull_started)
         else:
             print("\n❌ 下载失败")
             print("可能的原因:")
@@ -655,11 +2166,13 @@ def download_model():
             
     except KeyboardInterrupt:
         print("\n\n🛑 下载已取消")
+        print("   未完成的下载文件可在 高级工具 → 清理孤立数据块 中删除")
     except Exception as e:
         print(f"\n❌ 下载出错: {str(e)}")
     
     input("\n按回车键返回菜单...")
 
+@traced("menu.delete_model")
 def delete_model():
     """删除模型"""
     clear_screen()
@@ -668,11 +2181,11 @@ def delete_model():
     
     print("正在获取模型列表...")
     try:
-        result = subprocess.run(
+        result = run_command(
             ["ollama", "list"],
             capture_output=True,
             text=True,
-            timeout=8
+            timeout=get_timeout("list")
         )
         
         if result.returncode == 0 and result.stdout:
@@ -700,6 +2213,13 @@ def delete_model():
     
     # 确认删除
     print()
+    pinned = get_config()["pinned_models"]
+    if model_name in pinned or model_name + ":latest" in pinned:
+        print(f"📌 '{model_name}' 是配置文件中的固定模型")
+        if input("   请输入完整的模型名称以确认: ").strip() != model_name:
+            print("删除操作已取消")
+            input("\n按回车键返回菜单...")
+            return
     confirm = input(f"⚠️  确定要永久删除模型 '{model_name}' 吗？ (y/n): ").strip().lower()
     
     if confirm != 'y':
@@ -710,11 +2230,11 @@ def delete_model():
     print(f"\n正在删除模型 '{model_name}'...")
     
     try:
-        result = subprocess.run(
+        result = run_command(
             ["ollama", "rm", model_name],
             capture_output=True,
             text=True,
-            timeout=30
+            timeout=get_timeout("delete")
         )
         
         if result.returncode == 0:
@@ -729,6 +2249,7 @@ def delete_model():
     
     input("\n按回车键返回菜单...")
 
+@traced("menu.check_system_status")
 def check_system_status():
     """检查系统状态"""
     clear_screen()
@@ -769,6 +2290,7 @@ def check_system_status():
     
     input("\n按回车键返回菜单...")
 
+@traced("menu.open_model_folder")
 def open_model_folder():
     """打开模型文件夹"""
     clear_screen()
@@ -808,9 +2330,9 @@ def open_model_folder():
                 if platform.system() == "Windows":
                     os.startfile(path)
                 elif platform.system() == "Darwin":
-                    subprocess.run(["open", path])
+                    run_command(["open", path])
                 else:
-                    subprocess.run(["xdg-open", path])
+                    run_command(["xdg-open", path])
                 print(f"已打开文件夹")
                 found = True
                 break
@@ -835,7 +2357,9 @@ def system_settings():
     print("2. 测试 Ollama 连接")
     print("3. 查看环境变量")
     print("4. 查看安装说明")
-    print("5. 返回主菜单")
+    print("5. 查看配置文件")
+    print("6. 预加载固定模型")
+    print("7. 返回主菜单")
     print()
     
     choice = input("请选择: ").strip()
@@ -850,6 +2374,10 @@ def system_settings():
         show_manual_installation_guide()
         system_settings()
     elif choice == "5":
+        show_config()
+    elif choice == "6":
+        preload_pinned_models()
+    elif choice == "7":
         return
     else:
         print("❌ 无效选择")
@@ -894,55 +2422,90 @@ def reinstall_psutil():
     input("\n按回车键返回设置...")
     system_settings()
 
+@traced("menu.show_config")
+def show_config():
+    """查看配置文件和状态缓存"""
+    clear_screen()
+    print_header()
+    print("\n🧾 配置文件\n")
+    
+    config_path = os.path.join(MANAGER_DIR, CONFIG_FILE)
+    print(f"配置文件: {config_path} {'(已存在)' if os.path.exists(config_path) else '(未创建，使用默认值)'}")
+    print(f"服务地址: {get_ollama_base_url()}"
+          f"{' (来自 OLLAMA_HOST)' if os.environ.get('OLLAMA_HOST') else ''}")
+    print(f"模型目录: {get_models_dir()}")
+    print("\n当前生效的配置:")
+    print("-" * 50)
+    print(json.dumps(get_config(), ensure_ascii=False, indent=2))
+    print("-" * 50)
+    
+    binary = load_state().get("binary") or {}
+    if binary:
+        print("\n状态缓存:")
+        print(f"  可执行文件: {binary.get('path', '-')}")
+        print(f"  版本:       {binary.get('version', '-')}")
+    
+    print("\n操作:")
+    print("  c. 创建/补全配置文件（保留已有设置）")
+    print("  r. 重新读取配置文件")
+    print("  x. 清除状态缓存（下次重新查找 ollama）")
+    choice = input("\n请选择 (直接回车返回): ").strip().lower()
+    
+    if choice == "c":
+        save_json_file(os.path.join(get_manager_dir(), CONFIG_FILE), get_config())
+        print(f"✅ 已写入 {config_path}，修改后选择 r 重新读取")
+    elif choice == "r":
+        get_config(reload=True)
+        print("✅ 已重新读取配置")
+    elif choice == "x":
+        load_state().pop("binary", None)
+        save_state()
+        print("✅ 已清除状态缓存")
+    
+    if choice:
+        input("\n按回车键返回设置...")
+    system_settings()
+
+@traced("menu.preload_pinned_models")
+def preload_pinned_models():
+    """把配置中的固定模型加载到内存并常驻"""
+    clear_screen()
+    print_header()
+    print("\n📌 预加载固定模型\n")
+    
+    pinned = get_config()["pinned_models"]
+    if not pinned:
+        print("配置文件中没有固定模型 (pinned_models)")
+        print(f"可在 {os.path.join(MANAGER_DIR, CONFIG_FILE)} 中添加")
+    for model in pinned:
+        print(f"  正在加载 {model}...", end=' ', flush=True)
+        try:
+            # 空提示词只加载模型，keep_alive=-1 表示常驻内存
+            response = generate_text(model, "", keep_alive=-1)
+            print(f"✅ ({response['wall_seconds']:.1f} 秒)")
+        except OllamaAPIError as e:
+            print(f"❌ {str(e)}")
+    
+    input("\n按回车键返回设置...")
+    system_settings()
+
+@traced("menu.test_ollama_connection")
 def test_ollama_connection():
     """测试 Ollama 连接"""
     clear_screen()
     print_header()
     print("\n🔗 测试 Ollama 连接\n")
     
-    print("1. 测试基本连接...")
-    try:
-        result = subprocess.run(
-            ["ollama", "--version"],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.returncode == 0:
-            print(f"   ✅ Ollama 版本: {result.stdout.strip()}")
-        else:
-            print(f"   ❌ 命令失败: {result.stderr}")
-    except Exception as e:
-        print(f"   ❌ 测试失败: {str(e)}")
-    
-    print("\n2. 测试服务运行状态...")
-    if is_ollama_running():
-        print("   ✅ Ollama 服务正在运行")
-    else:
-        print("   ❌ Ollama 服务未运行")
-    
-    print("\n3. 测试模型列表...")
-    try:
-        result = subprocess.run(
-            ["ollama", "list"],
-            capture_output=True,
-            text=True,
-            timeout=8
-        )
-        if result.returncode == 0:
-            lines = result.stdout.strip().split('\n')
-            if len(lines) > 1:
-                print(f"   ✅ 找到 {len(lines)-1} 个模型")
-            else:
-                print("   ✅ 连接成功，但无模型")
-        else:
-            print("   ❌ 获取模型列表失败")
-    except Exception as e:
-        print(f"   ❌ 测试失败: {str(e)}")
+    print(f"正在并行检查（最多 {get_timeout('diagnostics'):.0f} 秒）...\n")
+    started = time.monotonic()
+    results = run_diagnostics()
+    print_diagnostics(results)
+    print(f"\n总耗时: {(time.monotonic() - started) * 1000:.0f} ms")
     
     input("\n按回车键返回设置...")
     system_settings()
 
+@traced("menu.show_environment_variables")
 def show_environment_variables():
     """显示环境变量"""
     clear_screen()
@@ -994,89 +2557,12 @@ def show_environment_variables():
     else:
         print("   ❌ 未在PATH中找到 'ollama'")
     
-    # 方法2：尝试运行 ollama 命令
-    print("\n2. 命令可执行性检查:")
-    try:
-        if platform.system() == "Windows":
-            result = subprocess.run(
-                ["where", "ollama"],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-        else:
-            result = subprocess.run(
-                ["which", "ollama"],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-        
-        if result.returncode == 0:
-            print(f"   ✅ 系统找到 ollama: {result.stdout.strip()}")
-        else:
-            print("   ❌ 系统找不到 ollama 命令")
-    except Exception as e:
-        print(f"   ⚠️  检查命令失败: {str(e)}")
-    
-    # 方法3：检查常见安装位置
-    print("\n3. 常见安装位置检查:")
-    common_paths = []
-    
-    if platform.system() == "Windows":
-        common_paths = [
-            r"C:\Program Files\Ollama",
-            r"C:\Program Files (x86)\Ollama",
-            os.path.join(os.environ.get('ProgramFiles', ''), "Ollama"),
-            os.path.join(os.environ.get('ProgramFiles(x86)', ''), "Ollama"),
-            os.path.join(os.environ.get('LOCALAPPDATA', ''), "Programs", "Ollama"),
-            os.path.join(os.environ.get('APPDATA', ''), "Local", "Programs", "Ollama"),
-        ]
-    elif platform.system() == "Darwin":  # macOS
-        common_paths = [
-            "/usr/local/bin",
-            "/opt/homebrew/bin",
-            "/Applications/Ollama.app/Contents/MacOS",
-            os.path.expanduser("~/.local/bin"),
-            os.path.expanduser("~/Applications/Ollama.app/Contents/MacOS"),
-        ]
-    else:  # Linux
-        common_paths = [
-            "/usr/local/bin",
-            "/usr/bin",
-            "/bin",
-            "/opt/ollama",
-            os.path.expanduser("~/.local/bin"),
-            os.path.expanduser("~/bin"),
-        ]
-    
-    found_common = False
-    for path in common_paths:
-        if os.path.exists(os.path.join(path, "ollama" if platform.system() != "Windows" else "ollama.exe")):
-            found_common = True
-            print(f"   ✅ 找到: {path}")
-            break
-    
-    if not found_common:
-        print("   ⚠️  未在常见位置找到")
-    
-    # 方法4：直接测试 ollama 命令
-    print("\n4. 直接测试 ollama 命令:")
-    try:
-        result = subprocess.run(
-            ["ollama", "--version"],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        if result.returncode == 0:
-            print(f"   ✅ ollama 命令可执行: {result.stdout.strip()}")
-        else:
-            print(f"   ⚠️  ollama 命令返回错误: {result.stderr[:50]}")
-    except FileNotFoundError:
-        print("   ❌ 找不到 ollama 命令")
-    except Exception as e:
-        print(f"   ⚠️  测试失败: {str(e)}")
+    # 方法2~4：并行诊断（进程内查找可执行文件、版本、服务接口等）
+    print(f"\n2. 并行诊断（最多 {get_timeout('diagnostics'):.0f} 秒）:")
+    results = run_diagnostics()
+    print_diagnostics(results)
+    found_common = any(name in ("可执行文件", "常见安装位置") and ok
+                       for name, ok, _, _ in results)
     
     print("-" * 40)
     
@@ -1095,19 +2581,5485 @@ def show_environment_variables():
     input("\n按回车键返回设置...")
     system_settings()
 
-# ============ 第五部分：主程序 ============
-def main():
-    """主程序"""
-    # 初始化程序（检查并询问安装）
-    if not initialize_program():
+# ============ 第五部分：高级工具 ============
+def advanced_tools():
+    """高级工具菜单"""
+    while True:
+        clear_screen()
+        print_header()
+        print("\n🧰 高级工具\n")
+        
+        print("1. 📈 服务日志分析")
+        print("2. 🧮 批量生成向量 (Embedding)")
+        print("3. 📚 本地知识库 (建立/更新索引)")
+        print("4. ⚖️  多模型对比")
+        print("5. ⏱️  耗时追踪报告")
+        print("6. 📡 Prometheus 指标导出")
+        print("7. 📖 模型目录 (搜索/导入/刷新)")
+        print("8. 🖥️  按本机硬件推荐模型")
+        print("9. 📦 模型导出/导入 (离线传输)")
+        print("10. 🔗 存储复制与去重")
+        print("11. 🔍 数据块完整性校验")
+        print("12. 🧹 清理孤立数据块")
+        print("13. 👀 模型清单实时监视")
+        print("14. 🗓️  计划下载队列 (时间窗口/限速)")
+        print("15. 🗄️  模型仓库缓存代理")
+        print("16. 🛰️  管理器守护进程")
+        print("17. 🏋️  负载测试 (延迟分位数/吞吐量)")
+        print("18. 🗃️  基准测试记录 (回归对比)")
+        print("19. 🎛️  运行参数自动调优 (线程/批大小/上下文)")
+        print("0. 返回主菜单")
+        print()
+        
+        choice = input("请选择: ").strip()
+        
+        if choice == "1":
+            analyze_server_log()
+        elif choice == "2":
+            embedding_job_menu()
+        elif choice == "3":
+            rag_index_menu()
+        elif choice == "4":
+            compare_models_menu()
+        elif choice == "5":
+            trace_report_menu()
+        elif choice == "6":
+            metrics_exporter_menu()
+        elif choice == "7":
+            catalog_menu()
+        elif choice == "8":
+            hardware_recommend_menu()
+        elif choice == "9":
+            bundle_menu()
+        elif choice == "10":
+            store_replicate_menu()
+        elif choice == "11":
+            verify_store_menu()
+        elif choice == "12":
+            garbage_collect_menu()
+        elif choice == "13":
+            inventory_watch_menu()
+        elif choice == "14":
+            pull_queue_menu()
+        elif choice == "15":
+            registry_cache_menu()
+        elif choice == "16":
+            daemon_menu()
+        elif choice == "17":
+            loadtest_menu()
+        elif choice == "18":
+            benchmark_db_menu()
+        elif choice == "19":
+            autotune_menu()
+        elif choice == "0":
+            return
+        else:
+            print("❌ 无效选择")
+            time.sleep(1)
+
+# ------------ 服务日志分析 ------------
+LOG_STATE_FILE = "log_state.json"
+LOG_SAMPLE_LIMIT = 2000  # 每类耗时最多保留的样本数（用于计算分位数）
+
+# Gin 请求日志: [GIN] 2024/07/22 - 10:11:12 | 200 |  1.234s | 127.0.0.1 | POST "/api/chat"
+GIN_LINE_RE = re.compile(
+    r'\[GIN\]\s+(?P<time>[\d/]+ - [\d:]+)\s*\|\s*(?P<status>\d{3})\s*\|'
+    r'\s*(?P<duration>[\d.hmsµun]+)\s*\|\s*(?P<client>[^|]*?)\s*\|'
+    r'\s*(?P<method>[A-Z]+)\s+"(?P<path>[^"]+)"'
+)
+GO_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(h|ms|us|µs|ns|m|s)')
+GO_DURATION_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 1e-3, 'us': 1e-6, 'µs': 1e-6, 'ns': 1e-9}
+
+RUNNER_STARTED_RE = re.compile(r'runner started in (\d+(?:\.\d+)?) seconds')
+RUNNER_STARTING_RE = re.compile(r'msg="(starting llama server|starting runner|starting go runner)')
+EVICTION_RE = re.compile(r'evict|expired event|make room|unloading|model unloaded', re.IGNORECASE)
+OOM_RE = re.compile(
+    r'out of memory|cudaMalloc failed|insufficient memory|requires more system memory'
+    r'|failed to allocate|\bOOM\b', re.IGNORECASE)
+CONTEXT_OVERFLOW_RE = re.compile(
+    r'truncating input|exceeds (the )?(context|maximum)|context limit|input length exceeds'
+    r'|context shift', re.IGNORECASE)
+LOG_LEVEL_RE = re.compile(r'level=(\w+)')
+
+def get_server_log_path():
+    """获取 Ollama 服务日志的默认路径"""
+    if platform.system() == "Windows":
+        local_app_data = os.environ.get('LOCALAPPDATA', os.path.expanduser("~"))
+        return os.path.join(local_app_data, "Ollama", "server.log")
+    # macOS 桌面版默认写入此处；Linux 下由 start_service 通过 tee 写入
+    return os.path.join(os.path.expanduser("~"), ".ollama", "logs", "server.log")
+
+def parse_go_duration(text):
+    """解析 Go 风格的时长字符串（如 1m2.5s、350ms），返回秒数"""
+    total = 0.0
+    matched = False
+    for value, unit in GO_DURATION_RE.findall(text):
+        total += float(value) * GO_DURATION_UNITS[unit]
+        matched = True
+    return total if matched else None
+
+def new_log_stats():
+    """创建空的日志统计结构"""
+    return {
+        "lines": 0,
+        "runner_starts": 0,
+        "load_count": 0,
+        "load_seconds": 0.0,
+        "load_max": 0.0,
+        "load_samples": [],
+        "evictions": 0,
+        "oom_events": 0,
+        "context_overflows": 0,
+        "errors": 0,
+        "requests": {},
+        "recent_events": [],
+    }
+
+def _keep_sample(samples, value):
+    """保存样本，超过上限时丢弃最旧的"""
+    samples.append(round(value, 6))
+    if len(samples) > LOG_SAMPLE_LIMIT:
+        del samples[:len(samples) - LOG_SAMPLE_LIMIT]
+
+def _record_event(stats, kind, line):
+    """记录最近的重要事件（OOM、上下文溢出等）"""
+    stats["recent_events"].append([kind, line[:200]])
+    if len(stats["recent_events"]) > 20:
+        del stats["recent_events"][0]
+
+def parse_log_line(line, stats):
+    """解析一行服务日志并更新统计"""
+    stats["lines"] += 1
+    
+    match = GIN_LINE_RE.search(line)
+    if match:
+        duration = parse_go_duration(match.group("duration"))
+        if duration is None:
+            return
+        path = match.group("path").split("?")[0]
+        req = stats["requests"].setdefault(path, {
+            "count": 0, "errors": 0, "seconds": 0.0, "max": 0.0, "samples": []
+        })
+        req["count"] += 1
+        req["seconds"] += duration
+        req["max"] = max(req["max"], duration)
+        if not match.group("status").startswith("2"):
+            req["errors"] += 1
+        _keep_sample(req["samples"], duration)
         return
     
-    # 主循环
-    while True:
+    level = LOG_LEVEL_RE.search(line)
+    if level and level.group(1).upper() == "ERROR":
+        stats["errors"] += 1
+    
+    match = RUNNER_STARTED_RE.search(line)
+    if match:
+        seconds = float(match.group(1))
+        stats["load_count"] += 1
+        stats["load_seconds"] += seconds
+        stats["load_max"] = max(stats["load_max"], seconds)
+        _keep_sample(stats["load_samples"], seconds)
+    elif RUNNER_STARTING_RE.search(line):
+        stats["runner_starts"] += 1
+    elif EVICTION_RE.search(line):
+        stats["evictions"] += 1
+    
+    if OOM_RE.search(line):
+        stats["oom_events"] += 1
+        _record_event(stats, "OOM", line.strip())
+    elif CONTEXT_OVERFLOW_RE.search(line):
+        stats["context_overflows"] += 1
+        _record_event(stats, "上下文溢出", line.strip())
+
+def update_log_stats(log_path):
+    """从上次的偏移量开始增量读取日志，返回 (统计, 本次新增行数)"""
+    state_path = os.path.join(get_manager_dir(), LOG_STATE_FILE)
+    all_state = load_json_file(state_path, {})
+    key = os.path.abspath(log_path)
+    entry = all_state.get(key)
+    
+    st = os.stat(log_path)
+    # 文件被轮转或截断时从头开始
+    if (not entry or entry.get("inode") != st.st_ino
+            or entry.get("offset", 0) > st.st_size):
+        entry = {"inode": st.st_ino, "offset": 0, "stats": new_log_stats()}
+    
+    stats = entry["stats"]
+    before = stats["lines"]
+    
+    with open(log_path, 'rb') as f:
+        f.seek(entry["offset"])
+        while True:
+            raw = f.readline()
+            # 只处理完整的行，未写完的行留到下次
+            if not raw or not raw.endswith(b"\n"):
+                break
+            entry["offset"] += len(raw)
+            parse_log_line(raw.decode('utf-8', errors='replace'), stats)
+    
+    all_state[key] = entry
+    save_json_file(state_path, all_state)
+    return stats, stats["lines"] - before
+
+def percentile(samples, pct):
+    """计算分位数（最近邻法）"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+def print_log_summary(stats):
+    """打印日志分析摘要"""
+    print("=" * 60)
+    print("          服务日志摘要")
+    print("=" * 60)
+    print(f"已分析行数: {stats['lines']}")
+    print()
+    print("🧠 模型加载:")
+    print(f"   runner 启动次数: {stats['runner_starts']}")
+    if stats["load_count"]:
+        avg = stats["load_seconds"] / stats["load_count"]
+        print(f"   加载完成次数:   {stats['load_count']}")
+        print(f"   加载总耗时:     {stats['load_seconds']:.2f} 秒")
+        print(f"   平均/P95/最大:  {avg:.2f} / "
+              f"{percentile(stats['load_samples'], 95):.2f} / {stats['load_max']:.2f} 秒")
+    else:
+        print("   加载完成次数:   0")
+    print(f"   模型卸载/驱逐:  {stats['evictions']}")
+    print()
+    
+    print("⚠️  异常事件:")
+    print(f"   内存不足 (OOM): {stats['oom_events']}")
+    print(f"   上下文溢出:     {stats['context_overflows']}")
+    print(f"   ERROR 日志:     {stats['errors']}")
+    print()
+    
+    requests = stats["requests"]
+    if requests:
+        print("🌐 请求耗时:")
+        print(f"   {'接口':<24}{'次数':>6}{'错误':>6}{'平均':>9}{'P95':>9}{'最大':>9}")
+        for path, req in sorted(requests.items(), key=lambda item: -item[1]["seconds"]):
+            avg = req["seconds"] / req["count"] if req["count"] else 0.0
+            print(f"   {path[:23]:<24}{req['count']:>6}{req['errors']:>6}"
+                  f"{avg:>8.2f}s{percentile(req['samples'], 95):>8.2f}s{req['max']:>8.2f}s")
+        print()
+    
+    # 推理请求总耗时中，有多少花在模型加载上
+    inference_seconds = sum(req["seconds"] for path, req in requests.items()
+                            if path in INFERENCE_PATHS)
+    if inference_seconds > 0:
+        load_share = min(stats["load_seconds"], inference_seconds) / inference_seconds
+        print("⏱️  延迟构成 (推理接口):")
+        print(f"   请求总耗时:     {inference_seconds:.2f} 秒")
+        print(f"   模型加载占比:   {load_share * 100:.1f}%")
+        print(f"   生成/其他占比:  {(1 - load_share) * 100:.1f}%")
+        print()
+    
+    if stats["recent_events"]:
+        print("🕘 最近的异常事件:")
+        for kind, line in stats["recent_events"][-5:]:
+            print(f"   [{kind}] {line[:100]}")
+    print("=" * 60)
+
+@traced("menu.analyze_server_log")
+def analyze_server_log():
+    """服务日志分析"""
+    clear_screen()
+    print_header()
+    print("\n📈 服务日志分析\n")
+    
+    default_path = get_server_log_path()
+    print(f"默认日志路径: {default_path}")
+    log_path = input("请输入日志路径 (直接回车使用默认): ").strip() or default_path
+    
+    if not os.path.isfile(log_path):
+        print(f"\n❌ 找不到日志文件: {log_path}")
+        print("\n💡 提示:")
+        print("  • 通过本程序启动服务时，Linux 下会自动记录日志")
+        print("  • systemd 安装的服务可运行: journalctl -u ollama > server.log")
+        input("\n按回车键返回...")
+        return
+    
+    follow = input("是否持续跟踪日志? (y/N): ").strip().lower() in ['y', 'yes']
+    
+    try:
+        while True:
+            stats, new_lines = update_log_stats(log_path)
+            clear_screen()
+            print_header()
+            print(f"\n📈 服务日志分析: {log_path}")
+            print(f"本次新增 {new_lines} 行\n")
+            print_log_summary(stats)
+            if not follow:
+                break
+            print("\n持续跟踪中，按 Ctrl+C 停止...")
+            time.sleep(2)
+    except KeyboardInterrupt:
+        print("\n\n🛑 已停止跟踪")
+    except Exception as e:
+        print(f"\n❌ 日志分析失败: {str(e)}")
+    
+    input("\n按回车键返回...")
+
+# ------------ 批量生成向量 ------------
+EMBED_HEADER_SIZE = 128  # 固定长度的 .npy 头，便于随时原地更新行数
+EMBED_MAX_RETRIES = 3
+DEFAULT_EMBED_MODEL = "nomic-embed-text"
+
+def build_npy_header(rows, dim):
+    """生成固定长度的 .npy (v1.0) 文件头，数据类型为 float32"""
+    descr = '<f4' if sys.byteorder == 'little' else '>f4'
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }" % (descr, rows, dim)
+    header = header.ljust(EMBED_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode('latin1')
+
+def iter_text_records(path, offset=0, line_no=0):
+    """从指定偏移量开始流式读取文本记录
+    
+    .jsonl 文件每行需包含 "text" 字段（可选 "id"），其他文件每行一条记录，
+    以行号作为 ID。产出 (读取后的偏移量, 行号, 记录ID, 文本)。
+    """
+    is_jsonl = path.lower().endswith(('.jsonl', '.ndjson'))
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for raw in f:
+            offset += len(raw)
+            line_no += 1
+            line = raw.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            if is_jsonl:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                # 与无法解析的行一样跳过不是对象的行（如数组、字符串）
+                if not isinstance(record, dict):
+                    continue
+                text = record.get("text") or record.get("content") or ""
+                if not isinstance(text, str):
+                    continue
+                record_id = str(record.get("id", line_no))
+            else:
+                text, record_id = line, str(line_no)
+            if text:
+                yield offset, line_no, record_id, text
+
+def iter_record_batches(path, batch_size, offset=0, line_no=0):
+    """把记录按批次分组，产出 (批次结束偏移量, 批次结束行号, [(ID, 文本), ...])"""
+    batch = []
+    for offset, line_no, record_id, text in iter_text_records(path, offset, line_no):
+        batch.append((record_id, text))
+        if len(batch) >= batch_size:
+            yield offset, line_no, batch
+            batch = []
+    if batch:
+        yield offset, line_no, batch
+
+def _embed_batch_with_retry(model, texts):
+    """生成一个批次的向量（批量优先级），失败时指数退避重试"""
+    for attempt in range(EMBED_MAX_RETRIES):
         try:
-            print_menu()
-            choice = input("\n请输入选项 [0-9]: ").strip()
-            
+            with request_priority(PRIORITY_BATCH):
+                return embed_texts(model, texts)
+        except OllamaAPIError:
+            if attempt == EMBED_MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+def iter_embedded_batches(model, batches, concurrency, get_texts):
+    """并发生成各批次的向量，按输入顺序产出 (批次, 向量列表)
+    
+    最多保持 concurrency 个批次在途，内存占用与输入总量无关。
+    """
+    pending = deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                item = next(batches, None)
+                if item is None:
+                    exhausted = True
+                    break
+                future = executor.submit(_embed_batch_with_retry, model, get_texts(item))
+                pending.append((item, future))
+            if not pending:
+                return
+            
+            item, future = pending.popleft()
+            try:
+                vectors = future.result()
+            except BaseException:
+                for _, other in pending:
+                    other.cancel()
+                raise
+            yield item, vectors
+
+def run_embedding_job(input_path, output_prefix, model, batch_size=32,
+                      concurrency=4, progress=None):
+    """批量生成向量，支持断点续传
+    
+    向量写入 <前缀>.npy（float32，可用 numpy.load(mmap_mode='r') 打开），
+    记录 ID 按行写入 <前缀>.ids.tsv，进度写入 <前缀>.ckpt.json。
+    返回本次任务结束时的总行数。
+    """
+    vec_path = output_prefix + ".npy"
+    ids_path = output_prefix + ".ids.tsv"
+    ckpt_path = output_prefix + ".ckpt.json"
+    
+    ckpt = load_json_file(ckpt_path)
+    resume = (ckpt is not None and ckpt.get("model") == model
+              and ckpt.get("input") == os.path.abspath(input_path)
+              and os.path.exists(vec_path) and os.path.exists(ids_path))
+    if not resume:
+        ckpt = {
+            "model": model,
+            "input": os.path.abspath(input_path),
+            "input_offset": 0,
+            "line_no": 0,
+            "rows": 0,
+            "dim": 0,
+            "ids_offset": 0,
+            "done": False,
+        }
+    if ckpt["done"]:
+        return ckpt["rows"]
+    
+    vec_file = open(vec_path, 'r+b' if resume else 'w+b')
+    ids_file = open(ids_path, 'r+b' if resume else 'w+b')
+    try:
+        # 丢弃检查点之后写入的不完整数据
+        vec_file.truncate(EMBED_HEADER_SIZE + ckpt["rows"] * ckpt["dim"] * 4)
+        ids_file.truncate(ckpt["ids_offset"])
+        vec_file.seek(0)
+        vec_file.write(build_npy_header(ckpt["rows"], ckpt["dim"]))
+        vec_file.seek(0, os.SEEK_END)
+        ids_file.seek(0, os.SEEK_END)
+        
+        batches = iter_record_batches(input_path, batch_size,
+                                      ckpt["input_offset"], ckpt["line_no"])
+        for (end_offset, end_line, batch), vectors in iter_embedded_batches(
+                model, batches, concurrency, lambda item: [text for _, text in item[2]]):
+            dim = len(vectors[0])
+            if ckpt["dim"] == 0:
+                ckpt["dim"] = dim
+            for vector in vectors:
+                if len(vector) != ckpt["dim"]:
+                    raise OllamaAPIError(f"向量维度不一致: {len(vector)} != {ckpt['dim']}")
+                array('f', vector).tofile(vec_file)
+            ids_file.write("".join(
+                re.sub(r'[\t\r\n]', ' ', record_id) + "\n" for record_id, _ in batch
+            ).encode('utf-8'))
+            
+            ckpt["rows"] += len(batch)
+            ckpt["input_offset"] = end_offset
+            ckpt["line_no"] = end_line
+            ckpt["ids_offset"] = ids_file.tell()
+            
+            # 先更新文件头并落盘数据，再写检查点
+            vec_file.seek(0)
+            vec_file.write(build_npy_header(ckpt["rows"], ckpt["dim"]))
+            vec_file.seek(0, os.SEEK_END)
+            vec_file.flush()
+            ids_file.flush()
+            save_json_file(ckpt_path, ckpt)
+            
+            if progress:
+                progress(ckpt["rows"])
+        
+        ckpt["done"] = True
+        save_json_file(ckpt_path, ckpt)
+        return ckpt["rows"]
+    finally:
+        vec_file.close()
+        ids_file.close()
+
+@traced("menu.embedding_job_menu")
+def embedding_job_menu():
+    """批量生成向量"""
+    clear_screen()
+    print_header()
+    print("\n🧮 批量生成向量 (Embedding)\n")
+    
+    print("输入文件格式:")
+    print("  • .jsonl: 每行一个 JSON，包含 \"text\" 字段（可选 \"id\"）")
+    print("  • 其他文本文件: 每行一条记录，行号作为 ID")
+    print()
+    
+    input_path = input("请输入输入文件路径: ").strip()
+    if not os.path.isfile(input_path):
+        print("❌ 输入文件不存在")
+        input("\n按回车键返回...")
+        return
+    
+    model = input(f"请输入向量模型 (默认 {DEFAULT_EMBED_MODEL}): ").strip() or DEFAULT_EMBED_MODEL
+    default_prefix = os.path.splitext(input_path)[0] + ".emb"
+    output_prefix = input(f"输出文件前缀 (默认 {default_prefix}): ").strip() or default_prefix
+    
+    defaults = get_config()["concurrency"]
+    try:
+        batch_size = int(input(f"每批记录数 (默认 {defaults['embed_batch_size']}): ").strip()
+                         or defaults['embed_batch_size'])
+        concurrency = int(input(f"并发请求数 (默认 {defaults['embed_requests']}): ").strip()
+                          or defaults['embed_requests'])
+    except ValueError:
+        print("❌ 请输入数字")
+        input("\n按回车键返回...")
+        return
+    batch_size = max(1, batch_size)
+    concurrency = max(1, concurrency)
+    
+    ckpt = load_json_file(output_prefix + ".ckpt.json")
+    if ckpt and not ckpt.get("done"):
+        print(f"\n♻️  发现检查点，将从第 {ckpt.get('rows', 0)} 条继续")
+    
+    print("\n开始生成向量，按 Ctrl+C 可中断（下次运行自动续传）...\n")
+    started = time.monotonic()
+    start_rows = ckpt.get("rows", 0) if ckpt and not ckpt.get("done") else 0
+    
+    def show_progress(rows):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        rate = (rows - start_rows) / elapsed
+        print(f"  已完成 {rows} 条  ({rate:.1f} 条/秒)", end='\r')
+    
+    try:
+        rows = run_embedding_job(input_path, output_prefix, model,
+                                 batch_size, concurrency, show_progress)
+        print(f"\n\n🎉 完成! 共 {rows} 条向量")
+        print(f"   向量文件: {output_prefix}.npy")
+        print(f"   ID 索引:  {output_prefix}.ids.tsv")
+    except KeyboardInterrupt:
+        print("\n\n🛑 已中断，进度已保存，重新运行即可继续")
+    except OllamaAPIError as e:
+        print(f"\n\n❌ 请求失败: {str(e)}")
+        print("进度已保存，请检查服务和模型后重新运行")
+    except Exception as e:
+        print(f"\n\n❌ 生成向量出错: {str(e)}")
+    
+    input("\n按回车键返回...")
+
+# ------------ 本地知识库检索 ------------
+RAG_CHUNK_CHARS = 800
+RAG_CHUNK_OVERLAP = 100
+RAG_TOP_K = 4
+RAG_NPROBE = 8
+RAG_MAX_DELTA_ROWS = 50000   # 增量段超过此行数（或主段的 20%）时重建索引
+RAG_CHECKPOINT_FILES = 200   # 建索引时每处理这么多文件（或每 10 秒）保存一次进度
+RAG_CHECKPOINT_SECONDS = 10
+RAG_TEXT_EXTENSIONS = (
+    '.txt', '.md', '.markdown', '.rst', '.py', '.js', '.ts', '.java', '.go', '.rs',
+    '.c', '.h', '.cpp', '.hpp', '.cs', '.json', '.yaml', '.yml', '.toml', '.ini',
+    '.cfg', '.html', '.htm', '.csv', '.sh', '.sql', '.tex', '.log',
+)
+
+def get_rag_index_dir(folder):
+    """获取文件夹对应的索引目录"""
+    folder = os.path.abspath(folder)
+    name = re.sub(r'[^\w.-]+', '_', os.path.basename(folder.rstrip(os.sep)) or "root")
+    digest = hashlib.sha1(folder.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(get_manager_dir(), "rag", f"{name}-{digest}")
+
+def chunk_text(text, size=RAG_CHUNK_CHARS, overlap=RAG_CHUNK_OVERLAP):
+    """把文本切分为带重叠的片段，尽量在段落或句子边界断开"""
+    text = text.strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            window = text[start:end]
+            for sep in ("\n\n", "\n", "。", ". ", " "):
+                cut = window.rfind(sep)
+                if cut > size // 2:
+                    end = start + cut + len(sep)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+def iter_folder_files(folder):
+    """遍历文件夹中的文本文件（跳过隐藏目录），产出相对路径"""
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.lower().endswith(RAG_TEXT_EXTENSIONS):
+                full_path = os.path.join(root, name)
+                yield os.path.relpath(full_path, folder)
+
+def _normalize_rows(vectors):
+    """按行归一化，使点积等于余弦相似度"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def train_kmeans(sample, nlist, iterations=10, seed=0):
+    """在样本上用球面 k-means 训练聚类中心（基于余弦相似度）"""
+    rng = np.random.default_rng(seed)
+    sample = np.ascontiguousarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = assign_clusters(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        # 空簇用随机样本重新初始化
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = _normalize_rows(sums).astype(np.float32)
+    return centroids
+
+def assign_clusters(vectors, centroids, block=16384):
+    """分块计算每个向量最近的聚类中心"""
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block):
+        part = np.asarray(vectors[start:start + block], dtype=np.float32)
+        assign[start:start + block] = np.argmax(part @ centroids.T, axis=1)
+    return assign
+
+class RagIndex:
+    """文件夹的向量索引
+    
+    向量分为两段：按聚类排序的主段（IVF 倒排，查询时只扫描最近的 nprobe 个簇）
+    和新增文件写入的增量段（暴力扫描）。增量段过大或删除过多时重建主段并压缩 chunks.jsonl。
+    所有向量文件都以内存映射方式打开。
+    
+    同一文件的片段行号连续，meta.json 中只记录行号区间 [起始, 行数]：每个文件一个，
+    增量段为 [delta_start, rows)，已删除的行也是区间列表，meta.json 的大小与行数无关。
+    """
+    
+    def __init__(self, folder, model=DEFAULT_EMBED_MODEL):
+        self.folder = os.path.abspath(folder)
+        self.index_dir = get_rag_index_dir(folder)
+        self.meta_path = os.path.join(self.index_dir, "meta.json")
+        self.meta = load_json_file(self.meta_path) or {
+            "folder": self.folder,
+            "model": model,
+            "dim": 0,
+            "rows": 0,          # chunks.jsonl 中的总行数（含已删除）
+            "main_rows": 0,
+            "nlist": 0,
+            "delta_start": 0,   # 增量段的第一行
+            "deleted": [],      # 已删除的行号区间 [[起始, 行数], ...]
+            "files": {},        # 相对路径 -> {"stat": [修改时间, 大小], "rows": [起始, 行数]}
+        }
+        if "delta_ids" in self.meta:
+            # 旧格式逐行记录行号，转换为区间
+            delta_ids = self.meta.pop("delta_ids")
+            self.meta["delta_start"] = delta_ids[0] if delta_ids else self.meta["rows"]
+            for entry in self.meta["files"].values():
+                rows = entry["rows"]
+                entry["rows"] = [rows[0], len(rows)] if rows else [self.meta["rows"], 0]
+            self.meta["deleted"] = [[row, 1] for row in self.meta["deleted"]]
+        self._deleted = self.meta["deleted"]
+        self._main = self._main_ids = self._centroids = self._offsets = None
+        self._delta = None
+        self._chunk_offsets = None
+    
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+    
+    @property
+    def delta_rows(self):
+        return self.meta["rows"] - self.meta["delta_start"]
+    
+    @property
+    def deleted_rows(self):
+        return sum(count for _, count in self._deleted)
+    
+    @property
+    def live_rows(self):
+        return self.meta["main_rows"] + self.delta_rows - self.deleted_rows
+    
+    def _deleted_ids(self):
+        """展开已删除的行号区间"""
+        ranges = [np.arange(start, start + count, dtype=np.int64) for start, count in self._deleted]
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+    
+    def save(self):
+        self.meta["deleted"] = self._deleted
+        save_json_file(self.meta_path, self.meta)
+    
+    def check_offsets(self):
+        """顺序读一遍 chunks.jsonl，返回 chunks.off 中与实际行位置不一致的行数"""
+        rows = self.meta["rows"]
+        if not rows:
+            return 0
+        offsets = np.fromfile(self._path("chunks.off"), dtype='<u8', count=rows)
+        if len(offsets) < rows:
+            return rows - len(offsets)
+        bad = 0
+        position = 0
+        with open(self._path("chunks.jsonl"), 'rb') as f:
+            for row in range(rows):
+                if offsets[row] != position:
+                    bad += 1
+                position += len(f.readline())
+        return bad
+    
+    def _reset(self):
+        """丢弃全部片段和向量，下次更新时重新嵌入所有文件"""
+        self._close()
+        for name in ("main.npy", "main_ids.npy", "centroids.npy", "offsets.npy", "delta.npy",
+                     "chunks.jsonl", "chunks.off"):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        self._deleted = []
+        self.meta.update(rows=0, main_rows=0, nlist=0, delta_start=0, files={})
+    
+    # ---- 建立/更新索引 ----
+    def update(self, batch_size=None, concurrency=None, progress=None):
+        """按修改时间增量更新索引，返回 (新增文件数, 更新文件数, 删除文件数)"""
+        batch_size = batch_size or get_config()["concurrency"]["embed_batch_size"]
+        concurrency = concurrency or get_config()["concurrency"]["embed_requests"]
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._close()
+        chunks_path = self._path("chunks.jsonl")
+        if (self.meta["rows"] and os.path.exists(chunks_path)
+                and os.path.getsize(chunks_path) != self._chunk_file_size()):
+            # 上次建索引被中断：续建前核对已提交片段的偏移量，不一致时重建整个索引
+            if self.check_offsets():
+                self._reset()
+        files = self.meta["files"]
+        current = {}
+        for rel_path in iter_folder_files(self.folder):
+            try:
+                st = os.stat(os.path.join(self.folder, rel_path))
+            except OSError:
+                continue
+            current[rel_path] = [st.st_mtime_ns, st.st_size]
+        
+        removed = [p for p in files if p not in current]
+        changed = [p for p in current if p in files and files[p]["stat"] != current[p]]
+        added = [p for p in current if p not in files]
+        
+        for rel_path in removed + changed:
+            start, count = files.pop(rel_path)["rows"]
+            if count:
+                self._deleted.append([start, count])
+        
+        self._append_files(changed + added, current, batch_size, concurrency, progress)
+        
+        if (self.delta_rows > min(RAG_MAX_DELTA_ROWS, max(1000, self.meta["main_rows"] // 5))
+                or self.deleted_rows > max(1000, self.meta["rows"] // 5)):
+            self.rebuild()
+        self.save()
+        return len(added), len(changed), len(removed)
+    
+    def _append_files(self, rel_paths, current, batch_size, concurrency, progress):
+        """切分并嵌入文件，追加到 chunks.jsonl 和增量段"""
+        chunks_path = self._path("chunks.jsonl")
+        offsets_path = self._path("chunks.off")
+        delta_path = self._path("delta.npy")
+        
+        def open_rw(path):
+            return open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        
+        # 不用追加模式：截断后追加模式的 tell() 仍返回截断前的位置，记录的偏移量会错位
+        with open_rw(chunks_path) as chunks_file, open_rw(offsets_path) as offsets_file, \
+                open_rw(delta_path) as delta_file:
+            # 丢弃上次异常退出时写入的不完整数据
+            chunks_file.truncate(self._chunk_file_size())
+            offsets_file.truncate(self.meta["rows"] * 8)
+            delta_file.truncate(EMBED_HEADER_SIZE + self.delta_rows * self.meta["dim"] * 4)
+            for handle in (chunks_file, offsets_file, delta_file):
+                handle.seek(0, os.SEEK_END)
+            
+            def checkpoint():
+                delta_file.seek(0)
+                delta_file.write(build_npy_header(self.delta_rows, self.meta["dim"]))
+                delta_file.seek(0, os.SEEK_END)
+                for handle in (chunks_file, offsets_file, delta_file):
+                    handle.flush()
+                self.save()
+            
+            # 每隔一批文件或一段时间提交一次，中断后已提交的文件无需重做
+            last_checkpoint = time.monotonic()
+            unsaved = 0
+            start = self.meta["rows"]
+            try:
+                for done, rel_path in enumerate(rel_paths, 1):
+                    try:
+                        with open(os.path.join(self.folder, rel_path), 'r',
+                                  encoding='utf-8', errors='replace') as f:
+                            chunks = chunk_text(f.read())
+                    except OSError:
+                        continue
+                    
+                    batches = (chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size))
+                    start = self.meta["rows"]
+                    for batch, vectors in iter_embedded_batches(
+                            self.meta["model"], batches, concurrency, lambda item: item):
+                        if not self.meta["dim"]:
+                            self.meta["dim"] = len(vectors[0])
+                        vectors = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+                        if vectors.shape[1] != self.meta["dim"]:
+                            raise OllamaAPIError(f"向量维度不一致: {vectors.shape[1]} != {self.meta['dim']}")
+                        delta_file.write(vectors.tobytes())
+                        for text in batch:
+                            offsets_file.write(struct.pack("<Q", chunks_file.tell()))
+                            chunks_file.write((json.dumps({"file": rel_path, "text": text},
+                                                          ensure_ascii=False) + "\n").encode('utf-8'))
+                            self.meta["rows"] += 1
+                    
+                    self.meta["files"][rel_path] = {"stat": current[rel_path],
+                                                    "rows": [start, self.meta["rows"] - start]}
+                    start = self.meta["rows"]
+                    unsaved += 1
+                    if (unsaved >= RAG_CHECKPOINT_FILES
+                            or time.monotonic() - last_checkpoint >= RAG_CHECKPOINT_SECONDS):
+                        checkpoint()
+                        last_checkpoint = time.monotonic()
+                        unsaved = 0
+                    if progress:
+                        progress(done, len(rel_paths), rel_path)
+            finally:
+                # 出错或中断时只提交已完成的文件，当前文件写了一半的行下次打开时截掉
+                self.meta["rows"] = start
+                checkpoint()
+    
+    def _chunk_file_size(self):
+        """根据已提交的行数计算 chunks.jsonl 的有效长度"""
+        rows = self.meta["rows"]
+        if rows == 0:
+            return 0
+        with open(self._path("chunks.off"), 'rb') as f:
+            f.seek((rows - 1) * 8)
+            last_offset = struct.unpack("<Q", f.read(8))[0]
+        with open(self._path("chunks.jsonl"), 'rb') as f:
+            f.seek(last_offset)
+            return last_offset + len(f.readline())
+    
+    def rebuild(self, block=65536):
+        """合并主段和增量段，去掉已删除的行，重新训练聚类并按簇排序写入主段
+        
+        向量始终通过内存映射分块读写，内存占用只与行数（而非向量总大小）成正比。
+        chunks.jsonl 同时压缩为只含有效行，行号重新从 0 连续编号。
+        """
+        self._open()
+        segments = []
+        if self._main is not None:
+            segments.append((self._main, self._main_ids))
+        if self._delta is not None and len(self._delta):
+            segments.append((self._delta, np.arange(self.meta["delta_start"], self.meta["rows"],
+                                                    dtype=np.int64)))
+        deleted = self._deleted_ids()
+        # 每个有效行记为 (段号, 段内行号)
+        seg_index, row_index = [], []
+        for i, (_, ids) in enumerate(segments):
+            rows = np.nonzero(~np.isin(ids, deleted))[0]
+            seg_index.append(np.full(len(rows), i, dtype=np.int8))
+            row_index.append(rows)
+        total = sum(len(rows) for rows in row_index)
+        
+        if total == 0:
+            self._close()
+            for name in ("main.npy", "main_ids.npy", "centroids.npy", "offsets.npy", "delta.npy"):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            self._compact_chunks(np.empty(0, dtype=np.int64))
+            self.meta.update(main_rows=0, nlist=0)
+            return
+        seg_index = np.concatenate(seg_index)
+        row_index = np.concatenate(row_index)
+        
+        def gather(positions):
+            out = np.empty((len(positions), self.meta["dim"]), dtype=np.float32)
+            for i, (vectors, _) in enumerate(segments):
+                mask = seg_index[positions] == i
+                if mask.any():
+                    rows = row_index[positions[mask]]
+                    out[mask] = vectors[rows]
+            return out
+        
+        def gather_ids(positions):
+            out = np.empty(len(positions), dtype=np.int64)
+            for i, (_, ids) in enumerate(segments):
+                mask = seg_index[positions] == i
+                out[mask] = ids[row_index[positions[mask]]]
+            return out
+        
+        # 在样本上训练，再分块给所有行分配簇
+        nlist = max(1, int(math.sqrt(total)))
+        rng = np.random.default_rng(0)
+        sample_size = min(total, max(nlist * 32, 1000))
+        sample = gather(np.sort(rng.choice(total, sample_size, replace=False)))
+        centroids = train_kmeans(sample, nlist)
+        assign = np.empty(total, dtype=np.int64)
+        for start in range(0, total, block):
+            positions = np.arange(start, min(total, start + block))
+            assign[start:start + block] = assign_clusters(gather(positions), centroids)
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        
+        main_tmp = self._path("main.npy.tmp")
+        out = np.lib.format.open_memmap(main_tmp, mode='w+', dtype=np.float32,
+                                        shape=(total, self.meta["dim"]))
+        for start in range(0, total, block):
+            out[start:start + block] = gather(order[start:start + block])
+        out.flush()
+        del out
+        main_ids = gather_ids(order)
+        # 有效行按原行号排序后的位置即压缩后的新行号
+        live_ids = np.sort(main_ids)
+        main_ids = np.searchsorted(live_ids, main_ids)
+        
+        self._close()
+        segments = None
+        os.replace(main_tmp, self._path("main.npy"))
+        for name, data in (("main_ids.npy", main_ids), ("centroids.npy", centroids),
+                           ("offsets.npy", offsets.astype(np.int64))):
+            np.save(self._path(name + ".tmp"), data)
+            os.replace(self._path(name + ".tmp.npy"), self._path(name))
+        if os.path.exists(self._path("delta.npy")):
+            os.remove(self._path("delta.npy"))
+        self._compact_chunks(live_ids)
+        self.meta.update(main_rows=total, nlist=nlist)
+    
+    def _compact_chunks(self, live_ids):
+        """只保留 live_ids（已排序的原行号）对应的片段，并把文件的行号区间改为新编号"""
+        live = np.zeros(self.meta["rows"], dtype=bool)
+        live[live_ids] = True
+        chunks_tmp, offsets_tmp = self._path("chunks.jsonl.tmp"), self._path("chunks.off.tmp")
+        with open(self._path("chunks.jsonl"), 'rb') as src, \
+                open(chunks_tmp, 'wb') as chunks_file, open(offsets_tmp, 'wb') as offsets_file:
+            for row in range(self.meta["rows"]):
+                line = src.readline()
+                if live[row]:
+                    offsets_file.write(struct.pack("<Q", chunks_file.tell()))
+                    chunks_file.write(line)
+        os.replace(chunks_tmp, self._path("chunks.jsonl"))
+        os.replace(offsets_tmp, self._path("chunks.off"))
+        for entry in self.meta["files"].values():
+            entry["rows"][0] = int(np.searchsorted(live_ids, entry["rows"][0]))
+        # 已删除的行不再出现在任何文件中，增量段从新的末尾开始
+        self._deleted = []
+        self.meta.update(rows=len(live_ids), delta_start=len(live_ids))
+    
+    # ---- 查询 ----
+    def _open(self):
+        """以内存映射方式打开各向量文件"""
+        if self._main is None and self.meta["main_rows"]:
+            self._main = np.load(self._path("main.npy"), mmap_mode='r')
+            self._main_ids = np.load(self._path("main_ids.npy"))
+            self._centroids = np.load(self._path("centroids.npy"))
+            self._offsets = np.load(self._path("offsets.npy"))
+        if self._delta is None and self.delta_rows:
+            self._delta = np.load(self._path("delta.npy"), mmap_mode='r')
+        if self._chunk_offsets is None and self.meta["rows"]:
+            self._chunk_offsets = np.memmap(self._path("chunks.off"), dtype='<u8', mode='r',
+                                            shape=(self.meta["rows"],))
+    
+    def _close(self):
+        self._main = self._main_ids = self._centroids = self._offsets = None
+        self._delta = None
+        self._chunk_offsets = None
+    
+    def search(self, query_vector, top_k=RAG_TOP_K, nprobe=RAG_NPROBE):
+        """返回最相似的片段列表 [(相似度, 文件, 文本), ...]"""
+        self._open()
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= (np.linalg.norm(query) or 1.0)
+        
+        scores, ids = [], []
+        if self._main is not None:
+            probe = np.argsort(self._centroids @ query)[::-1][:nprobe]
+            for cluster in probe:
+                start, end = self._offsets[cluster], self._offsets[cluster + 1]
+                if end > start:
+                    scores.append(self._main[start:end] @ query)
+                    ids.append(self._main_ids[start:end])
+        if self._delta is not None:
+            scores.append(self._delta @ query)
+            ids.append(np.arange(self.meta["delta_start"], self.meta["rows"], dtype=np.int64))
+        if not scores:
+            return []
+        
+        scores = np.concatenate(scores)
+        ids = np.concatenate(ids)
+        if self._deleted:
+            live = ~np.isin(ids, self._deleted_ids())
+            scores, ids = scores[live], ids[live]
+        
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k] if k else []
+        best = sorted(best, key=lambda i: -scores[i])
+        results = []
+        with open(self._path("chunks.jsonl"), 'rb') as f:
+            for i in best:
+                f.seek(int(self._chunk_offsets[ids[i]]))
+                try:
+                    record = json.loads(f.readline())
+                except ValueError as e:
+                    raise OllamaAPIError(f"索引片段损坏，请删除 {self.index_dir} 后重新建立索引") from e
+                results.append((float(scores[i]), record["file"], record["text"]))
+        return results
+    
+    def retrieve(self, question, top_k=RAG_TOP_K):
+        """嵌入问题并检索相关片段"""
+        query_vector = embed_texts(self.meta["model"], [question])[0]
+        return self.search(query_vector, top_k)
+
+def build_rag_messages(history, question, results):
+    """把检索到的片段注入到本轮用户消息之前"""
+    context = "\n\n".join(f"[{i}] 来源: {file}\n{text}"
+                          for i, (_, file, text) in enumerate(results, 1))
+    system = ("请优先根据以下资料回答用户问题，并注明引用的来源编号。"
+              "如果资料中没有相关内容，请直接说明。\n\n" + context)
+    return history + [{"role": "system", "content": system},
+                      {"role": "user", "content": question}]
+
+def rag_chat(model_name, index):
+    """基于本地知识库的对话（通过 /api/chat 流式输出）"""
+    history = []
+    while True:
+        try:
+            question = input("\n>>> ").strip()
+        except EOFError:
+            break
+        if not question:
+            continue
+        if question in ('/bye', '/exit'):
+            break
+        
+        try:
+            started = time.perf_counter()
+            results = index.retrieve(question)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            sources = ", ".join(sorted({file for _, file, _ in results})) or "无"
+            print(f"📚 检索 {len(results)} 个片段 ({elapsed_ms:.0f} ms): {sources}\n")
+            
+            answer = []
+            payload = {"model": model_name,
+                       "messages": build_rag_messages(history, question, results)}
+            with TokenRenderer() as renderer:
+                for message in ollama_api_stream("/api/chat", payload):
+                    token = message.get("message", {}).get("content", "")
+                    if token:
+                        answer.append(token)
+                        renderer.write(token)
+            print()
+            # 历史中只保留问答本身，资料只注入当前轮
+            history += [{"role": "user", "content": question},
+                        {"role": "assistant", "content": "".join(answer)}]
+        except KeyboardInterrupt:
+            print("\n🛑 已中断本轮回答")
+        except OllamaAPIError as e:
+            print(f"\n❌ 请求失败: {str(e)}")
+
+def update_rag_index(folder, model):
+    """更新文件夹索引并打印进度，返回索引对象"""
+    index = RagIndex(folder, model)
+    if index.meta["model"] != model and index.meta["rows"]:
+        print(f"⚠️  索引已使用模型 {index.meta['model']} 建立，将继续使用该模型")
+    
+    def show_progress(done, total, rel_path):
+        print(f"  [{done}/{total}] {rel_path[:60]}")
+    
+    started = time.monotonic()
+    added, changed, removed = index.update(progress=show_progress)
+    print(f"\n✅ 索引已更新 ({time.monotonic() - started:.1f} 秒)")
+    print(f"   新增 {added} 个文件，更新 {changed} 个，删除 {removed} 个")
+    print(f"   有效片段 {index.live_rows} 个，聚类数 {index.meta['nlist']}，"
+          f"增量段 {index.delta_rows} 个")
+    return index
+
+@traced("menu.rag_index_menu")
+def rag_index_menu():
+    """本地知识库：建立/更新索引并测试检索"""
+    clear_screen()
+    print_header()
+    print("\n📚 本地知识库\n")
+    
+    if not HAS_NUMPY:
+        print("❌ 此功能需要 numpy")
+        print("请运行: pip install numpy")
+        input("\n按回车键返回...")
+        return
+    
+    folder = input("请输入文档文件夹路径: ").strip()
+    if not os.path.isdir(folder):
+        print("❌ 文件夹不存在")
+        input("\n按回车键返回...")
+        return
+    model = input(f"请输入向量模型 (默认 {DEFAULT_EMBED_MODEL}): ").strip() or DEFAULT_EMBED_MODEL
+    
+    try:
+        print("\n正在扫描并更新索引...\n")
+        index = update_rag_index(folder, model)
+        
+        while True:
+            query = input("\n输入测试问题 (直接回车返回): ").strip()
+            if not query:
+                break
+            started = time.perf_counter()
+            query_vector = embed_texts(index.meta["model"], [query])[0]
+            embedded = time.perf_counter()
+            results = index.search(query_vector)
+            searched = time.perf_counter()
+            print(f"\n嵌入 {(embedded - started) * 1000:.0f} ms，"
+                  f"检索 {(searched - embedded) * 1000:.1f} ms")
+            for score, file, text in results:
+                preview = text[:80].replace('\n', ' ')
+                print(f"  {score:.3f}  {file}: {preview}")
+    except KeyboardInterrupt:
+        print("\n\n🛑 已中断，已完成的文件不会重复处理")
+        input("\n按回车键返回...")
+    except OllamaAPIError as e:
+        print(f"\n❌ 请求失败: {str(e)}")
+        input("\n按回车键返回...")
+    except Exception as e:
+        print(f"\n❌ 索引出错: {str(e)}")
+        input("\n按回车键返回...")
+
+# ------------ 多模型对比 ------------
+COMPARE_MEMORY_HEADROOM = 1.2   # 模型加载所需内存约为文件大小的 1.2 倍
+COMPARE_MAX_OUTPUT_LINES = 15
+
+def get_memory_info():
+    """获取系统内存 (总量, 可用量)，单位字节；无法获取时返回 (None, None)"""
+    if HAS_PSUTIL:
+        try:
+            import psutil
+            mem = psutil.virtual_memory()
+            return mem.total, mem.available
+        except Exception:
+            pass
+    try:
+        values = {}
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                values[key] = int(rest.split()[0]) * 1024
+        return values.get("MemTotal"), values.get("MemAvailable", values.get("MemFree"))
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+def format_bytes(num):
+    """把字节数格式化为易读的字符串"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num) < 1024:
+            return f"{num:.1f} {unit}" if unit != "B" else f"{num} B"
+        num /= 1024.0
+    return f"{num:.1f} TB"
+
+def display_width(text):
+    """计算字符串在终端中的显示宽度（中文等宽字符占两列）"""
+    return sum(2 if unicodedata.east_asian_width(ch) in ('W', 'F') else 1 for ch in text)
+
+def wrap_display(text, width):
+    """按显示宽度折行，英文尽量在空格处断开"""
+    lines = []
+    for paragraph in text.splitlines() or [""]:
+        line = ""
+        for ch in paragraph:
+            if display_width(line + ch) > width:
+                cut = line.rfind(" ")
+                if cut > 0:
+                    lines.append(line[:cut])
+                    line = line[cut + 1:]
+                else:
+                    lines.append(line)
+                    line = ""
+            line += ch
+        lines.append(line)
+    return lines
+
+def pad_display(text, width):
+    """按显示宽度右侧补空格"""
+    return text + " " * max(0, width - display_width(text))
+
+def get_installed_models():
+    """通过 API 获取已安装模型 {名称: 大小}"""
+    result = ollama_api("/api/tags", timeout=10)
+    return {m["name"]: m.get("size", 0) for m in result.get("models", [])}
+
+def run_model_prompts(model, prompts, unload_after=False):
+    """让一个模型依次回答所有提示词，返回结果列表"""
+    results = []
+    for i, prompt in enumerate(prompts):
+        # 顺序模式下最后一个请求结束后立即卸载模型，为下一个模型腾出内存
+        keep_alive = 0 if unload_after and i == len(prompts) - 1 else None
+        try:
+            response = generate_text(model, prompt, keep_alive=keep_alive)
+            results.append({
+                "output": response.get("response", ""),
+                "latency": response["wall_seconds"],
+                "load": response.get("load_duration", 0) / 1e9,
+                "tokens": response.get("eval_count", 0),
+                "tps": tokens_per_second(response.get("eval_count"), response.get("eval_duration")),
+                "error": None,
+            })
+        except OllamaAPIError as e:
+            results.append({"output": "", "latency": 0.0, "load": 0.0, "tokens": 0,
+                            "tps": 0.0, "error": str(e)})
+    return results
+
+def compare_models(models, prompts, concurrent_mode=True, sizes=None):
+    """对比多个模型，返回 {模型: 结果列表}；顺序模式下跳过内存放不下的模型"""
+    results = {}
+    if concurrent_mode:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(models)) as executor:
+            futures = {model: executor.submit(run_model_prompts, model, prompts)
+                       for model in models}
+            for model, future in futures.items():
+                results[model] = future.result()
+        return results
+    
+    for model in models:
+        _, available = get_memory_info()
+        needed = (sizes or {}).get(model, 0) * COMPARE_MEMORY_HEADROOM
+        if available and needed > available:
+            print(f"  ⚠️  跳过 {model}: 需要约 {format_bytes(needed)}，"
+                  f"可用内存 {format_bytes(available)}")
+            continue
+        print(f"  正在运行 {model}...")
+        results[model] = run_model_prompts(model, prompts, unload_after=True)
+    return results
+
+def print_side_by_side(models, outputs):
+    """并排显示多个模型的输出"""
+    columns = max(40, shutil.get_terminal_size((120, 24)).columns)
+    col_width = max(10, (columns - 3 * (len(models) - 1)) // len(models))
+    wrapped = []
+    for output in outputs:
+        lines = wrap_display(output, col_width)
+        if len(lines) > COMPARE_MAX_OUTPUT_LINES:
+            lines = lines[:COMPARE_MAX_OUTPUT_LINES - 1] + ["..."]
+        wrapped.append(lines)
+    
+    print(" | ".join(pad_display(model[:col_width], col_width) for model in models))
+    print("-+-".join("-" * col_width for _ in models))
+    for row in range(max(len(lines) for lines in wrapped)):
+        print(" | ".join(pad_display(lines[row] if row < len(lines) else "", col_width)
+                         for lines in wrapped))
+
+def print_compare_table(results):
+    """打印各模型的汇总指标"""
+    print(f"{'模型':<24}{'平均延迟':>10}{'加载':>9}{'tokens/秒':>11}{'输出字数':>10}{'错误':>6}")
+    print("-" * 70)
+    rows = []
+    for model, items in results.items():
+        ok = [item for item in items if not item["error"]]
+        errors = len(items) - len(ok)
+        if ok:
+            latency = sum(item["latency"] for item in ok) / len(ok)
+            load = sum(item["load"] for item in ok) / len(ok)
+            tps = sum(item["tps"] for item in ok) / len(ok)
+            chars = sum(len(item["output"]) for item in ok) / len(ok)
+        else:
+            latency = load = tps = chars = 0.0
+        rows.append((model, latency, load, tps, chars, errors))
+    
+    for model, latency, load, tps, chars, errors in sorted(rows, key=lambda row: -row[3]):
+        print(f"{model[:23]:<24}{latency:>9.2f}s{load:>8.2f}s{tps:>11.1f}{chars:>10.0f}{errors:>6}")
+
+@traced("menu.compare_models_menu")
+def compare_models_menu():
+    """多模型对比"""
+    clear_screen()
+    print_header()
+    print("\n⚖️  多模型对比\n")
+    
+    try:
+        installed = get_installed_models()
+    except OllamaAPIError as e:
+        print(f"❌ 无法获取模型列表: {str(e)}")
+        print("请确认 Ollama 服务正在运行")
+        input("\n按回车键返回...")
+        return
+    
+    presets = [name for name, _ in RECOMMENDED_MODELS if name in installed
+               or name + ":latest" in installed]
+    print("已安装模型:")
+    for name, size in sorted(installed.items()):
+        print(f"  • {name:<30} {format_bytes(size)}")
+    print()
+    
+    default_models = ",".join(presets)
+    prompt_text = f"请输入要对比的模型，用逗号分隔 (默认 {default_models}): " if presets \
+        else "请输入要对比的模型，用逗号分隔: "
+    models = [m.strip() for m in (input(prompt_text).strip() or default_models).split(",")
+              if m.strip()]
+    if len(models) < 2:
+        print("❌ 至少需要两个模型")
+        input("\n按回车键返回...")
+        return
+    
+    prompt_input = input("请输入提示词，或提示词文件路径 (每行一个): ").strip()
+    if not prompt_input:
+        print("❌ 提示词不能为空")
+        input("\n按回车键返回...")
+        return
+    if os.path.isfile(prompt_input):
+        with open(prompt_input, 'r', encoding='utf-8') as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    else:
+        prompts = [prompt_input]
+    
+    print("\n运行方式:")
+    print("  1. 并发运行（所有模型同时加载，速度快）")
+    print("  2. 顺序运行（逐个加载并卸载，内存占用低）")
+    concurrent_mode = input("请选择 [1-2] (默认 1): ").strip() != "2"
+    
+    sizes = {model: installed.get(model, installed.get(model + ":latest", 0)) for model in models}
+    if concurrent_mode:
+        _, available = get_memory_info()
+        needed = sum(sizes.values()) * COMPARE_MEMORY_HEADROOM
+        if available and needed > available:
+            print(f"\n⚠️  并发运行约需 {format_bytes(needed)} 内存，"
+                  f"当前可用 {format_bytes(available)}，将改为顺序运行")
+            concurrent_mode = False
+    
+    print(f"\n正在对比 {len(models)} 个模型，{len(prompts)} 个提示词...\n")
+    try:
+        started = time.monotonic()
+        results = compare_models(models, prompts, concurrent_mode, sizes)
+        elapsed = time.monotonic() - started
+    except KeyboardInterrupt:
+        print("\n\n🛑 对比已取消")
+        input("\n按回车键返回...")
+        return
+    
+    if not results:
+        print("❌ 没有可运行的模型")
+        input("\n按回车键返回...")
+        return
+    
+    ran_models = list(results)
+    for i, prompt in enumerate(prompts):
+        print("\n" + "=" * 60)
+        print(f"提示词 {i + 1}: {prompt[:100]}")
+        print("=" * 60)
+        print_side_by_side(ran_models, [
+            results[model][i]["output"] or f"❌ {results[model][i]['error'] or '无输出'}"
+            for model in ran_models
+        ])
+    
+    print("\n" + "=" * 60)
+    print(f"📊 汇总 (总耗时 {elapsed:.1f} 秒)")
+    print("=" * 60)
+    print_compare_table(results)
+    print()
+    record_compare_results(results, prompts)
+    
+    input("\n按回车键返回...")
+
+# ------------ 耗时追踪报告 ------------
+TRACE_HISTOGRAM_BUCKETS = [
+    (0.001, "<1ms"), (0.01, "1-10ms"), (0.1, "10-100ms"),
+    (1.0, "0.1-1s"), (10.0, "1-10s"), (float("inf"), ">10s"),
+]
+
+def format_seconds(seconds):
+    """把秒数格式化为合适的单位"""
+    if seconds < 1:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds:.2f}s"
+
+def trace_snapshot():
+    """复制当前的追踪数据，避免打印时被其他线程修改"""
+    with _TRACE_LOCK:
+        spans = list(TRACE_SPANS)
+        stats = {name: dict(item, samples=list(item["samples"]))
+                 for name, item in TRACE_STATS.items()}
+        tree = {path: list(node) for path, node in TRACE_TREE.items()}
+    return spans, stats, tree
+
+def print_trace_report(top=10):
+    """打印最慢操作、各操作统计、调用树和耗时分布"""
+    spans, stats, tree = trace_snapshot()
+    if not spans:
+        print("暂无追踪数据，请先使用其他功能后再查看")
+        return
+    
+    print("🐢 最慢的操作:")
+    for path, _, started, duration, error in sorted(spans, key=lambda s: -s[3])[:top]:
+        when = datetime.fromtimestamp(started).strftime('%H:%M:%S')
+        print(f"   {format_seconds(duration):>9}  {when}  {'❌ ' if error else ''}{path[-70:]}")
+    
+    print("\n📊 各操作统计 (菜单操作包含等待用户输入的时间):")
+    print(f"   {'操作':<34}{'次数':>6}{'总计':>10}{'平均':>10}{'P50':>10}{'P95':>10}{'最大':>10}")
+    for name, item in sorted(stats.items(), key=lambda kv: -kv[1]["total"]):
+        avg = item["total"] / item["count"]
+        print(f"   {name[:33]:<34}{item['count']:>6}{format_seconds(item['total']):>10}"
+              f"{format_seconds(avg):>10}{format_seconds(percentile(item['samples'], 50)):>10}"
+              f"{format_seconds(percentile(item['samples'], 95)):>10}"
+              f"{format_seconds(item['max']):>10}")
+    
+    print("\n🌳 调用树 (次数 / 总耗时):")
+    for path in sorted(tree):
+        count, total = tree[path]
+        depth = path.count(" > ")
+        name = path.rsplit(" > ", 1)[-1]
+        print(f"   {'  ' * depth}{name[:50]}  ×{count}  {format_seconds(total)}")
+    
+    print("\n📈 耗时分布 (按总耗时排序的前几个操作):")
+    for name, item in sorted(stats.items(), key=lambda kv: -kv[1]["total"])[:5]:
+        print(f"   {name}")
+        counts = [0] * len(TRACE_HISTOGRAM_BUCKETS)
+        for sample in item["samples"]:
+            for i, (limit, _) in enumerate(TRACE_HISTOGRAM_BUCKETS):
+                if sample < limit:
+                    counts[i] += 1
+                    break
+        peak = max(counts) or 1
+        for (_, label), count in zip(TRACE_HISTOGRAM_BUCKETS, counts):
+            if count:
+                print(f"     {label:>9} {'█' * max(1, count * 30 // peak)} {count}")
+
+def export_trace(path):
+    """把追踪数据导出为 JSON 文件"""
+    spans, stats, tree = trace_snapshot()
+    save_json_file(path, {
+        "exported_at": datetime.now().isoformat(timespec='seconds'),
+        "spans": [{"path": p, "name": n, "start": s, "duration": d, "error": e}
+                  for p, n, s, d, e in spans],
+        "stats": {name: {k: v for k, v in item.items() if k != "samples"}
+                  for name, item in stats.items()},
+        "tree": tree,
+    })
+
+def trace_report_menu():
+    """耗时追踪报告"""
+    clear_screen()
+    print_header()
+    print("\n⏱️  耗时追踪报告 (本次运行)\n")
+    print_trace_report()
+    
+    print()
+    choice = input("输入 e 导出为 JSON，直接回车返回: ").strip().lower()
+    if choice == "e":
+        path = os.path.join(get_manager_dir(),
+                            f"trace-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        try:
+            export_trace(path)
+            print(f"✅ 已导出: {path}")
+        except OSError as e:
+            print(f"❌ 导出失败: {str(e)}")
+        input("\n按回车键返回...")
+
+# ------------ Prometheus 指标导出 ------------
+DEFAULT_METRICS_PORT = 9877
+STORE_USAGE_CACHE_SECONDS = 60
+
+_store_usage_cache = {"time": 0.0, "path": None, "bytes": 0, "blobs": 0}
+_metrics_server = None
+
+def get_models_dir():
+    """获取模型存储目录（OLLAMA_MODELS、配置文件或默认位置）"""
+    env_dir = os.environ.get("OLLAMA_MODELS", "").strip() or get_config()["models_dir"]
+    if env_dir:
+        return os.path.expanduser(env_dir)
+    candidates = [os.path.join(os.path.expanduser("~"), ".ollama", "models")]
+    if platform.system() == "Linux":
+        # 通过 systemd 安装的服务以 ollama 用户运行
+        candidates.append("/usr/share/ollama/.ollama/models")
+    for path in candidates:
+        if os.path.isdir(path):
+            return path
+    return candidates[0]
+
+def get_store_usage(models_dir):
+    """统计模型存储的磁盘占用（按 inode 去重），结果缓存一段时间"""
+    now = time.monotonic()
+    cache = _store_usage_cache
+    if cache["path"] == models_dir and now - cache["time"] < STORE_USAGE_CACHE_SECONDS:
+        return cache["bytes"], cache["blobs"]
+    
+    total, blobs, seen = 0, 0, set()
+    for root, _, files in os.walk(models_dir):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+            if os.path.basename(root) == "blobs":
+                blobs += 1
+    cache.update(time=now, path=models_dir, bytes=total, blobs=blobs)
+    return total, blobs
+
+def check_server_alive(timeout=2, base_url=None):
+    """通过 /api/version 检查服务是否可用，返回 (是否可用, 版本号)"""
+    try:
+        result = ollama_api("/api/version", timeout=timeout, base_url=base_url)
+        return True, result.get("version", "")
+    except OllamaAPIError:
+        return False, ""
+
+def collect_server_metrics():
+    """抓取时从服务和磁盘采集的指标"""
+    extra = {}
+    started = time.perf_counter()
+    up, version = check_server_alive()
+    host_status = [({"host": get_ollama_base_url()}, int(up))]
+    # 配置文件中的其他服务地址只检查存活状态
+    for host in get_config()["hosts"][1:]:
+        base_url = get_ollama_base_url(host)
+        if base_url != get_ollama_base_url():
+            host_status.append(({"host": base_url}, int(check_server_alive(base_url=base_url)[0])))
+    extra["ollama_up"] = ("gauge", "Whether the Ollama server answers /api/version.", host_status)
+    extra["ollama_liveness_check_seconds"] = (
+        "gauge", "Duration of the liveness checks.", [({}, time.perf_counter() - started)])
+    if up:
+        extra["ollama_server_info"] = ("gauge", "Ollama server version.", [({"version": version}, 1)])
+        try:
+            loaded = ollama_api("/api/ps", timeout=5).get("models", [])
+            extra["ollama_loaded_models"] = ("gauge", "Models currently loaded in memory.",
+                                             [({}, len(loaded))])
+            extra["ollama_loaded_model_size_bytes"] = (
+                "gauge", "Memory used by each loaded model.",
+                [({"model": m.get("name", "")}, m.get("size", 0)) for m in loaded])
+            extra["ollama_loaded_model_vram_bytes"] = (
+                "gauge", "GPU memory used by each loaded model.",
+                [({"model": m.get("name", "")}, m.get("size_vram", 0)) for m in loaded])
+        except OllamaAPIError:
+            pass
+    
+    models_dir = get_models_dir()
+    if os.path.isdir(models_dir):
+        # 由监视线程增量维护，抓取时不需要重新列目录
+        extra["ollama_installed_models"] = ("gauge", "Models present in the local store.",
+                                            [({}, len(get_model_inventory().models))])
+        store_bytes, blob_count = get_store_usage(models_dir)
+        extra["ollama_model_store_bytes"] = ("gauge", "Disk space used by the model store.",
+                                             [({"path": models_dir}, store_bytes)])
+        extra["ollama_model_store_blobs"] = ("gauge", "Number of blob files in the model store.",
+                                             [({"path": models_dir}, blob_count)])
+        try:
+            usage = shutil.disk_usage(models_dir)
+            extra["ollama_model_store_free_bytes"] = (
+                "gauge", "Free space on the model store filesystem.",
+                [({"path": models_dir}, usage.free)])
+        except OSError:
+            pass
+    return extra
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """只提供 /metrics 的 HTTP 处理器"""
+    
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        try:
+            # 守护进程运行时，推理请求都经过它，导出它汇总的指标
+            text = daemon_call("metrics")
+        except DaemonUnavailable:
+            text = render_metrics(collect_server_metrics())
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=DEFAULT_METRICS_PORT, bind="0.0.0.0"):
+    """在后台线程启动指标服务"""
+    global _metrics_server
+    if _metrics_server is None:
+        _metrics_server = http.server.ThreadingHTTPServer((bind, port), MetricsHandler)
+        _metrics_server.daemon_threads = True
+        threading.Thread(target=_metrics_server.serve_forever, name="metrics",
+                         daemon=True).start()
+    return _metrics_server
+
+def stop_metrics_server():
+    """停止指标服务"""
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+        _metrics_server = None
+
+def record_pull_metrics(model_name, seconds):
+    """记录拉取耗时和吞吐量（以模型大小计算）"""
+    metric_observe("ollama_manager_pull_duration_seconds", seconds)
+    try:
+        installed = get_installed_models()
+    except OllamaAPIError:
+        return
+    name = model_name if ":" in model_name else model_name + ":latest"
+    size = installed.get(name, installed.get(model_name, 0))
+    if size:
+        metric_inc("ollama_manager_pull_bytes_total", {"model": name}, size)
+        metric_set("ollama_manager_pull_throughput_bytes_per_second",
+                   size / max(seconds, 1e-6), {"model": name})
+
+@traced("menu.metrics_exporter_menu")
+def metrics_exporter_menu():
+    """Prometheus 指标导出"""
+    clear_screen()
+    print_header()
+    print("\n📡 Prometheus 指标导出\n")
+    
+    if _metrics_server is not None:
+        host, port = _metrics_server.server_address[:2]
+        print(f"✅ 指标服务运行中: http://{host}:{port}/metrics")
+        if input("\n是否停止指标服务? (y/N): ").strip().lower() in ['y', 'yes']:
+            stop_metrics_server()
+            print("🛑 指标服务已停止")
+            input("\n按回车键返回...")
+        return
+    
+    try:
+        port = int(input(f"监听端口 (默认 {DEFAULT_METRICS_PORT}): ").strip() or DEFAULT_METRICS_PORT)
+    except ValueError:
+        print("❌ 请输入数字")
+        input("\n按回车键返回...")
+        return
+    bind = input("监听地址 (默认 0.0.0.0): ").strip() or "0.0.0.0"
+    
+    try:
+        start_metrics_server(port, bind)
+        print(f"\n✅ 指标服务已启动: http://{bind}:{port}/metrics")
+        print("服务在本程序运行期间持续提供指标，退出程序后停止")
+        print("请求延迟和 tokens/秒直方图来自本程序（或守护进程）发出的推理请求")
+        print(f"如需无人值守运行: python {os.path.basename(__file__)} metrics --port {port}")
+    except OSError as e:
+        print(f"\n❌ 启动失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 离线模型目录 ------------
+CATALOG_FILE = "catalog.json"
+CATALOG_INDEX_FILE = "catalog.idx.json"
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+# 内置快照（来自 ollama.com/library，大小为近似值），可通过导入/刷新替换
+BUILTIN_CATALOG = [
+    # (名称, 标签, 参数量, 量化, 大小, 说明)
+    ("llama3.2", "1b", "1.2B", "Q8_0", int(1.3 * GB), "Meta 轻量模型"),
+    ("llama3.2", "3b", "3.2B", "Q4_K_M", int(2.0 * GB), "Meta 轻量模型，默认版本"),
+    ("llama3.1", "8b", "8.0B", "Q4_K_M", int(4.9 * GB), "Meta 通用模型"),
+    ("llama3.1", "70b", "70.6B", "Q4_K_M", 43 * GB, "Meta 大模型"),
+    ("phi3", "mini", "3.8B", "Q4_0", int(2.2 * GB), "微软小模型"),
+    ("phi3", "medium", "14B", "Q4_0", int(7.9 * GB), "微软中型模型"),
+    ("phi4", "14b", "14.7B", "Q4_K_M", int(9.1 * GB), "微软推理增强模型"),
+    ("qwen2.5", "0.5b", "0.49B", "Q4_K_M", 398 * MB, "阿里通义，中文优化"),
+    ("qwen2.5", "1.5b", "1.5B", "Q4_K_M", 986 * MB, "阿里通义，中文优化"),
+    ("qwen2.5", "3b", "3.1B", "Q4_K_M", int(1.9 * GB), "阿里通义，中文优化"),
+    ("qwen2.5", "7b", "7.6B", "Q4_K_M", int(4.7 * GB), "阿里通义，中文优化"),
+    ("qwen2.5", "14b", "14.8B", "Q4_K_M", 9 * GB, "阿里通义，中文优化"),
+    ("qwen2.5", "32b", "32.8B", "Q4_K_M", 20 * GB, "阿里通义，中文优化"),
+    ("qwen2.5", "72b", "72.7B", "Q4_K_M", 47 * GB, "阿里通义，中文优化"),
+    ("qwen2.5-coder", "1.5b", "1.5B", "Q4_K_M", 986 * MB, "代码模型"),
+    ("qwen2.5-coder", "7b", "7.6B", "Q4_K_M", int(4.7 * GB), "代码模型"),
+    ("mistral", "7b", "7.2B", "Q4_0", int(4.1 * GB), "Mistral AI 通用模型"),
+    ("mixtral", "8x7b", "46.7B", "Q4_0", 26 * GB, "混合专家模型"),
+    ("gemma2", "2b", "2.6B", "Q4_0", int(1.6 * GB), "谷歌轻量版"),
+    ("gemma2", "9b", "9.2B", "Q4_0", int(5.4 * GB), "谷歌通用模型"),
+    ("gemma2", "27b", "27.2B", "Q4_0", 16 * GB, "谷歌大模型"),
+    ("gemma3", "1b", "1.0B", "Q4_K_M", 815 * MB, "谷歌新一代轻量模型"),
+    ("gemma3", "4b", "4.3B", "Q4_K_M", int(3.3 * GB), "谷歌新一代，多模态"),
+    ("gemma3", "12b", "12.2B", "Q4_K_M", int(8.1 * GB), "谷歌新一代，多模态"),
+    ("deepseek-r1", "1.5b", "1.8B", "Q4_K_M", int(1.1 * GB), "深度求索推理模型"),
+    ("deepseek-r1", "7b", "7.6B", "Q4_K_M", int(4.7 * GB), "深度求索推理模型"),
+    ("deepseek-r1", "8b", "8.0B", "Q4_K_M", int(4.9 * GB), "深度求索推理模型"),
+    ("deepseek-r1", "14b", "14.8B", "Q4_K_M", 9 * GB, "深度求索推理模型"),
+    ("deepseek-r1", "32b", "32.8B", "Q4_K_M", 20 * GB, "深度求索推理模型"),
+    ("tinyllama", "1.1b", "1.1B", "Q4_0", 638 * MB, "超小模型"),
+    ("smollm2", "135m", "135M", "F16", 271 * MB, "HuggingFace 超小模型"),
+    ("smollm2", "360m", "362M", "F16", 726 * MB, "HuggingFace 超小模型"),
+    ("smollm2", "1.7b", "1.7B", "Q8_0", int(1.8 * GB), "HuggingFace 小模型"),
+    ("codellama", "7b", "7B", "Q4_0", int(3.8 * GB), "Meta 代码模型"),
+    ("llava", "7b", "7B", "Q4_0", int(4.7 * GB), "视觉多模态模型"),
+    ("nomic-embed-text", "v1.5", "137M", "F16", 274 * MB, "向量模型"),
+    ("mxbai-embed-large", "335m", "334M", "F16", 670 * MB, "向量模型"),
+    ("all-minilm", "22m", "23M", "F16", 46 * MB, "小型向量模型"),
+]
+
+_catalog_cache = {"mtime": None, "entries": None, "index": None}
+
+def _builtin_catalog_entries():
+    return [{"name": name, "tag": tag, "params": params, "quant": quant, "size": size, "desc": desc}
+            for name, tag, params, quant, size, desc in BUILTIN_CATALOG]
+
+def normalize_catalog_entry(raw):
+    """规范化导入的目录条目，缺少名称时返回 None"""
+    name = str(raw.get("name", "")).strip().lower()
+    tag = str(raw.get("tag", "")).strip().lower()
+    if ":" in name and not tag:
+        name, tag = name.split(":", 1)
+    if not name:
+        return None
+    try:
+        size = int(raw.get("size") or 0)
+    except (TypeError, ValueError):
+        size = 0
+    return {
+        "name": name,
+        "tag": tag or "latest",
+        "params": str(raw.get("params", "")),
+        "quant": str(raw.get("quant", "")),
+        "size": size,
+        "desc": str(raw.get("desc", raw.get("description", ""))),
+    }
+
+def save_catalog(entries, source):
+    """写入目录文件并重建索引"""
+    unique = {}
+    for entry in entries:
+        unique[f"{entry['name']}:{entry['tag']}"] = entry
+    save_json_file(os.path.join(get_manager_dir(), CATALOG_FILE), {
+        "updated": datetime.now().isoformat(timespec='seconds'),
+        "source": source,
+        "models": sorted(unique.values(), key=lambda e: (e["name"], e["tag"])),
+    })
+    _catalog_cache["mtime"] = None
+    return len(unique)
+
+def import_catalog(source, replace=False):
+    """从 JSON 文件或 URL 导入目录
+    
+    支持 {"models": [...]} 或条目数组，条目字段为 name、tag、params、quant、size、desc。
+    replace 为 False 时与现有目录合并。返回导入后的条目数。
+    """
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source, timeout=get_timeout("api")) as response:
+            data = json.loads(response.read().decode('utf-8'))
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    raw_entries = data.get("models", []) if isinstance(data, dict) else data
+    entries = [e for e in (normalize_catalog_entry(raw) for raw in raw_entries
+                           if isinstance(raw, dict)) if e]
+    if not entries:
+        raise ValueError("没有找到有效的模型条目")
+    if not replace:
+        entries = load_catalog()[0] + entries
+    return save_catalog(entries, source)
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def build_catalog_index(entries):
+    """构建搜索索引：排序后的键（前缀二分查找）和三元组倒排表（模糊匹配）"""
+    keys = sorted((f"{e['name']}:{e['tag']}", i) for i, e in enumerate(entries))
+    trigrams = {}
+    for i, entry in enumerate(entries):
+        for gram in _trigrams(f"{entry['name']}:{entry['tag']}"):
+            trigrams.setdefault(gram, []).append(i)
+    return {"keys": keys, "trigrams": trigrams}
+
+def load_catalog():
+    """读取目录和索引，返回 (条目列表, 索引)
+    
+    索引与目录文件一起保存，目录修改时间变化时才重建。
+    """
+    catalog_path = os.path.join(MANAGER_DIR, CATALOG_FILE)
+    index_path = os.path.join(MANAGER_DIR, CATALOG_INDEX_FILE)
+    try:
+        mtime = os.stat(catalog_path).st_mtime_ns
+    except OSError:
+        mtime = 0
+    if _catalog_cache["entries"] is not None and _catalog_cache["mtime"] == mtime:
+        return _catalog_cache["entries"], _catalog_cache["index"]
+    
+    if mtime:
+        entries = (load_json_file(catalog_path, {}) or {}).get("models", [])
+    else:
+        entries = _builtin_catalog_entries()
+    
+    stored = load_json_file(index_path) if mtime else None
+    if stored and stored.get("catalog_mtime") == mtime:
+        index = dict(stored, keys=[tuple(key) for key in stored["keys"]])
+    else:
+        index = build_catalog_index(entries)
+        if mtime:
+            try:
+                save_json_file(index_path, dict(index, catalog_mtime=mtime))
+            except OSError:
+                pass
+    _catalog_cache.update(mtime=mtime, entries=entries, index=index)
+    return entries, index
+
+def search_catalog(query, limit=10):
+    """搜索目录：先精确匹配和前缀匹配，不足时用三元组做模糊匹配"""
+    entries, index = load_catalog()
+    query = query.strip().lower()
+    if not query:
+        return []
+    keys = index["keys"]
+    
+    found, seen = [], set()
+    def add(i):
+        if i not in seen:
+            seen.add(i)
+            found.append(entries[i])
+    
+    # 精确匹配（不带标签时匹配 latest 或该模型所有标签）
+    for key, i in keys:
+        if key == query or (":" not in query and key.split(":")[0] == query):
+            add(i)
+    
+    # 前缀匹配：二分查找到第一个不小于查询的键
+    position = bisect.bisect_left(keys, (query, -1))
+    while position < len(keys) and keys[position][0].startswith(query) and len(found) < limit:
+        add(keys[position][1])
+        position += 1
+    
+    # 模糊匹配：按共享三元组数量筛选候选，再用编辑相似度排序
+    if len(found) < limit:
+        counts = {}
+        for gram in _trigrams(query):
+            for i in index["trigrams"].get(gram, []):
+                counts[i] = counts.get(i, 0) + 1
+        candidates = sorted(counts, key=lambda i: -counts[i])[:50]
+        scored = []
+        for i in candidates:
+            key = f"{entries[i]['name']}:{entries[i]['tag']}"
+            ratio = max(difflib.SequenceMatcher(None, query, key).ratio(),
+                        difflib.SequenceMatcher(None, query, entries[i]["name"]).ratio())
+            if ratio >= 0.5:
+                scored.append((ratio, i))
+        for _, i in sorted(scored, reverse=True):
+            add(i)
+    return found[:limit]
+
+def catalog_contains(model_name):
+    """检查模型名（可带标签）是否在目录中"""
+    name, _, tag = model_name.strip().lower().partition(":")
+    entries, _ = load_catalog()
+    return any(e["name"] == name and (not tag or e["tag"] == tag) for e in entries)
+
+def print_catalog_entries(entries):
+    """打印目录条目"""
+    for i, entry in enumerate(entries, 1):
+        key = f"{entry['name']}:{entry['tag']}"
+        size = format_bytes(entry["size"]) if entry["size"] else "-"
+        print(f" {i:>2}. {key:<26} {entry['params']:>7} {entry['quant']:<7} {size:>9}  {entry['desc']}")
+
+def pick_from_catalog(query):
+    """搜索目录并让用户选择，返回模型全名或 None"""
+    results = search_catalog(query)
+    if not results:
+        print("❌ 目录中没有匹配的模型")
+        return None
+    print_catalog_entries(results)
+    choice = input("\n请选择序号 (直接回车取消): ").strip()
+    if choice.isdigit() and 1 <= int(choice) <= len(results):
+        entry = results[int(choice) - 1]
+        return f"{entry['name']}:{entry['tag']}"
+    return None
+
+@traced("menu.catalog_menu")
+def catalog_menu():
+    """模型目录：搜索、导入、刷新"""
+    while True:
+        clear_screen()
+        print_header()
+        entries, _ = load_catalog()
+        catalog = load_json_file(os.path.join(MANAGER_DIR, CATALOG_FILE))
+        print("\n📖 离线模型目录\n")
+        if catalog:
+            print(f"目录: {len(entries)} 个模型，更新于 {catalog.get('updated')}，来源 {catalog.get('source')}")
+        else:
+            print(f"目录: 内置快照，{len(entries)} 个模型")
+        print()
+        print("1. 搜索模型")
+        print("2. 从文件导入 (与现有目录合并)")
+        print("3. 从文件或 URL 刷新 (替换现有目录)")
+        print("4. 恢复内置快照")
+        print("0. 返回")
+        print()
+        
+        choice = input("请选择: ").strip()
+        try:
+            if choice == "1":
+                query = input("搜索 (名称、前缀或近似拼写): ").strip()
+                started = time.perf_counter()
+                results = search_catalog(query, limit=20)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                print(f"\n找到 {len(results)} 个结果 ({elapsed_ms:.1f} ms):")
+                print_catalog_entries(results)
+            elif choice in ("2", "3"):
+                source = input("文件路径或 URL: ").strip()
+                count = import_catalog(source, replace=(choice == "3"))
+                print(f"✅ 目录已更新，共 {count} 个模型")
+            elif choice == "4":
+                count = save_catalog(_builtin_catalog_entries(), "builtin")
+                print(f"✅ 已恢复内置快照，共 {count} 个模型")
+            elif choice == "0":
+                return
+            else:
+                print("❌ 无效选择")
+                time.sleep(1)
+                continue
+        except (OSError, ValueError) as e:
+            print(f"❌ 操作失败: {str(e)}")
+        input("\n按回车键继续...")
+
+# ------------ 硬件适配推荐 ------------
+def parse_param_count(text):
+    """把 "7.6B"、"135M" 这样的参数量解析为数值，无法解析时返回 0"""
+    match = re.match(r'^\s*([\d.]+)\s*([KMB])?', str(text), re.IGNORECASE)
+    if not match:
+        return 0.0
+    scale = {"K": 1e3, "M": 1e6, "B": 1e9}.get((match.group(2) or "").upper(), 1)
+    return float(match.group(1)) * scale
+
+def get_cpu_cores():
+    """获取物理核心数，拿不到时退回逻辑核心数"""
+    if HAS_PSUTIL:
+        try:
+            import psutil
+            cores = psutil.cpu_count(logical=False)
+            if cores:
+                return cores
+        except Exception:
+            pass
+    return os.cpu_count() or 1
+
+def get_hardware_profile():
+    """汇总用于推荐的硬件信息：内存、核心数和估算的内存带宽"""
+    hardware = get_config()["hardware"]
+    total, available = get_memory_info()
+    cores = get_cpu_cores()
+    bandwidth = hardware["memory_bandwidth_gbps"]
+    if not bandwidth:
+        # 粗略估计：CPU 推理受内存带宽限制，核心越多通常内存通道越多
+        bandwidth = min(8 + 3 * cores, 60)
+    return {
+        "total": total,
+        "available": available,
+        "cores": cores,
+        "bandwidth_gbps": bandwidth,
+        "reserve": int(hardware["reserve_gb"] * GB),
+    }
+
+def estimate_model_memory(entry):
+    """估计运行模型需要的内存：权重 + KV 缓存与运行时开销"""
+    return int(entry["size"] * 1.1 + 0.5 * GB)
+
+def estimate_tokens_per_second(entry, profile):
+    """按内存带宽估计 CPU 生成速度：每个 token 都要完整读一遍权重"""
+    if not entry["size"]:
+        return 0.0
+    return profile["bandwidth_gbps"] * GB * 0.6 / entry["size"]
+
+def assess_model_fit(entry, profile):
+    """评估模型在本机的运行情况，返回 (等级, 所需内存, 估算 tokens/秒)
+    
+    等级：0 流畅，1 可运行但较慢，2 需关闭其他程序，3 内存不足
+    """
+    needed = estimate_model_memory(entry)
+    speed = estimate_tokens_per_second(entry, profile)
+    total, available = profile["total"], profile["available"]
+    if total is None:
+        return (0 if speed >= get_config()["hardware"]["min_tokens_per_second"] else 1), needed, speed
+    if needed > total - profile["reserve"]:
+        return 3, needed, speed
+    if available is not None and needed > available:
+        return 2, needed, speed
+    if speed < get_config()["hardware"]["min_tokens_per_second"]:
+        return 1, needed, speed
+    return 0, needed, speed
+
+FIT_LABELS = {0: "✅ 流畅", 1: "🟡 较慢", 2: "⚠️  需释放内存", 3: "❌ 内存不足"}
+
+def is_embedding_entry(entry):
+    """向量模型不能对话，推荐时排除"""
+    return "embed" in entry["name"] or "minilm" in entry["name"]
+
+def recommend_models(profile=None, limit=12):
+    """按本机硬件为目录中的模型排序
+    
+    能流畅运行的排在前面，同一等级内参数量大的优先（能力更强）。
+    返回 [(条目, 等级, 所需内存, 估算 tokens/秒)]
+    """
+    profile = profile or get_hardware_profile()
+    entries, _ = load_catalog()
+    ranked = []
+    for entry in entries:
+        if is_embedding_entry(entry) or not entry["size"]:
+            continue
+        level, needed, speed = assess_model_fit(entry, profile)
+        ranked.append((entry, level, needed, speed))
+    ranked.sort(key=lambda item: (item[1], -parse_param_count(item[0]["params"]), item[0]["size"]))
+    return ranked[:limit]
+
+def find_catalog_entry(model_name):
+    """按模型全名查找目录条目
+    
+    不带标签时 ollama 拉取 latest：目录中有 latest 就用它，否则按最大的版本估算（宁可多提示一次）。
+    """
+    name, _, tag = model_name.strip().lower().partition(":")
+    entries, _ = load_catalog()
+    matches = [e for e in entries if e["name"] == name and e["tag"] == (tag or "latest")]
+    if not matches and not tag:
+        matches = sorted((e for e in entries if e["name"] == name), key=lambda e: -(e["size"] or 0))
+    return matches[0] if matches else None
+
+def print_hardware_profile(profile):
+    """打印硬件概况"""
+    total, available = profile["total"], profile["available"]
+    memory = (f"{format_bytes(total)} (可用 {format_bytes(available)})"
+              if total is not None else "未知")
+    print(f"内存: {memory}  物理核心: {profile['cores']}  "
+          f"估算内存带宽: {profile['bandwidth_gbps']:.0f} GB/s")
+
+def print_recommendations(ranked):
+    """打印推荐列表"""
+    print("     " + pad_display("模型", 23) + pad_display("   参数", 8) + pad_display("量化", 8)
+          + pad_display("     大小", 10) + pad_display(" 需要内存", 10) + " 约 tok/s  评估")
+    print("-" * 86)
+    for i, (entry, level, needed, speed) in enumerate(ranked, 1):
+        key = f"{entry['name']}:{entry['tag']}"
+        print(f" {i:>2}. {key:<22} {entry['params']:>7} {entry['quant']:<7} "
+              f"{format_bytes(entry['size']):>9} {format_bytes(needed):>9} {speed:>8.1f}  {FIT_LABELS[level]}")
+    print("-" * 86)
+    print("速度为纯 CPU 推理的粗略估计，使用 GPU 时会快很多；可在配置文件 hardware 中校准内存带宽")
+
+def pick_recommended_model():
+    """显示硬件推荐并让用户选择，返回模型全名或 None"""
+    profile = get_hardware_profile()
+    print_hardware_profile(profile)
+    print()
+    ranked = recommend_models(profile)
+    print_recommendations(ranked)
+    choice = input("\n请选择序号 (直接回车取消): ").strip()
+    if choice.isdigit() and 1 <= int(choice) <= len(ranked):
+        entry = ranked[int(choice) - 1][0]
+        return f"{entry['name']}:{entry['tag']}"
+    return None
+
+def confirm_model_fit(model_name):
+    """下载前检查模型是否适合本机，不适合时要求确认"""
+    entry = find_catalog_entry(model_name)
+    if not entry or not entry["size"]:
+        return True
+    level, needed, speed = assess_model_fit(entry, get_hardware_profile())
+    if level == 0:
+        return True
+    print(f"\n{FIT_LABELS[level]}: '{model_name}' 运行约需 {format_bytes(needed)} 内存，"
+          f"本机纯 CPU 估算约 {speed:.1f} tokens/秒")
+    if level == 3:
+        print("   模型会使用交换空间，速度会非常慢，建议选择更小的版本")
+    return input("仍然下载? (y/N): ").strip().lower() == 'y'
+
+@traced("menu.hardware_recommend_menu")
+def hardware_recommend_menu():
+    """按本机硬件推荐模型"""
+    clear_screen()
+    print_header()
+    print("\n🖥️  按本机硬件推荐模型\n")
+    profile = get_hardware_profile()
+    print_hardware_profile(profile)
+    print()
+    print_recommendations(recommend_models(profile, limit=30))
+    input("\n按回车键返回...")
+
+# ------------ 模型导出/导入 ------------
+DEFAULT_REGISTRY = "registry.ollama.ai"
+DEFAULT_NAMESPACE = "library"
+BUNDLE_INFO_NAME = "bundle.json"
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+BLOB_NAME_RE = re.compile(r'^sha256[-:]([0-9a-f]{64})$')
+
+def parse_model_name(name):
+    """把模型名拆成 (仓库, 命名空间, 模型, 标签)，缺省部分按 ollama 的规则补全"""
+    name = name.strip()
+    path, tag = name, "latest"
+    if ":" in name.rsplit("/", 1)[-1]:
+        path, tag = name.rsplit(":", 1)
+    parts = path.split("/")
+    if len(parts) == 1:
+        return DEFAULT_REGISTRY, DEFAULT_NAMESPACE, parts[0], tag
+    if len(parts) == 2:
+        return DEFAULT_REGISTRY, parts[0], parts[1], tag
+    return parts[0], "/".join(parts[1:-1]), parts[-1], tag
+
+def format_model_name(registry, namespace, model, tag):
+    """parse_model_name 的逆操作，省略默认仓库和命名空间"""
+    if registry == DEFAULT_REGISTRY:
+        path = model if namespace == DEFAULT_NAMESPACE else f"{namespace}/{model}"
+    else:
+        path = f"{registry}/{namespace}/{model}"
+    return f"{path}:{tag}"
+
+def get_manifest_path(models_dir, name):
+    """模型清单文件路径"""
+    return os.path.join(models_dir, "manifests", *parse_model_name(name))
+
+def get_blob_path(models_dir, digest):
+    """数据块文件路径（sha256:xxx 存为 sha256-xxx）"""
+    return os.path.join(models_dir, "blobs", digest.replace(":", "-"))
+
+def iter_manifests(models_dir):
+    """遍历存储中的所有清单，产出 (模型全名, 清单路径)"""
+    root = os.path.join(models_dir, "manifests")
+    for dirpath, _, files in os.walk(root):
+        rel = os.path.relpath(dirpath, root).split(os.sep)
+        if len(rel) < 3:
+            continue
+        for tag in files:
+            if tag.endswith(".tmp"):
+                continue
+            yield format_model_name(rel[0], "/".join(rel[1:-1]), rel[-1], tag), os.path.join(dirpath, tag)
+
+def load_manifest(path):
+    """读取清单 JSON"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def manifest_layers(manifest):
+    """清单引用的所有数据块 [(摘要, 大小)]，包括 config"""
+    layers = list(manifest.get("layers", []))
+    if manifest.get("config"):
+        layers.append(manifest["config"])
+    return [(layer["digest"], layer.get("size", 0)) for layer in layers if layer.get("digest")]
+
+def copy_fd_range(src_fd, dst_fd, count, src_offset=None, progress=None):
+    """在两个文件描述符之间复制 count 字节，优先使用内核零拷贝
+    
+    依次尝试 copy_file_range（Python 3.8+，Linux）、sendfile，最后退回普通读写。
+    src_offset 为 None 时从源文件当前位置读取。
+    """
+    if src_offset is not None:
+        os.lseek(src_fd, src_offset, os.SEEK_SET)
+    remaining = count
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append("copy_file_range")
+    if hasattr(os, "sendfile") and platform.system() == "Linux":
+        methods.append("sendfile")
+    
+    while remaining > 0:
+        step = min(remaining, COPY_CHUNK_SIZE)
+        copied = 0
+        while methods and not copied:
+            try:
+                if methods[0] == "copy_file_range":
+                    copied = os.copy_file_range(src_fd, dst_fd, step)
+                else:
+                    offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+                    copied = os.sendfile(dst_fd, src_fd, offset, step)
+                    os.lseek(src_fd, offset + copied, os.SEEK_SET)
+                if not copied:
+                    raise EOFError("源文件提前结束")
+            except OSError:
+                # 文件系统或平台不支持时换下一种方式
+                methods.pop(0)
+        if not copied:
+            data = os.read(src_fd, step)
+            if not data:
+                raise EOFError("源文件提前结束")
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dst_fd, view):]
+            copied = len(data)
+        remaining -= copied
+        if progress:
+            progress(copied)
+
+def _write_tar_entry(out_fd, arcname, size, mtime, src_path=None, data=None, progress=None):
+    """写入一个 tar 条目：头部 + 数据 + 补齐到 512 字节"""
+    info = tarfile.TarInfo(arcname)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    os.write(out_fd, info.tobuf(format=tarfile.GNU_FORMAT))
+    if data is not None:
+        os.write(out_fd, data)
+    else:
+        src_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            copy_fd_range(src_fd, out_fd, size, progress=progress)
+        finally:
+            os.close(src_fd)
+    padding = -size % tarfile.BLOCKSIZE
+    if padding:
+        os.write(out_fd, b"\0" * padding)
+
+def export_models(names, output_path, models_dir=None, progress=None):
+    """把模型的清单和数据块打包为一个 tar 文件
+    
+    数据块通过零拷贝流式写入，不在内存中保留完整副本；多个模型共享的数据块只写一次。
+    返回 (模型数, 数据块数, 总字节数)。
+    """
+    models_dir = models_dir or get_models_dir()
+    models, blobs = [], {}
+    for name in names:
+        manifest_path = get_manifest_path(models_dir, name)
+        if not os.path.isfile(manifest_path):
+            raise FileNotFoundError(f"找不到模型清单: {name}")
+        manifest = load_manifest(manifest_path)
+        for digest, _ in manifest_layers(manifest):
+            path = get_blob_path(models_dir, digest)
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"模型 {name} 缺少数据块 {digest}")
+            blobs[digest] = path
+        rel = os.path.relpath(manifest_path, models_dir).replace(os.sep, "/")
+        models.append({"name": format_model_name(*parse_model_name(name)), "manifest": rel,
+                       "path": manifest_path})
+    
+    info = json.dumps({
+        "format": 1,
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "models": [{"name": m["name"], "manifest": m["manifest"]} for m in models],
+        "blobs": sorted(blobs),
+    }, ensure_ascii=False, indent=2).encode('utf-8')
+    
+    total = 0
+    tmp_path = output_path + ".tmp"
+    out_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        now = time.time()
+        _write_tar_entry(out_fd, BUNDLE_INFO_NAME, len(info), now, data=info)
+        for digest, path in sorted(blobs.items()):
+            size = os.path.getsize(path)
+            if progress:
+                progress("blob", digest, size)
+            _write_tar_entry(out_fd, "blobs/" + os.path.basename(path), size,
+                             os.path.getmtime(path), src_path=path,
+                             progress=(lambda n: progress("bytes", digest, n)) if progress else None)
+            total += size
+        # 清单放在最后，导入时数据块全部就位后才会出现模型
+        for model in models:
+            size = os.path.getsize(model["path"])
+            _write_tar_entry(out_fd, model["manifest"], size, os.path.getmtime(model["path"]),
+                             src_path=model["path"])
+        os.write(out_fd, b"\0" * (tarfile.BLOCKSIZE * 2))
+    finally:
+        os.close(out_fd)
+    os.replace(tmp_path, output_path)
+    return len(models), len(blobs), total
+
+def _hash_file(path, buffer_size=4 * 1024 * 1024):
+    """计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+def _safe_manifest_member(name):
+    """只接受 manifests/ 下不含 .. 的相对路径"""
+    parts = name.split("/")
+    return (len(parts) >= 5 and parts[0] == "manifests"
+            and all(p and p not in (".", "..") for p in parts))
+
+def _import_blob(src_fd, member, digest, target, verify, progress):
+    """把 tar 包中的一个数据块零拷贝写入临时文件，校验后改名为正式文件"""
+    tmp_path = target + "-partial-import"
+    dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        copy_fd_range(src_fd, dst_fd, member.size, src_offset=member.offset_data,
+                      progress=(lambda n: progress("bytes", digest, n)) if progress else None)
+    finally:
+        os.close(dst_fd)
+    if verify and "sha256:" + _hash_file(tmp_path) != digest:
+        os.remove(tmp_path)
+        raise ValueError(f"数据块校验失败: {digest}")
+    os.replace(tmp_path, target)
+
+def import_bundle(bundle_path, models_dir=None, verify=True, progress=None):
+    """把导出的 tar 包解到模型存储，已存在（按摘要和大小判断）的数据块直接跳过
+    
+    数据块先写入临时文件，校验通过后再改名；所有数据块就位后才写清单。
+    返回 (导入的模型列表, 新写入的数据块数, 跳过的数据块数, 新写入字节数)。
+    """
+    models_dir = models_dir or get_models_dir()
+    os.makedirs(os.path.join(models_dir, "blobs"), exist_ok=True)
+    written, skipped, written_bytes = 0, 0, 0
+    manifests = []
+    
+    # 数据块用单独的描述符零拷贝读取，不干扰 tarfile 自己的缓冲读取
+    src_fd = os.open(bundle_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        with tarfile.open(bundle_path, "r:") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if member.name.startswith("blobs/"):
+                    match = BLOB_NAME_RE.match(member.name[len("blobs/"):])
+                    if not match:
+                        raise ValueError(f"无效的数据块名称: {member.name}")
+                    digest = "sha256:" + match.group(1)
+                    target = get_blob_path(models_dir, digest)
+                    if os.path.isfile(target) and os.path.getsize(target) == member.size:
+                        skipped += 1
+                        if progress:
+                            progress("skip", digest, member.size)
+                        continue
+                    if progress:
+                        progress("blob", digest, member.size)
+                    _import_blob(src_fd, member, digest, target, verify, progress)
+                    written += 1
+                    written_bytes += member.size
+                elif member.name.startswith("manifests/"):
+                    if not _safe_manifest_member(member.name):
+                        raise ValueError(f"无效的清单路径: {member.name}")
+                    manifests.append((member.name, archive.extractfile(member).read()))
+    finally:
+        os.close(src_fd)
+    
+    imported = []
+    for name, data in manifests:
+        manifest = json.loads(data.decode('utf-8'))
+        parts = name.split("/")[1:]
+        model_name = format_model_name(parts[0], "/".join(parts[1:-2]), parts[-2], parts[-1])
+        missing = [d for d, _ in manifest_layers(manifest)
+                   if not os.path.isfile(get_blob_path(models_dir, d))]
+        if missing:
+            raise ValueError(f"模型 {model_name} 缺少 {len(missing)} 个数据块，导入包不完整")
+        target = os.path.join(models_dir, *name.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + ".tmp", 'wb') as f:
+            f.write(data)
+        os.replace(target + ".tmp", target)
+        imported.append(model_name)
+    return imported, written, skipped, written_bytes
+
+def make_copy_progress():
+    """生成导出/导入进度回调，按数据块打印进度"""
+    state = {"size": 0, "done": 0, "last": 0.0}
+    
+    def progress(kind, digest, value):
+        short = digest.split(":")[-1][:12]
+        if kind == "skip":
+            print(f"  ⏭️  {short} 已存在，跳过 ({format_bytes(value)})")
+        elif kind == "blob":
+            state.update(size=value, done=0, last=0.0)
+            print(f"  📦 {short} ({format_bytes(value)})", end="", flush=True)
+        else:
+            state["done"] += value
+            now = time.monotonic()
+            if state["done"] >= state["size"] or now - state["last"] > 0.5:
+                state["last"] = now
+                percent = state["done"] * 100 // max(state["size"], 1)
+                print(f"\r  📦 {short} ({format_bytes(state['size'])}) {percent:>3}%", end="",
+                      flush=True)
+                if state["done"] >= state["size"]:
+                    print()
+    return progress
+
+@traced("menu.bundle_menu")
+def bundle_menu():
+    """模型导出/导入"""
+    clear_screen()
+    print_header()
+    print("\n📦 模型导出/导入 (离线传输)\n")
+    models_dir = get_models_dir()
+    print(f"模型存储: {models_dir}\n")
+    print("1. 导出模型到文件")
+    print("2. 从文件导入模型")
+    print("0. 返回")
+    choice = input("\n请选择: ").strip()
+    
+    try:
+        if choice == "1":
+            names = sorted(get_model_inventory().snapshot())
+            if not names:
+                print("❌ 没有找到已安装的模型")
+                input("\n按回车键返回...")
+                return
+            for i, name in enumerate(names, 1):
+                print(f" {i:>2}. {name}")
+            picked = input("\n要导出的模型序号 (多个用空格分隔): ").split()
+            selected = [names[int(p) - 1] for p in picked if p.isdigit() and 1 <= int(p) <= len(names)]
+            if not selected:
+                print("❌ 没有选择模型")
+            else:
+                output = input("输出文件 (默认 ollama-models.tar): ").strip() or "ollama-models.tar"
+                started = time.perf_counter()
+                count, blob_count, total = export_models(selected, output, models_dir,
+                                                         progress=make_copy_progress())
+                elapsed = time.perf_counter() - started
+                print(f"\n✅ 已导出 {count} 个模型、{blob_count} 个数据块，共 {format_bytes(total)}，"
+                      f"用时 {format_seconds(elapsed)}")
+                print(f"   文件: {os.path.abspath(output)}")
+        elif choice == "2":
+            path = input("导入文件路径: ").strip()
+            started = time.perf_counter()
+            imported, written, skipped, written_bytes = import_bundle(
+                path, models_dir, progress=make_copy_progress())
+            elapsed = time.perf_counter() - started
+            print(f"\n✅ 已导入 {len(imported)} 个模型: {', '.join(imported)}")
+            print(f"   新写入 {written} 个数据块 ({format_bytes(written_bytes)})，跳过已有 {skipped} 个，"
+                  f"用时 {format_seconds(elapsed)}")
+            print("   如果服务正在运行，可直接使用导入的模型")
+        elif choice != "0":
+            print("❌ 无效选择")
+        else:
+            return
+    except (OSError, ValueError, EOFError, tarfile.TarError) as e:
+        print(f"\n❌ 操作失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 存储复制与去重 ------------
+FICLONE = 0x40049409  # Linux ioctl：在支持的文件系统（btrfs、XFS 等）上共享数据块
+
+def reflink_file(src, dst):
+    """尝试用 reflink 创建写时复制副本，不支持时抛出 OSError"""
+    if platform.system() != "Linux":
+        raise OSError("reflink 仅支持 Linux")
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+def link_or_copy(src, dst, allow_copy=True):
+    """依次尝试硬链接、reflink、普通复制，返回使用的方式
+    
+    先写到临时名再改名，目标已存在时会被原子替换。
+    allow_copy 为 False 且无法链接时不做改动，返回 None。
+    """
+    tmp = dst + "-partial-link"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    method = None
+    try:
+        os.link(src, tmp)
+        method = "hardlink"
+    except OSError:
+        try:
+            reflink_file(src, tmp)
+            method = "reflink"
+        except OSError:
+            if not allow_copy:
+                return None
+            size = os.path.getsize(src)
+            src_fd = os.open(src, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+                try:
+                    copy_fd_range(src_fd, dst_fd, size)
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+            method = "copy"
+    os.replace(tmp, dst)
+    return method
+
+def replicate_store(src_dir, dst_dir, names=None):
+    """把模型从一个存储复制到另一个存储，数据块尽量链接而不是复制
+    
+    names 为 None 时复制全部模型。返回统计 {方式: [个数, 字节数]}，方式包括
+    hardlink、reflink、copy 和 existing（目标中已有）。
+    """
+    manifests = dict(iter_manifests(src_dir))
+    if names:
+        manifests = {format_model_name(*parse_model_name(n)): get_manifest_path(src_dir, n)
+                     for n in names}
+    stats = {"hardlink": [0, 0], "reflink": [0, 0], "copy": [0, 0], "existing": [0, 0]}
+    os.makedirs(os.path.join(dst_dir, "blobs"), exist_ok=True)
+    done = set()
+    for name, manifest_path in sorted(manifests.items()):
+        manifest = load_manifest(manifest_path)
+        for digest, _ in manifest_layers(manifest):
+            if digest in done:
+                continue
+            done.add(digest)
+            src = get_blob_path(src_dir, digest)
+            dst = get_blob_path(dst_dir, digest)
+            size = os.path.getsize(src)
+            if os.path.isfile(dst) and os.path.getsize(dst) == size:
+                method = "existing"
+            else:
+                method = link_or_copy(src, dst)
+            stats[method][0] += 1
+            stats[method][1] += size
+        # 数据块就位后再写清单
+        target = get_manifest_path(dst_dir, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(manifest_path, target + ".tmp")
+        os.replace(target + ".tmp", target)
+    return stats
+
+def find_duplicate_blobs(store_dirs):
+    """找出多个存储中内容相同（摘要相同）但不是同一个文件的数据块
+    
+    只有同一文件系统上的文件能链接，按 (设备, 摘要) 分组。
+    返回 [(保留的文件, [(重复文件, stat)...], 大小)]，重复文件包括所有 inode 与保留者不同的路径
+    （彼此是硬链接的多个路径都要替换，否则旧 inode 仍被引用）。
+    """
+    groups = {}
+    listed = set()
+    for store in store_dirs:
+        blobs_dir = os.path.join(store, "blobs")
+        try:
+            names = os.listdir(blobs_dir)
+        except OSError:
+            continue
+        for name in names:
+            if not BLOB_NAME_RE.match(name):
+                continue
+            path = os.path.join(blobs_dir, name)
+            real = os.path.realpath(path)
+            if real in listed:
+                continue   # 同一目录被重复指定
+            listed.add(real)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            groups.setdefault((st.st_dev, name, st.st_size), []).append((path, st))
+    
+    duplicates = []
+    for (_, _, size), files in groups.items():
+        # 链接数最多的文件作为保留者，其余不同 inode 的文件指向它
+        files.sort(key=lambda item: -item[1].st_nlink)
+        keeper, keeper_st = files[0]
+        others = [(path, st) for path, st in files[1:] if st.st_ino != keeper_st.st_ino]
+        if others:
+            duplicates.append((keeper, others, size))
+    return duplicates
+
+def dedupe_stores(store_dirs, dry_run=False):
+    """把多个存储中的重复数据块替换为硬链接（不支持时用 reflink）
+    
+    替换前核对内容：保留者和每个被替换的 inode 都要与文件名中的摘要一致
+    （校验缓存中签名未变的直接采用，否则重新计算），不一致的不处理。dry_run 时不核对。
+    返回 (处理的文件数, 释放的字节数, [内容不符的文件])。
+    一个 inode 的所有链接都被替换时空间才会释放，每个 inode 只计一次。
+    """
+    cache = load_json_file(os.path.join(MANAGER_DIR, VERIFY_CACHE_FILE), {}) or {}
+    checked = {}     # (设备, inode) -> 内容是否正确
+    
+    def content_ok(path, st, expected):
+        key = (st.st_dev, st.st_ino)
+        if key not in checked:
+            if cache.get(path) == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                checked[key] = True
+            else:
+                try:
+                    checked[key] = hash_blob(path) == expected
+                except OSError:
+                    checked[key] = False
+        return checked[key]
+    
+    replaced, saved, corrupt = 0, 0, []
+    for keeper, others, size in find_duplicate_blobs(store_dirs):
+        expected = BLOB_NAME_RE.match(os.path.basename(keeper)).group(1)
+        if not dry_run and not content_ok(keeper, os.stat(keeper), expected):
+            corrupt.append(keeper)
+            continue
+        links = {}
+        for path, st in others:
+            links.setdefault(st.st_ino, []).append((path, st))
+        for paths in links.values():
+            st = paths[0][1]
+            if not dry_run and not content_ok(paths[0][0], st, expected):
+                corrupt.extend(path for path, _ in paths)
+                continue
+            done = sum(1 for path, _ in paths
+                       if dry_run or link_or_copy(keeper, path, allow_copy=False))
+            replaced += done
+            # 这个 inode 在组外还有链接时不会释放空间
+            if done == len(paths) == st.st_nlink:
+                saved += size
+    return replaced, saved, corrupt
+
+def print_corrupt_blobs(corrupt):
+    """提示内容与摘要不符、未参与去重的文件"""
+    for path in corrupt:
+        print(f"⚠️  内容与文件名摘要不符，已跳过: {path}")
+    if corrupt:
+        print("   请用 数据块完整性校验 检查对应的存储")
+
+def print_replicate_stats(stats):
+    """打印复制统计"""
+    labels = {"hardlink": "硬链接", "reflink": "reflink", "copy": "复制", "existing": "已存在"}
+    for method, (count, size) in stats.items():
+        if count:
+            print(f"  {labels[method]:<8} {count:>5} 个数据块  {format_bytes(size)}")
+    # 目标中已有的数据块本次没有写入，也没有节省空间
+    saved = stats["hardlink"][1] + stats["reflink"][1]
+    print(f"  节省空间 {format_bytes(saved)}，实际复制 {format_bytes(stats['copy'][1])}")
+
+@traced("menu.store_replicate_menu")
+def store_replicate_menu():
+    """存储复制与去重"""
+    clear_screen()
+    print_header()
+    print("\n🔗 模型存储复制与去重\n")
+    print("1. 复制模型到另一个存储目录 (优先硬链接/reflink)")
+    print("2. 多个存储目录去重 (重复数据块改为硬链接)")
+    print("0. 返回")
+    choice = input("\n请选择: ").strip()
+    
+    try:
+        if choice == "1":
+            src = input(f"源目录 (默认 {get_models_dir()}): ").strip() or get_models_dir()
+            dst = input("目标目录: ").strip()
+            if not dst:
+                print("❌ 目标目录不能为空")
+            else:
+                names = input("模型名称 (多个用空格分隔，直接回车复制全部): ").split()
+                started = time.perf_counter()
+                stats = replicate_store(os.path.expanduser(src), os.path.expanduser(dst), names or None)
+                print(f"\n✅ 复制完成，用时 {format_seconds(time.perf_counter() - started)}")
+                print_replicate_stats(stats)
+        elif choice == "2":
+            dirs = [os.path.expanduser(d) for d in
+                    input("存储目录 (多个用空格分隔): ").split()]
+            if len(dirs) < 2:
+                print("❌ 至少需要两个目录")
+            else:
+                count, saved, _ = dedupe_stores(dirs, dry_run=True)
+                print(f"\n发现 {count} 个重复数据块，可释放 {format_bytes(saved)}")
+                if count and input("确认替换为链接（会先核对内容）? (y/N): ").strip().lower() == 'y':
+                    count, saved, corrupt = dedupe_stores(dirs)
+                    print(f"✅ 已处理 {count} 个数据块，释放 {format_bytes(saved)}")
+                    print_corrupt_blobs(corrupt)
+                    print("   注意：链接的文件共享权限和所有者")
+        elif choice == "0":
+            return
+        else:
+            print("❌ 无效选择")
+    except (OSError, ValueError, EOFError) as e:
+        print(f"\n❌ 操作失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 数据块完整性校验 ------------
+VERIFY_CACHE_FILE = "verify_cache.json"
+VERIFY_BUFFER_SIZE = 8 * 1024 * 1024
+_verify_local = threading.local()
+
+def hash_blob(path):
+    """计算数据块的 SHA-256，每个线程复用一块读取缓冲区（hashlib 计算时会释放 GIL）"""
+    buffer = getattr(_verify_local, "buffer", None)
+    if buffer is None:
+        buffer = _verify_local.buffer = bytearray(VERIFY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+def get_verify_workers():
+    """校验线程数：配置为 0 时按 CPU 数量"""
+    workers = get_config()["concurrency"]["verify_workers"]
+    return workers if workers > 0 else min(os.cpu_count() or 1, 8)
+
+def verify_store(models_dir=None, workers=None, full=False, progress=None):
+    """并行校验存储中的数据块，文件名中的摘要即期望值
+    
+    (大小, 修改时间, inode) 与上次校验通过时相同的文件直接跳过，full 为 True 时本存储的全部重新计算
+    （其他存储的缓存记录保留）。同时在计算的文件不超过线程数的两倍，中断时取消尚未开始的。
+    返回结果字典：checked、cached、bytes、bad [(路径, 实际摘要)]、missing [(模型, 摘要)]。
+    """
+    models_dir = models_dir or get_models_dir()
+    blobs_dir = os.path.join(models_dir, "blobs")
+    cache_path = os.path.join(get_manager_dir(), VERIFY_CACHE_FILE)
+    cache = load_json_file(cache_path, {})
+    if full:
+        cache = {path: sig for path, sig in cache.items() if os.path.dirname(path) != blobs_dir}
+    result = {"checked": 0, "cached": 0, "bytes": 0, "bad": [], "missing": []}
+    
+    pending = []
+    for name in os.listdir(blobs_dir) if os.path.isdir(blobs_dir) else []:
+        match = BLOB_NAME_RE.match(name)
+        if not match:
+            continue
+        path = os.path.join(blobs_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+        if cache.get(path) == signature:
+            result["cached"] += 1
+        else:
+            pending.append((path, match.group(1), signature))
+    
+    # 大文件先提交，避免最后剩一个大文件单线程计算
+    pending.sort(key=lambda item: -item[2][0])
+    total_bytes = sum(item[2][0] for item in pending)
+    workers = workers or get_verify_workers()
+    queue = iter(pending)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = {}
+    try:
+        while True:
+            for path, expected, signature in itertools.islice(queue, workers * 2 - len(futures)):
+                futures[pool.submit(hash_blob, path)] = (path, expected, signature)
+            if not futures:
+                break
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, expected, signature = futures.pop(future)
+                try:
+                    actual = future.result()
+                except OSError as e:
+                    actual = f"读取失败: {e}"
+                result["checked"] += 1
+                result["bytes"] += signature[0]
+                if actual == expected:
+                    cache[path] = signature
+                else:
+                    cache.pop(path, None)
+                    result["bad"].append((path, actual))
+                if progress:
+                    progress(result["bytes"], total_bytes, result["checked"], len(pending))
+    finally:
+        # 中断时取消排队的文件，不等正在计算的几个结束
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+        # 中断时也保存已完成的部分，下次从这里继续
+        live = {path: sig for path, sig in cache.items() if os.path.dirname(path) != blobs_dir
+                or os.path.exists(path)}
+        try:
+            save_json_file(cache_path, live)
+        except OSError:
+            pass
+    
+    for model, manifest_path in iter_manifests(models_dir):
+        try:
+            layers = manifest_layers(load_manifest(manifest_path))
+        except (OSError, ValueError):
+            result["missing"].append((model, "清单无法读取"))
+            continue
+        for digest, _ in layers:
+            if not os.path.isfile(get_blob_path(models_dir, digest)):
+                result["missing"].append((model, digest))
+    return result
+
+def print_verify_result(result, elapsed):
+    """打印校验结果"""
+    speed = result["bytes"] / elapsed if elapsed > 0 else 0
+    print(f"校验 {result['checked']} 个数据块 ({format_bytes(result['bytes'])}，"
+          f"{format_bytes(speed)}/s)，缓存跳过 {result['cached']} 个，用时 {format_seconds(elapsed)}")
+    for path, actual in result["bad"]:
+        print(f"❌ 损坏: {path}")
+        print(f"   实际: {actual}")
+    for model, digest in result["missing"]:
+        print(f"❌ 缺失: {model} -> {digest}")
+    if not result["bad"] and not result["missing"]:
+        print("✅ 所有数据块完整")
+    elif result["bad"]:
+        print("损坏的数据块可删除后重新下载对应模型 (ollama pull)")
+
+def make_verify_progress():
+    """生成校验进度回调"""
+    last = [0.0]
+    
+    def progress(done_bytes, total_bytes, done, total):
+        now = time.monotonic()
+        if done == total or now - last[0] > 0.5:
+            last[0] = now
+            percent = done_bytes * 100 // max(total_bytes, 1)
+            print(f"\r  {done}/{total} 个文件  {format_bytes(done_bytes)}/{format_bytes(total_bytes)}"
+                  f"  {percent:>3}%", end="", flush=True)
+            if done == total:
+                print()
+    return progress
+
+@traced("menu.verify_store_menu")
+def verify_store_menu():
+    """校验模型数据块完整性"""
+    clear_screen()
+    print_header()
+    print("\n🔍 模型数据块完整性校验\n")
+    models_dir = get_models_dir()
+    print(f"模型存储: {models_dir}")
+    print(f"校验线程: {get_verify_workers()}\n")
+    full = input("是否忽略缓存全部重新校验? (y/N): ").strip().lower() == 'y'
+    print()
+    started = time.perf_counter()
+    try:
+        result = verify_store(models_dir, full=full, progress=make_verify_progress())
+        print()
+        print_verify_result(result, time.perf_counter() - started)
+    except KeyboardInterrupt:
+        print("\n\n🛑 校验已中断，已完成的部分已记录，下次会跳过")
+    except OSError as e:
+        print(f"\n❌ 校验失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 清理孤立数据块 ------------
+def collect_referenced_digests(models_dir):
+    """读取所有清单，返回被引用的摘要集合
+    
+    任何清单无法读取时抛出 ValueError，避免误删仍在使用的数据块。
+    """
+    referenced = set()
+    for model, manifest_path in iter_manifests(models_dir):
+        try:
+            layers = manifest_layers(load_manifest(manifest_path))
+        except (OSError, ValueError, KeyError) as e:
+            raise ValueError(f"清单 {model} 无法读取 ({e})，已停止清理")
+        referenced.update(digest.replace(":", "-") for digest, _ in layers)
+    return referenced
+
+def find_garbage(models_dir=None, min_age_hours=None):
+    """找出未被任何清单引用的数据块和残留的未完成下载文件
+    
+    最近 min_age_hours 小时内修改过的文件视为可能正在下载，不计入。
+    返回 [(路径, 大小, 类型)]，类型为 "orphan" 或 "partial"。
+    """
+    models_dir = models_dir or get_models_dir()
+    if min_age_hours is None:
+        min_age_hours = get_config()["gc"]["min_age_hours"]
+    blobs_dir = os.path.join(models_dir, "blobs")
+    referenced = collect_referenced_digests(models_dir)
+    cutoff = time.time() - min_age_hours * 3600
+    
+    garbage = []
+    for name in os.listdir(blobs_dir) if os.path.isdir(blobs_dir) else []:
+        path = os.path.join(blobs_dir, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if not os.path.isfile(path) or st.st_mtime > cutoff:
+            continue
+        if BLOB_NAME_RE.match(name):
+            if name not in referenced:
+                garbage.append((path, st.st_size, "orphan"))
+        elif "-partial" in name or name.endswith(".tmp"):
+            # ollama pull 中断留下的 -partial、-partial-N，以及导入/复制留下的临时文件
+            garbage.append((path, st.st_size, "partial"))
+    return sorted(garbage, key=lambda item: -item[1])
+
+def collect_garbage(models_dir=None, dry_run=True, min_age_hours=None):
+    """删除孤立数据块和残留文件，返回 (清单, 释放的字节数)"""
+    garbage = find_garbage(models_dir, min_age_hours)
+    freed = 0
+    for path, size, _ in garbage:
+        if not dry_run:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        freed += size
+    return garbage, freed
+
+def print_garbage(garbage, freed, dry_run):
+    """打印清理结果"""
+    labels = {"orphan": "孤立数据块", "partial": "未完成下载"}
+    for path, size, kind in garbage:
+        print(f"  {labels[kind]}  {format_bytes(size):>10}  {os.path.basename(path)}")
+    orphans = sum(size for _, size, kind in garbage if kind == "orphan")
+    partials = sum(size for _, size, kind in garbage if kind == "partial")
+    print(f"\n孤立数据块 {format_bytes(orphans)}，未完成下载 {format_bytes(partials)}")
+    print(f"{'可释放' if dry_run else '已释放'} {format_bytes(freed)} ({len(garbage)} 个文件)")
+
+@traced("menu.garbage_collect_menu")
+def garbage_collect_menu():
+    """清理孤立数据块和未完成的下载"""
+    clear_screen()
+    print_header()
+    print("\n🧹 清理孤立数据块和未完成的下载\n")
+    models_dir = get_models_dir()
+    min_age = get_config()["gc"]["min_age_hours"]
+    print(f"模型存储: {models_dir}")
+    print(f"跳过最近 {min_age} 小时内修改的文件 (可能正在下载)\n")
+    try:
+        garbage, freed = collect_garbage(models_dir, dry_run=True)
+        if not garbage:
+            print("✅ 没有需要清理的文件")
+        else:
+            print_garbage(garbage, freed, dry_run=True)
+            if not any(True for _ in iter_manifests(models_dir)):
+                print("\n⚠️  没有找到任何模型清单，所有数据块都会被删除，请确认存储目录正确")
+            if input("\n确认删除? (y/N): ").strip().lower() == 'y':
+                garbage, freed = collect_garbage(models_dir, dry_run=False)
+                print(f"✅ 已释放 {format_bytes(freed)}")
+    except (OSError, ValueError) as e:
+        print(f"❌ 清理失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 模型清单监视 ------------
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class ModelInventory:
+    """已安装模型清单，启动时扫描一次，之后根据 manifests 目录的变化增量更新
+    
+    Linux 上通过 ctypes 调用 inotify，其他平台或 inotify 不可用时按间隔比较文件状态。
+    所有 ollama 客户端（包括命令行）的拉取和删除都会被发现。
+    """
+    
+    def __init__(self, models_dir=None):
+        self.models_dir = models_dir or get_models_dir()
+        self.root = os.path.join(self.models_dir, "manifests")
+        self.models = {}         # 模型名 -> {"path", "size", "modified", "id"}
+        self.listeners = []      # 回调 (事件, 模型名)，事件为 added / updated / removed
+        self.mode = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._libc = None
+        self._fd = None
+        self._watches = {}       # inotify 监视描述符 -> 目录
+        self._stats = {}         # 轮询模式下 文件路径 -> (修改时间, 大小)
+    
+    def _model_name(self, path):
+        rel = os.path.relpath(path, self.root).split(os.sep)
+        if len(rel) < 4 or rel[-1].endswith(".tmp"):
+            return None
+        return format_model_name(rel[0], "/".join(rel[1:-2]), rel[-2], rel[-1])
+    
+    def _notify(self, event, name):
+        for listener in list(self.listeners):
+            try:
+                listener(event, name)
+            except Exception:
+                pass
+    
+    def refresh_path(self, path):
+        """重新读取一个清单文件；文件不存在时从清单中移除"""
+        name = self._model_name(path)
+        if not name:
+            return
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            manifest = json.loads(data.decode('utf-8'))
+            entry = {
+                "path": path,
+                "size": sum(size for _, size in manifest_layers(manifest)),
+                "modified": os.path.getmtime(path),
+                "id": hashlib.sha256(data).hexdigest()[:12],
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            entry = None
+        with self._lock:
+            old = self.models.get(name)
+            if entry:
+                self.models[name] = entry
+            else:
+                self.models.pop(name, None)
+        if entry and not old:
+            self._notify("added", name)
+        elif entry and old.get("id") != entry["id"]:
+            self._notify("updated", name)
+        elif not entry and old:
+            self._notify("removed", name)
+    
+    def remove_under(self, directory):
+        """目录被删除或移走时移除其下的所有模型"""
+        prefix = directory.rstrip(os.sep) + os.sep
+        with self._lock:
+            names = [n for n, e in self.models.items() if e["path"].startswith(prefix)]
+        for name in names:
+            with self._lock:
+                self.models.pop(name, None)
+            self._notify("removed", name)
+    
+    def scan(self, directory=None):
+        """扫描目录（默认整个 manifests 目录）下的清单文件"""
+        directory = directory or self.root
+        seen = set()
+        for dirpath, _, files in os.walk(directory):
+            if self.mode == "inotify":
+                self._add_watch(dirpath)
+            for name in files:
+                path = os.path.join(dirpath, name)
+                seen.add(path)
+                self.refresh_path(path)
+        if directory == self.root:
+            with self._lock:
+                stale = [e["path"] for e in self.models.values() if e["path"] not in seen]
+            for path in stale:
+                self.refresh_path(path)
+    
+    def snapshot(self):
+        """返回当前清单的副本"""
+        with self._lock:
+            return {name: dict(entry) for name, entry in self.models.items()}
+    
+    def start(self):
+        """首次扫描并启动后台监视线程"""
+        if self._thread:
+            return self
+        if platform.system() == "Linux" and os.path.isdir(self.root):
+            try:
+                self._init_inotify()
+                self.mode = "inotify"
+            except (OSError, AttributeError):
+                self.mode = "poll"
+        else:
+            self.mode = "poll"
+        self.scan()
+        target = self._inotify_loop if self.mode == "inotify" else self._poll_loop
+        self._thread = threading.Thread(target=target, name="model-inventory", daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        """停止监视线程"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+    
+    # ---- inotify ----
+    def _init_inotify(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self._libc, self._fd = libc, fd
+    
+    def _add_watch(self, directory):
+        if directory in self._watches.values():
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd >= 0:
+            self._watches[wd] = directory
+    
+    def _inotify_loop(self):
+        import select
+        while not self._stop.is_set():
+            try:
+                ready, _, _ = select.select([self._fd], [], [], 1.0)
+                if not ready:
+                    continue
+                data = os.read(self._fd, 64 * 1024)
+            except (OSError, ValueError, TypeError):
+                return
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0").decode('utf-8', 'replace')
+                offset += length
+                self._handle_event(wd, mask, name)
+    
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # 事件队列溢出时无法确定丢了什么，只能整体重新扫描
+            self.scan()
+            return
+        directory = self._watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self.remove_under(directory)
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # 新目录中的文件可能在加监视之前已经写好，需要扫描一次
+                self.scan(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_under(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+            self.refresh_path(path)
+    
+    # ---- 轮询 ----
+    def _poll_once(self):
+        current = {}
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                current[path] = (st.st_mtime_ns, st.st_size)
+        for path, signature in current.items():
+            if self._stats.get(path) != signature:
+                self.refresh_path(path)
+        for path in set(self._stats) - set(current):
+            self.refresh_path(path)
+        self._stats = current
+    
+    def _poll_loop(self):
+        interval = get_config()["watch"]["poll_interval"]
+        self._poll_once()
+        while not self._stop.wait(interval):
+            try:
+                self._poll_once()
+            except OSError:
+                pass
+
+_model_inventory = None
+
+def get_model_inventory():
+    """获取全局模型清单（首次调用时启动监视；守护进程运行时使用它的清单）"""
+    global _model_inventory
+    models_dir = get_models_dir()
+    if isinstance(_model_inventory, DaemonInventory) and get_daemon_client() is None:
+        _model_inventory = None
+    if _model_inventory is None and get_daemon_client() is not None:
+        try:
+            daemon_call("ping")
+            _model_inventory = DaemonInventory(models_dir).start()
+        except DaemonUnavailable:
+            pass
+    if _model_inventory is None or _model_inventory.models_dir != models_dir:
+        if _model_inventory:
+            _model_inventory.stop()
+        _model_inventory = ModelInventory(models_dir).start()
+    return _model_inventory
+
+@traced("menu.inventory_watch_menu")
+def inventory_watch_menu():
+    """实时显示模型清单的变化"""
+    clear_screen()
+    print_header()
+    print("\n👀 模型清单实时监视\n")
+    inventory = get_model_inventory()
+    mode = "inotify" if inventory.mode == "inotify" else f"轮询 (每 {get_config()['watch']['poll_interval']} 秒)"
+    print(f"清单目录: {inventory.root}")
+    print(f"监视方式: {mode}\n")
+    models = inventory.snapshot()
+    for name, entry in sorted(models.items()):
+        print(f"  {name:<36} {entry['id']}  {format_bytes(entry['size']):>10}")
+    print(f"\n共 {len(models)} 个模型。使用 ollama pull/rm 或其他客户端修改时会在下方显示，按 Ctrl+C 返回\n")
+    
+    labels = {"added": "➕ 新增", "updated": "🔄 更新", "removed": "➖ 删除"}
+    events = queue.Queue()
+    listener = lambda event, name: events.put((event, name))
+    inventory.listeners.append(listener)
+    try:
+        while True:
+            try:
+                event, name = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] {labels[event]} {name}"
+                  f"  (当前 {len(inventory.models)} 个模型)")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inventory.listeners.remove(listener)
+
+# ------------ 计划下载队列 ------------
+PULL_QUEUE_FILE = "pull_queue.json"
+TIME_WINDOW_RE = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$')
+
+def parse_time_window(text):
+    """解析 "01:00-06:00" 这样的时间窗口，返回 (开始分钟, 结束分钟)；空字符串表示不限时间"""
+    if not text or not text.strip():
+        return None
+    match = TIME_WINDOW_RE.match(text)
+    if not match:
+        raise ValueError(f"时间窗口格式应为 HH:MM-HH:MM: {text}")
+    h1, m1, h2, m2 = (int(g) for g in match.groups())
+    if h1 > 23 or h2 > 24 or m1 > 59 or m2 > 59:
+        raise ValueError(f"无效的时间: {text}")
+    return h1 * 60 + m1, h2 * 60 + m2
+
+def in_time_window(window, now=None):
+    """当前时间是否在窗口内（支持跨午夜，如 22:00-06:00）"""
+    bounds = parse_time_window(window)
+    if bounds is None:
+        return True
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    start, end = bounds
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+def format_rate(bytes_per_second):
+    """把字节/秒格式化为 Mbps"""
+    return f"{bytes_per_second * 8 / 1e6:.1f} Mbps"
+
+class PullScheduler:
+    """计划下载队列：按时间窗口依次拉取模型，总带宽不超过上限，队列持久化到磁盘
+    
+    ollama 的拉取接口本身不能限速，这里通过断开并稍后重新请求 /api/pull 实现占空比限速：
+    下载量超出配额时断开连接（服务端保留已下载的部分），等配额恢复后再续传。
+    同一时间只运行一个任务，所以任务的速度上限就是总带宽上限。
+    """
+    
+    BURST_SECONDS = 10   # 允许超出配额的量（秒数 × 带宽），避免频繁断开重连
+    MAX_ATTEMPTS = 3
+    RETRY_SECONDS = 30
+    
+    def __init__(self):
+        self.path = os.path.join(MANAGER_DIR, PULL_QUEUE_FILE)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.current = None      # 正在运行的任务 id
+        self.rate = 0.0          # 当前任务的实测速度（字节/秒）
+    
+    # ---- 持久化 ----
+    def load(self):
+        state = load_json_file(self.path, {}) or {}
+        state.setdefault("paused", False)
+        state.setdefault("bandwidth_limit",
+                         int(get_config()["pull"]["bandwidth_limit_mbps"] * 1e6 / 8))
+        state.setdefault("jobs", [])
+        state.setdefault("next_id", 1)
+        return state
+    
+    def update(self, change):
+        """读取-修改-写回队列文件；菜单和后台任务（可能在另一个进程）都通过这里修改
+        
+        线程锁保护本进程，锁文件保护其他进程，整个读-改-写期间持有。
+        """
+        with self._lock, file_lock(os.path.join(get_manager_dir(), PULL_QUEUE_FILE + ".lock")):
+            state = self.load()
+            result = change(state)
+            save_json_file(os.path.join(get_manager_dir(), PULL_QUEUE_FILE), state)
+            return result
+    
+    def _update_job(self, job_id, **fields):
+        def change(state):
+            for job in state["jobs"]:
+                if job["id"] == job_id:
+                    job.update(fields)
+                    return dict(job)
+        return self.update(change)
+    
+    # ---- 队列操作 ----
+    def add(self, model, window=""):
+        parse_time_window(window)
+        def change(state):
+            job = {"id": state["next_id"], "model": model, "window": window.strip(),
+                   "status": "queued", "completed": 0, "total": 0,
+                   "added": datetime.now().isoformat(timespec='seconds'),
+                   "finished": None, "error": ""}
+            state["next_id"] += 1
+            state["jobs"].append(job)
+            return job
+        return self.update(change)
+    
+    def set_job_paused(self, job_id, paused):
+        """暂停或恢复任务；恢复也用于重试失败的任务"""
+        def change(state):
+            for job in state["jobs"]:
+                if job["id"] == job_id and job["status"] != "done":
+                    job["status"] = "paused" if paused else "queued"
+                    job["error"] = ""
+                    return True
+            return False
+        return self.update(change)
+    
+    def remove(self, job_id):
+        def change(state):
+            before = len(state["jobs"])
+            state["jobs"] = [j for j in state["jobs"] if j["id"] != job_id]
+            return len(state["jobs"]) != before
+        return self.update(change)
+    
+    def clear_finished(self):
+        def change(state):
+            state["jobs"] = [j for j in state["jobs"] if j["status"] != "done"]
+        self.update(change)
+    
+    def _set(self, key, value):
+        def change(state):
+            state[key] = value
+        self.update(change)
+    
+    def set_paused(self, paused):
+        self._set("paused", paused)
+    
+    def set_bandwidth_limit(self, bytes_per_second):
+        self._set("bandwidth_limit", int(bytes_per_second))
+    
+    def next_job(self, state):
+        """按添加顺序找第一个可以运行的任务"""
+        if state["paused"]:
+            return None
+        for job in state["jobs"]:
+            if job["status"] in ("queued", "running") and in_time_window(job["window"]):
+                return job
+        return None
+    
+    # ---- 后台运行 ----
+    def worker_running(self):
+        """检查是否已有进程在运行队列（菜单和命令行不能同时下载）"""
+        pid = self.load().get("worker_pid")
+        return bool(pid) and pid != os.getpid() and _pid_alive(pid)
+    
+    def start(self):
+        if self._thread:
+            return False
+        # 检查和登记在同一次加锁的读-改-写中完成，两个进程同时启动时只有一个能登记成功
+        def claim(state):
+            pid = state.get("worker_pid")
+            if pid and pid != os.getpid() and _pid_alive(pid):
+                return False
+            state["worker_pid"] = os.getpid()
+            return True
+        if not self.update(claim):
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name="pull-scheduler", daemon=True)
+        self._thread.start()
+        return True
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+    
+    def run_forever(self):
+        try:
+            while not self._stop.is_set():
+                job = self.next_job(self.load())
+                if job is None:
+                    self._stop.wait(5)
+                    continue
+                self.run_job(job)
+        finally:
+            def release(state):
+                if state.get("worker_pid") == os.getpid():
+                    state["worker_pid"] = None
+                for job in state["jobs"]:
+                    if job["status"] == "running":
+                        job["status"] = "queued"
+            self.update(release)
+            self.current = None
+    
+    def _interrupt_reason(self, job_id):
+        """检查是否需要中断当前任务：停止、全局暂停、任务暂停或删除、离开时间窗口"""
+        if self._stop.is_set():
+            return "stop"
+        state = self.load()
+        job = next((j for j in state["jobs"] if j["id"] == job_id), None)
+        if state["paused"] or job is None or job["status"] == "paused":
+            return "paused"
+        if not in_time_window(job["window"]):
+            return "window"
+        return None
+    
+    def run_job(self, job):
+        """运行一个任务直到完成、失败或被中断"""
+        job_id, model = job["id"], job["model"]
+        self.current = job_id
+        self._update_job(job_id, status="running", error="")
+        progress = {}            # 摘要 -> 已完成字节（跨重连保留，用于计算增量）
+        tokens = 0.0
+        started = time.perf_counter()
+        last_check = last_time = time.monotonic()
+        window_bytes, window_started = 0, last_time
+        
+        while True:
+            limit = self.load()["bandwidth_limit"]
+            throttled = False
+            try:
+                for message in ollama_api_stream("/api/pull", {"model": model, "stream": True}):
+                    now = time.monotonic()
+                    digest = message.get("digest")
+                    delta = 0
+                    if digest and message.get("completed") is not None:
+                        delta = max(0, message["completed"] - progress.get(digest, 0))
+                        progress[digest] = max(progress.get(digest, 0), message["completed"])
+                        progress[digest + ":total"] = message.get("total", 0)
+                    window_bytes += delta
+                    if now - window_started >= 2:
+                        self.rate = window_bytes / (now - window_started)
+                        window_bytes, window_started = 0, now
+                    
+                    if message.get("status") == "success":
+                        self._update_job(job_id, status="done", finished=datetime.now().isoformat(
+                            timespec='seconds'), completed=self._sum(progress), total=self._sum(progress, True))
+                        record_pull_metrics(model, time.perf_counter() - started)
+                        self.current, self.rate = None, 0.0
+                        return
+                    
+                    if limit:
+                        # 令牌桶：每秒获得 limit 字节的配额，最多累积 BURST_SECONDS 秒
+                        tokens = min(tokens + (now - last_time) * limit, limit * self.BURST_SECONDS)
+                        tokens -= delta
+                    last_time = now
+                    
+                    if now - last_check >= 1:
+                        last_check = now
+                        self._update_job(job_id, completed=self._sum(progress),
+                                         total=self._sum(progress, True))
+                        reason = self._interrupt_reason(job_id)
+                        if reason:
+                            # 单独暂停的任务保持暂停，其余情况回到等待状态
+                            if self._job_status(job_id) != "paused":
+                                self._update_job(job_id, status="queued")
+                            self.current, self.rate = None, 0.0
+                            return
+                    if limit and tokens < -limit * self.BURST_SECONDS:
+                        throttled = True
+                        break
+            except OllamaAPIError as e:
+                # 夜间任务开始时服务可能还没启动，失败几次后才放弃
+                attempts = job.get("attempts", 0) + 1
+                job["attempts"] = attempts
+                failed = attempts >= self.MAX_ATTEMPTS
+                self._update_job(job_id, status="failed" if failed else "queued",
+                                 error=str(e)[:200], attempts=0 if failed else attempts)
+                self.current, self.rate = None, 0.0
+                if not failed:
+                    self._stop.wait(self.RETRY_SECONDS)
+                return
+            
+            if not throttled:
+                # 流正常结束却没有 success，视为失败
+                self._update_job(job_id, status="failed", error="拉取未完成")
+                self.current, self.rate = None, 0.0
+                return
+            # 超出配额：连接已断开，等配额恢复到零再续传
+            self.rate = 0.0
+            wait = -tokens / limit
+            if self._stop.wait(wait):
+                self._update_job(job_id, status="queued")
+                self.current = None
+                return
+            tokens += wait * limit
+            last_time = time.monotonic()
+    
+    def _job_status(self, job_id):
+        job = next((j for j in self.load()["jobs"] if j["id"] == job_id), None)
+        return job["status"] if job else None
+    
+    @staticmethod
+    def _sum(progress, totals=False):
+        if totals:
+            return sum(v for k, v in progress.items() if k.endswith(":total"))
+        return sum(v for k, v in progress.items() if not k.endswith(":total"))
+
+_pull_scheduler = None
+
+def get_pull_scheduler():
+    """获取全局下载队列"""
+    global _pull_scheduler
+    if _pull_scheduler is None:
+        _pull_scheduler = PullScheduler()
+    return _pull_scheduler
+
+def print_pull_queue(scheduler):
+    """打印队列状态"""
+    state = scheduler.load()
+    labels = {"queued": "等待", "running": "下载中", "paused": "已暂停", "done": "完成", "failed": "失败"}
+    limit = state["bandwidth_limit"]
+    print(f"带宽上限: {format_rate(limit) if limit else '不限'}    "
+          f"队列: {'已暂停' if state['paused'] else '运行'}    "
+          f"后台任务: {'运行中' if scheduler._thread or scheduler.worker_running() else '未启动'}")
+    print("-" * 72)
+    if not state["jobs"]:
+        print("  (队列为空)")
+    for job in state["jobs"]:
+        percent = f"{job['completed'] * 100 // job['total']}%" if job["total"] else "-"
+        window = job["window"] or "任意时间"
+        status = labels.get(job["status"], job["status"])
+        if job["id"] == scheduler.current and scheduler.rate:
+            status += f" {format_rate(scheduler.rate)}"
+        print(f" #{job['id']:<3} {job['model']:<24} {window:<12} {percent:>5}  {status}")
+        if job["error"]:
+            print(f"       {job['error']}")
+    print("-" * 72)
+
+@traced("menu.pull_queue_menu")
+def pull_queue_menu():
+    """计划下载队列"""
+    scheduler = get_pull_scheduler()
+    while True:
+        clear_screen()
+        print_header()
+        print("\n🗓️  计划下载队列\n")
+        print_pull_queue(scheduler)
+        print()
+        print("1. 添加任务")
+        print("2. 暂停/恢复任务 (恢复也可重试失败的任务)")
+        print("3. 删除任务")
+        print("4. 暂停/恢复整个队列")
+        print("5. 设置带宽上限")
+        print("6. 在后台开始处理队列 (管理器退出时停止)")
+        print("7. 清除已完成的任务")
+        print("8. 刷新")
+        print("0. 返回")
+        choice = input("\n请选择: ").strip()
+        try:
+            if choice == "1":
+                model = input("模型名称: ").strip()
+                if model:
+                    window = input("时间窗口 (如 01:00-06:00，直接回车不限): ").strip()
+                    job = scheduler.add(model, window)
+                    print(f"✅ 已添加任务 #{job['id']}")
+            elif choice in ("2", "3"):
+                job_id = input("任务编号: ").strip().lstrip("#")
+                if job_id.isdigit():
+                    job_id = int(job_id)
+                    if choice == "3":
+                        scheduler.remove(job_id)
+                    else:
+                        job = next((j for j in scheduler.load()["jobs"] if j["id"] == job_id), None)
+                        if job:
+                            scheduler.set_job_paused(job_id, job["status"] != "paused"
+                                                     and job["status"] != "failed")
+            elif choice == "4":
+                scheduler.set_paused(not scheduler.load()["paused"])
+            elif choice == "5":
+                value = input("带宽上限 (Mbps，0 表示不限): ").strip()
+                scheduler.set_bandwidth_limit(float(value) * 1e6 / 8)
+            elif choice == "6":
+                if not scheduler.start():
+                    print("⚠️  队列已经在处理中 (可能在另一个进程中)")
+                    time.sleep(1.5)
+            elif choice == "7":
+                scheduler.clear_finished()
+            elif choice == "0":
+                return
+            elif choice != "8":
+                print("❌ 无效选择")
+                time.sleep(1)
+                continue
+        except (ValueError, OSError) as e:
+            print(f"❌ 操作失败: {str(e)}")
+            input("\n按回车键继续...")
+
+# ------------ 模型仓库缓存代理 ------------
+DEFAULT_REGISTRY_CACHE_PORT = 9878
+REGISTRY_PATH_RE = re.compile(r'^/v2/(?P<repo>.+)/(?P<kind>manifests|blobs)/(?P<ref>[^/]+)$')
+REGISTRY_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+MANIFEST_ACCEPT = ("application/vnd.docker.distribution.manifest.v2+json, "
+                   "application/vnd.oci.image.manifest.v1+json")
+REGISTRY_CHUNK_SIZE = 1024 * 1024
+
+_registry_cache_server = None
+
+class BlobFetch:
+    """正在从上游下载的数据块
+    
+    下载线程顺序写入临时文件，同时到达的请求（包括分段 Range 请求）按已写入的字节边读边发，
+    不必等整个文件下载完。
+    """
+    
+    def __init__(self, digest, path):
+        self.digest = digest
+        self.path = path
+        self.partial = path + "-partial"
+        self.size = None
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+    
+    def wait(self, predicate):
+        with self.cond:
+            while not predicate() and not self.done and self.error is None:
+                self.cond.wait(1.0)
+            if self.error is not None:
+                raise OSError(self.error)
+    
+    def wait_size(self):
+        self.wait(lambda: self.size is not None)
+        return self.size
+    
+    def wait_bytes(self, offset):
+        """等待 offset 处的数据写入，返回当前已写入的字节数"""
+        self.wait(lambda: self.written > offset)
+        return self.written
+
+class RegistryCache:
+    """拉取缓存：按摘要在磁盘上保存数据块，超出容量时淘汰最久未使用的
+    
+    同一个数据块同时被多个节点请求时只向上游下载一次。清单按标签缓存一段时间，
+    上游不可用时继续使用旧的清单；按摘要请求的清单和数据块内容不会变化，可以一直使用。
+    """
+    
+    def __init__(self, cache_dir=None, upstream=None, max_bytes=None, manifest_ttl=None):
+        settings = get_config()["registry_cache"]
+        self.cache_dir = os.path.expanduser(cache_dir or settings["dir"]
+                                            or os.path.join(MANAGER_DIR, "registry_cache"))
+        self.upstream = (upstream or settings["upstream"]).rstrip("/")
+        self.max_bytes = max_bytes if max_bytes is not None else int(settings["max_gb"] * GB)
+        self.manifest_ttl = manifest_ttl if manifest_ttl is not None else settings["manifest_ttl"]
+        self.blobs_dir = os.path.join(self.cache_dir, "blobs")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._fetches = {}              # 摘要 -> BlobFetch
+        self._sizes = {}                # 清单中记录的数据块大小，HEAD 请求时不必问上游
+        self._lru = OrderedDict()       # 摘要 -> 大小，最近使用的在末尾
+        self.total = 0
+        self.reserved = 0               # 正在下载的数据块预留的空间
+        self._load_lru()
+    
+    def _load_lru(self):
+        """按修改时间恢复使用顺序（每次命中都会更新修改时间）"""
+        entries = []
+        for name in os.listdir(self.blobs_dir):
+            match = BLOB_NAME_RE.match(name)
+            path = os.path.join(self.blobs_dir, name)
+            if not match:
+                if name.endswith("-partial"):
+                    os.remove(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, "sha256:" + match.group(1), st.st_size))
+        for _, digest, size in sorted(entries):
+            self._lru[digest] = size
+            self.total += size
+    
+    def _touch(self, digest):
+        with self._lock:
+            if digest in self._lru:
+                self._lru.move_to_end(digest)
+        try:
+            os.utime(get_blob_path(self.cache_dir, digest))
+        except OSError:
+            pass
+    
+    def _make_room(self, size):
+        """淘汰最久未使用的数据块，直到能放下 size 字节，并为它预留空间
+        
+        正在下载的数据块也计入占用，多个同时未命中的下载不会让缓存超出容量；
+        正在下载的不能淘汰，实在放不下时抛出 OSError。
+        """
+        with self._lock:
+            while self._lru and self.total + self.reserved + size > self.max_bytes:
+                digest, old_size = self._lru.popitem(last=False)
+                self.total -= old_size
+                try:
+                    os.remove(get_blob_path(self.cache_dir, digest))
+                except OSError:
+                    pass
+                metric_inc("ollama_manager_registry_cache_evictions_total")
+            if self.total + self.reserved + size > self.max_bytes:
+                raise OSError(f"缓存空间不足: 需要 {format_bytes(size)}，"
+                              f"正在下载的数据块已占用 {format_bytes(self.reserved)}")
+            self.reserved += size
+    
+    def upstream_open(self, path, method="GET", accept=None):
+        """请求上游仓库（自动跟随跳转到 CDN）"""
+        request = urllib.request.Request(self.upstream + path, method=method)
+        if accept:
+            request.add_header("Accept", accept)
+        return urllib.request.urlopen(request, timeout=get_timeout("api"))
+    
+    # ---- 清单 ----
+    def get_manifest(self, repo, ref):
+        """返回 (清单内容, Content-Type)"""
+        path = os.path.join(self.cache_dir, "manifests", *repo.split("/"), ref.replace(":", "-"))
+        cached = load_json_file(path)
+        immutable = ref.startswith("sha256:")
+        if cached and (immutable or time.time() - cached["fetched"] < self.manifest_ttl):
+            metric_inc("ollama_manager_registry_cache_requests_total", {"kind": "manifest", "result": "hit"})
+            body = cached["body"].encode('utf-8')
+        else:
+            try:
+                with self.upstream_open(f"/v2/{repo}/manifests/{ref}", accept=MANIFEST_ACCEPT) as response:
+                    body = response.read()
+                    content_type = response.headers.get("Content-Type", "application/json")
+                cached = {"fetched": time.time(), "content_type": content_type,
+                          "body": body.decode('utf-8')}
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                save_json_file(path, cached)
+                metric_inc("ollama_manager_registry_cache_requests_total", {"kind": "manifest", "result": "miss"})
+            except OSError as e:
+                # 4xx 是上游的明确答复（如标签不存在），直接返回给客户端；
+                # 5xx 和网络错误表示上游不可用，有旧清单时继续使用
+                if not cached or (isinstance(e, urllib.error.HTTPError) and e.code < 500):
+                    raise
+                body = cached["body"].encode('utf-8')
+                metric_inc("ollama_manager_registry_cache_requests_total", {"kind": "manifest", "result": "stale"})
+        try:
+            for digest, size in manifest_layers(json.loads(body)):
+                self._sizes[digest] = size
+        except (ValueError, AttributeError):
+            pass
+        return body, cached["content_type"]
+    
+    # ---- 数据块 ----
+    def blob_size(self, repo, digest):
+        """数据块大小：已缓存的文件、正在下载的任务、清单中的记录，最后才问上游"""
+        path = get_blob_path(self.cache_dir, digest)
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        with self._lock:
+            fetch = self._fetches.get(digest)
+        if fetch and fetch.size is not None:
+            return fetch.size
+        if digest in self._sizes:
+            return self._sizes[digest]
+        with self.upstream_open(f"/v2/{repo}/blobs/{digest}", method="HEAD") as response:
+            return int(response.headers["Content-Length"])
+    
+    def open_blob(self, repo, digest):
+        """返回 (路径, None) 表示已缓存，或 (None, BlobFetch) 表示正在下载"""
+        path = get_blob_path(self.cache_dir, digest)
+        with self._lock:
+            fetch = self._fetches.get(digest)
+            if fetch is not None:
+                result = "shared"
+            elif not os.path.isfile(path):
+                fetch = self._fetches[digest] = BlobFetch(digest, path)
+                threading.Thread(target=self._download, args=(repo, fetch),
+                                 name="registry-fetch", daemon=True).start()
+                result = "miss"
+        if fetch:
+            metric_inc("ollama_manager_registry_cache_requests_total", {"kind": "blob", "result": result})
+            return None, fetch
+        self._touch(digest)
+        metric_inc("ollama_manager_registry_cache_requests_total", {"kind": "blob", "result": "hit"})
+        return path, None
+    
+    def _download(self, repo, fetch):
+        """从上游下载数据块，边下载边校验摘要，完成后改名为正式文件"""
+        expected = fetch.digest.split(":", 1)[1]
+        reserved = 0
+        try:
+            with self.upstream_open(f"/v2/{repo}/blobs/{fetch.digest}") as response:
+                size = int(response.headers.get("Content-Length") or self._sizes.get(fetch.digest, 0))
+                self._make_room(size)
+                reserved = size
+                hasher = hashlib.sha256()
+                with open(fetch.partial, 'wb') as f:
+                    with fetch.cond:
+                        fetch.size = size
+                        fetch.cond.notify_all()
+                    while True:
+                        chunk = response.read(REGISTRY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        f.flush()
+                        hasher.update(chunk)
+                        metric_inc("ollama_manager_registry_cache_upstream_bytes_total", value=len(chunk))
+                        with fetch.cond:
+                            fetch.written += len(chunk)
+                            fetch.cond.notify_all()
+            if fetch.written != size or hasher.hexdigest() != expected:
+                raise OSError(f"数据块 {fetch.digest} 校验失败")
+            os.replace(fetch.partial, fetch.path)
+            with self._lock:
+                self._lru[fetch.digest] = size
+                self.total += size
+                self.reserved -= reserved
+                self._fetches.pop(fetch.digest, None)
+            with fetch.cond:
+                fetch.done = True
+                fetch.cond.notify_all()
+        except Exception as e:
+            with self._lock:
+                self.reserved -= reserved
+                self._fetches.pop(fetch.digest, None)
+            with fetch.cond:
+                fetch.error = str(e) or type(e).__name__
+                fetch.cond.notify_all()
+            try:
+                os.remove(fetch.partial)
+            except OSError:
+                pass
+
+class RegistryCacheHandler(http.server.BaseHTTPRequestHandler):
+    """实现 ollama 拉取所需的 /v2 仓库接口（清单、数据块、Range 分段）"""
+    
+    protocol_version = "HTTP/1.1"
+    
+    def do_GET(self):
+        self.handle_request(head=False)
+    
+    def do_HEAD(self):
+        self.handle_request(head=True)
+    
+    def send_json(self, status, payload, head=False):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+    
+    def handle_request(self, head):
+        cache = self.server.cache
+        path = urllib.parse.urlsplit(self.path).path
+        if path in ("/v2", "/v2/"):
+            self.send_json(200, {}, head)
+            return
+        match = REGISTRY_PATH_RE.match(path)
+        if not match or ".." in match.group("repo").split("/"):
+            self.send_json(404, {"errors": [{"code": "NOT_FOUND", "message": "not found"}]}, head)
+            return
+        repo, kind, ref = match.group("repo"), match.group("kind"), match.group("ref")
+        self.body_started = False
+        try:
+            if kind == "manifests":
+                body, content_type = cache.get_manifest(repo, ref)
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Docker-Content-Digest", "sha256:" + hashlib.sha256(body).hexdigest())
+                self.end_headers()
+                self.body_started = True
+                if not head:
+                    self.wfile.write(body)
+            elif not BLOB_NAME_RE.match(ref):
+                self.send_json(400, {"errors": [{"code": "DIGEST_INVALID", "message": ref}]}, head)
+            elif head:
+                size = cache.blob_size(repo, ref)
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Docker-Content-Digest", ref)
+                self.end_headers()
+            else:
+                self.send_blob(cache, repo, ref)
+        except (OSError, ValueError) as e:
+            if self.body_started:
+                # 响应头已经发出，不能再改成错误响应；断开连接让客户端按长度不足重试
+                self.close_connection = True
+            elif isinstance(e, urllib.error.HTTPError):
+                self.send_json(e.code, {"errors": [{"code": "UPSTREAM", "message": str(e.reason)}]}, head)
+            else:
+                self.send_json(502, {"errors": [{"code": "UPSTREAM", "message": str(e)}]}, head)
+    
+    def send_blob(self, cache, repo, digest):
+        path, fetch = cache.open_blob(repo, digest)
+        size = os.path.getsize(path) if path else fetch.wait_size()
+        start, end = 0, size - 1
+        match = REGISTRY_RANGE_RE.match(self.headers.get("Range", "").strip())
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        length = end - start + 1
+        self.send_header("Content-Length", str(length))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Docker-Content-Digest", digest)
+        self.end_headers()
+        self.body_started = True
+        self.wfile.flush()
+        metric_inc("ollama_manager_registry_cache_served_bytes_total", value=length)
+        
+        if path:
+            # 已缓存：用 sendfile 直接从页缓存发送
+            with open(path, 'rb') as f:
+                self.connection.sendfile(f, start, length)
+            return
+        try:
+            f = open(fetch.partial, 'rb')
+        except FileNotFoundError:
+            # 下载刚好完成并已改名
+            f = open(fetch.path, 'rb')
+        with f:
+            position = start
+            while position <= end:
+                available = fetch.wait_bytes(position)
+                f.seek(position)
+                data = f.read(min(available, end + 1, position + REGISTRY_CHUNK_SIZE) - position)
+                if not data:
+                    raise OSError("数据块比声明的短")
+                self.wfile.write(data)
+                position += len(data)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_registry_cache(port=DEFAULT_REGISTRY_CACHE_PORT, bind="0.0.0.0", **options):
+    """在后台线程启动仓库缓存代理"""
+    global _registry_cache_server
+    if _registry_cache_server is None:
+        server = http.server.ThreadingHTTPServer((bind, port), RegistryCacheHandler)
+        server.daemon_threads = True
+        server.cache = RegistryCache(**options)
+        threading.Thread(target=server.serve_forever, name="registry-cache", daemon=True).start()
+        _registry_cache_server = server
+    return _registry_cache_server
+
+def stop_registry_cache():
+    """停止仓库缓存代理"""
+    global _registry_cache_server
+    if _registry_cache_server is not None:
+        _registry_cache_server.shutdown()
+        _registry_cache_server.server_close()
+        _registry_cache_server = None
+
+def print_registry_cache_usage(port):
+    """打印其他节点的使用方法"""
+    print("\n其他节点通过缓存拉取 (http 需要 --insecure):")
+    print(f"  ollama pull --insecure <本机地址>:{port}/library/llama3.2:1b")
+    print(f"  ollama cp <本机地址>:{port}/library/llama3.2:1b llama3.2:1b   # 可选：改回常用名称")
+
+@traced("menu.registry_cache_menu")
+def registry_cache_menu():
+    """模型仓库缓存代理"""
+    clear_screen()
+    print_header()
+    print("\n🗄️  模型仓库缓存代理 (供局域网内其他节点拉取)\n")
+    
+    if _registry_cache_server is not None:
+        cache = _registry_cache_server.cache
+        host, port = _registry_cache_server.server_address[:2]
+        print(f"✅ 缓存代理运行中: http://{host}:{port}  上游 {cache.upstream}")
+        print(f"   缓存 {len(cache._lru)} 个数据块，{format_bytes(cache.total)} / {format_bytes(cache.max_bytes)}")
+        print_registry_cache_usage(port)
+        if input("\n是否停止缓存代理? (y/N): ").strip().lower() in ['y', 'yes']:
+            stop_registry_cache()
+            print("🛑 缓存代理已停止")
+        input("\n按回车键返回...")
+        return
+    
+    settings = get_config()["registry_cache"]
+    try:
+        port = int(input(f"监听端口 (默认 {DEFAULT_REGISTRY_CACHE_PORT}): ").strip()
+                   or DEFAULT_REGISTRY_CACHE_PORT)
+    except ValueError:
+        print("❌ 请输入数字")
+        input("\n按回车键返回...")
+        return
+    upstream = input(f"上游仓库 (默认 {settings['upstream']}): ").strip() or None
+    
+    try:
+        server = start_registry_cache(port, "0.0.0.0", upstream=upstream)
+        print(f"\n✅ 缓存代理已启动: http://0.0.0.0:{port}")
+        print(f"   缓存目录 {server.cache.cache_dir}，容量 {format_bytes(server.cache.max_bytes)}")
+        print_registry_cache_usage(port)
+        print(f"\n如需无人值守运行: python {os.path.basename(__file__)} registry-cache --port {port}")
+    except OSError as e:
+        print(f"\n❌ 启动失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 管理器守护进程 ------------
+DAEMON_STREAM_METHOD = "stream.message"
+DAEMON_KEEPALIVE_METHOD = "keepalive"
+DAEMON_KEEPALIVE_SECONDS = 5    # 请求在守护进程的调度队列中等待时，每隔这么久通知客户端一次
+DAEMON_RETRY_SECONDS = 10
+RPC_API_ERROR = -32000
+
+_DAEMON_MODE = False            # 当前进程就是守护进程时为 True，API 调用不再转发
+_daemon_local = threading.local()
+_daemon_probe = {"failed_at": 0.0}
+_manager_daemon = None
+
+class DaemonUnavailable(Exception):
+    """守护进程不可用（未启动或连接中断），调用方应改为直接访问"""
+
+class DaemonReplyLost(DaemonUnavailable):
+    """请求已发给守护进程，但没有收到结果（超时或连接中断）
+    
+    守护进程可能仍在执行这个请求，推理和修改类调用不能再直接重发，应按 API 错误处理。
+    """
+
+class DaemonRPCError(Exception):
+    """守护进程返回的错误"""
+    
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+def get_daemon_socket_path():
+    """守护进程的 Unix 套接字路径"""
+    return os.path.expanduser(get_config()["daemon"]["socket"]
+                              or os.path.join(MANAGER_DIR, "manager.sock"))
+
+class DaemonClient:
+    """JSON-RPC 客户端：每行一个 JSON 消息，一个连接可以连续发送多个请求"""
+    
+    def __init__(self, path=None, timeout=None):
+        if not hasattr(socket, "AF_UNIX"):
+            raise DaemonUnavailable("当前平台不支持 Unix 套接字")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout or get_timeout("stream"))
+        try:
+            self.sock.connect(path or get_daemon_socket_path())
+        except OSError as e:
+            self.sock.close()
+            raise DaemonUnavailable(str(e)) from e
+        self.file = self.sock.makefile('rwb')
+        self.broken = False
+        self._next_id = 0
+    
+    def _send(self, method, params):
+        self._next_id += 1
+        request = {"jsonrpc": "2.0", "id": self._next_id, "method": method, "params": params}
+        try:
+            self.file.write(json.dumps(request, ensure_ascii=False).encode('utf-8') + b"\n")
+            self.file.flush()
+        except OSError as e:
+            self.close()
+            raise DaemonUnavailable(str(e)) from e
+        return self._next_id
+    
+    def _receive(self):
+        try:
+            line = self.file.readline()
+        except OSError as e:
+            self.close()
+            raise DaemonReplyLost(str(e)) from e
+        if not line:
+            self.close()
+            raise DaemonReplyLost("守护进程关闭了连接")
+        return json.loads(line)
+    
+    @staticmethod
+    def _result(response):
+        if "error" in response:
+            error = response["error"]
+            if error.get("code") == RPC_API_ERROR:
+                raise OllamaAPIError(error.get("message", ""))
+            raise DaemonRPCError(error.get("code"), error.get("message", ""))
+        return response.get("result")
+    
+    def call(self, rpc_method, **params):
+        request_id = self._send(rpc_method, params)
+        while True:
+            response = self._receive()
+            # 排队期间的保活通知只用于重置超时
+            if response.get("id") == request_id:
+                return self._result(response)
+    
+    def stream(self, rpc_method, **params):
+        """流式调用：逐条产出通知中的消息，直到收到最终结果"""
+        request_id = self._send(rpc_method, params)
+        completed = False
+        try:
+            while True:
+                response = self._receive()
+                if response.get("method") == DAEMON_STREAM_METHOD:
+                    yield response["params"]["message"]
+                elif response.get("id") == request_id:
+                    completed = True
+                    self._result(response)
+                    return
+        finally:
+            # 提前停止时连接里还有未读的消息，直接断开（守护进程随之取消上游请求）
+            if not completed:
+                self.close()
+    
+    def close(self):
+        self.broken = True
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+def get_daemon_client():
+    """守护进程在运行时返回当前线程的客户端，否则返回 None
+    
+    连接失败后 DAEMON_RETRY_SECONDS 秒内不再尝试，避免每次 API 调用都去连接。
+    """
+    if _DAEMON_MODE or not get_config()["daemon"]["use"] or not hasattr(socket, "AF_UNIX"):
+        return None
+    client = getattr(_daemon_local, "client", None)
+    if client is not None and not client.broken:
+        return client
+    if time.monotonic() - _daemon_probe["failed_at"] < DAEMON_RETRY_SECONDS:
+        return None
+    if not os.path.exists(get_daemon_socket_path()):
+        _daemon_probe["failed_at"] = time.monotonic()
+        return None
+    try:
+        client = _daemon_local.client = DaemonClient()
+        return client
+    except DaemonUnavailable:
+        _daemon_probe["failed_at"] = time.monotonic()
+        return None
+
+def daemon_call(rpc_method, **params):
+    """通过守护进程调用；守护进程不可用时抛出 DaemonUnavailable"""
+    client = get_daemon_client()
+    if client is None:
+        raise DaemonUnavailable("守护进程未运行")
+    try:
+        return client.call(rpc_method, **params)
+    except DaemonUnavailable:
+        _daemon_probe["failed_at"] = time.monotonic()
+        raise
+
+def daemon_api(client, path, payload, method, timeout, base_url):
+    """通过守护进程转发 ollama_api 调用
+    
+    只有请求没能发出时才抛出 DaemonUnavailable（调用方可以改为直接请求）；
+    发出后超时或断开抛出 OllamaAPIError，避免同一请求执行两次。
+    在守护进程中排队的时间不计入超时（排队期间会定期收到保活通知）。
+    """
+    client.sock.settimeout((timeout or get_timeout("api")) + DAEMON_RETRY_SECONDS)
+    with trace_span(f"api {path} (daemon)"):
+        try:
+            return client.call("api", path=path, payload=payload, method=method,
+                               timeout=timeout, base_url=base_url, priority=current_priority())
+        except DaemonReplyLost as e:
+            _daemon_probe["failed_at"] = time.monotonic()
+            raise OllamaAPIError(f"守护进程未返回结果: {e}") from e
+
+def daemon_stream(client, path, payload, timeout, base_url):
+    """通过守护进程转发流式调用
+    
+    只有请求没能发出时才抛出 DaemonUnavailable（调用方可以改为直接请求），
+    发出后断开按 API 错误处理，避免重复生成。
+    """
+    client.sock.settimeout(timeout or get_timeout("stream"))
+    messages = client.stream("api_stream", path=path, payload=payload,
+                             timeout=timeout, base_url=base_url, priority=current_priority())
+    try:
+        yield from messages
+    except DaemonReplyLost as e:
+        _daemon_probe["failed_at"] = time.monotonic()
+        raise OllamaAPIError(f"读取流式响应失败: {e}") from e
+
+def get_server_status():
+    """服务状态 {up, version, loaded}；守护进程运行时使用它定期刷新的结果，不再各自轮询"""
+    try:
+        return daemon_call("status")
+    except DaemonUnavailable:
+        pass
+    up, version = check_server_alive(timeout=1)
+    loaded = []
+    if up:
+        try:
+            loaded = ollama_api("/api/ps", timeout=2).get("models", [])
+        except OllamaAPIError:
+            pass
+    return {"up": up, "version": version, "loaded": loaded}
+
+class DaemonInventory:
+    """客户端使用的模型清单代理，数据来自守护进程中的 ModelInventory"""
+    
+    mode = "daemon"
+    
+    def __init__(self, models_dir):
+        self.models_dir = models_dir
+        self.root = os.path.join(models_dir, "manifests")
+        self.listeners = []
+        self._thread = None
+        self._fallback = None
+    
+    def snapshot(self):
+        try:
+            return daemon_call("inventory")
+        except DaemonUnavailable:
+            # 守护进程中途退出时改为本地监视
+            if self._fallback is None:
+                self._fallback = ModelInventory(self.models_dir).start()
+            return self._fallback.snapshot()
+    
+    @property
+    def models(self):
+        return self.snapshot()
+    
+    def start(self):
+        # 有监听者时按秒比较快照，产生与本地监视相同的事件
+        def poll():
+            previous = self.snapshot()
+            while True:
+                time.sleep(1)
+                if not self.listeners:
+                    continue
+                current = self.snapshot()
+                for name in current.keys() - previous.keys():
+                    self._notify("added", name)
+                for name in previous.keys() - current.keys():
+                    self._notify("removed", name)
+                for name in current.keys() & previous.keys():
+                    if current[name]["id"] != previous[name]["id"]:
+                        self._notify("updated", name)
+                previous = current
+        self._thread = threading.Thread(target=poll, name="daemon-inventory", daemon=True)
+        self._thread.start()
+        return self
+    
+    def _notify(self, event, name):
+        for listener in list(self.listeners):
+            try:
+                listener(event, name)
+            except Exception:
+                pass
+    
+    def stop(self):
+        if self._fallback:
+            self._fallback.stop()
+
+# ---- 守护进程端 ----
+def _rpc_ping(daemon, params):
+    return {"pid": os.getpid(), "started": daemon.started, "uptime": time.time() - daemon.started,
+            "clients": daemon.clients, "requests": daemon.requests, "socket": daemon.path,
+            "max_in_flight": REQUEST_SCHEDULER.limit(), "scheduler": REQUEST_SCHEDULER.snapshot()}
+
+def _rpc_status(daemon, params):
+    with daemon.lock:
+        return dict(daemon.status)
+
+def _rpc_inventory(daemon, params):
+    return get_model_inventory().snapshot()
+
+def _rpc_api(daemon, params):
+    with request_priority(params.get("priority", PRIORITY_INTERACTIVE)):
+        return ollama_api(params["path"], params.get("payload"), params.get("method"),
+                          params.get("timeout"), params.get("base_url"))
+
+def _rpc_pull_queue(daemon, params):
+    scheduler = get_pull_scheduler()
+    state = scheduler.load()
+    state.update(current=scheduler.current, rate=scheduler.rate)
+    return state
+
+def _rpc_pull_add(daemon, params):
+    return get_pull_scheduler().add(params["model"], params.get("window", ""))
+
+def _rpc_metrics(daemon, params):
+    return render_metrics(collect_server_metrics())
+
+def _rpc_shutdown(daemon, params):
+    threading.Thread(target=daemon.stop, daemon=True).start()
+    return True
+
+RPC_METHODS = {
+    "ping": _rpc_ping,
+    "status": _rpc_status,
+    "inventory": _rpc_inventory,
+    "api": _rpc_api,
+    "pull_queue": _rpc_pull_queue,
+    "pull_add": _rpc_pull_add,
+    "metrics": _rpc_metrics,
+    "shutdown": _rpc_shutdown,
+}
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """处理一个客户端连接上的全部请求"""
+    
+    def setup(self):
+        super().setup()
+        self._send_lock = threading.Lock()
+    
+    def send(self, message):
+        with self._send_lock:
+            self.wfile.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b"\n")
+            self.wfile.flush()
+    
+    @contextlib.contextmanager
+    def keepalive(self, request_id):
+        """请求在调度队列中等待时定期发送保活通知，客户端的超时不计入排队时间"""
+        queued = threading.Event()
+        done = threading.Event()
+        
+        def run():
+            while not done.wait(DAEMON_KEEPALIVE_SECONDS):
+                if queued.is_set():
+                    try:
+                        self.send({"jsonrpc": "2.0", "method": DAEMON_KEEPALIVE_METHOD,
+                                   "params": {"id": request_id}})
+                    except OSError:
+                        return
+        
+        def on_queue(waiting):
+            if not waiting:
+                queued.clear()
+            elif not queued.is_set():
+                queued.set()
+                if not hasattr(on_queue, "thread"):
+                    on_queue.thread = threading.Thread(target=run, name="daemon-keepalive", daemon=True)
+                    on_queue.thread.start()
+        
+        try:
+            with queue_listener(on_queue):
+                yield
+        finally:
+            done.set()
+    
+    def handle(self):
+        daemon = self.server.manager
+        with daemon.lock:
+            daemon.clients += 1
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    request_id, method = request.get("id"), request.get("method")
+                    params = request.get("params") or {}
+                except (ValueError, AttributeError):
+                    self.send({"jsonrpc": "2.0", "id": None,
+                               "error": {"code": -32700, "message": "无法解析请求"}})
+                    continue
+                with daemon.lock:
+                    daemon.requests += 1
+                try:
+                    if not isinstance(params, dict):
+                        raise TypeError("params 必须是对象")
+                    if method == "api_stream":
+                        # 客户端断开时立即关闭流，释放调度名额并让服务端取消生成
+                        messages = ollama_api_stream(params["path"], params.get("payload"),
+                                                     params.get("timeout"), params.get("base_url"))
+                        with request_priority(params.get("priority", PRIORITY_INTERACTIVE)), \
+                                self.keepalive(request_id), contextlib.closing(messages):
+                            for message in messages:
+                                self.send({"jsonrpc": "2.0", "method": DAEMON_STREAM_METHOD,
+                                           "params": {"id": request_id, "message": message}})
+                        result = None
+                    elif method in RPC_METHODS:
+                        with self.keepalive(request_id):
+                            result = RPC_METHODS[method](daemon, params)
+                    else:
+                        self.send({"jsonrpc": "2.0", "id": request_id,
+                                   "error": {"code": -32601, "message": f"未知方法: {method}"}})
+                        continue
+                    self.send({"jsonrpc": "2.0", "id": request_id, "result": result})
+                except OllamaAPIError as e:
+                    self.send({"jsonrpc": "2.0", "id": request_id,
+                               "error": {"code": RPC_API_ERROR, "message": str(e)}})
+                except (KeyError, TypeError) as e:
+                    # 缺少参数或参数类型不对，不能让处理线程退出
+                    self.send({"jsonrpc": "2.0", "id": request_id,
+                               "error": {"code": -32602, "message": f"参数无效: {e}"}})
+                except (OSError, ValueError) as e:
+                    if isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                        return
+                    self.send({"jsonrpc": "2.0", "id": request_id,
+                               "error": {"code": -32603, "message": str(e)}})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with daemon.lock:
+                daemon.clients -= 1
+
+class ManagerDaemon:
+    """管理器守护进程：集中运行连接池、模型清单监视、下载队列和服务状态轮询
+    
+    菜单和命令行检测到守护进程后，API 调用、服务状态和模型清单都通过它获取。
+    """
+    
+    def __init__(self, path=None):
+        self.path = path or get_daemon_socket_path()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.requests = 0
+        self.status = {"up": False, "version": "", "loaded": [], "checked": 0.0}
+        self.server = None
+        self._stop = threading.Event()
+    
+    def _poll_status(self):
+        interval = get_config()["daemon"]["status_interval"]
+        while not self._stop.is_set():
+            up, version = check_server_alive(timeout=2)
+            loaded = []
+            if up:
+                try:
+                    loaded = ollama_api("/api/ps", timeout=5).get("models", [])
+                except OllamaAPIError:
+                    pass
+            with self.lock:
+                self.status = {"up": up, "version": version, "loaded": loaded, "checked": time.time()}
+            self._stop.wait(interval)
+    
+    def start(self):
+        """启动套接字服务和后台任务；已有守护进程在运行时抛出 RuntimeError"""
+        global _DAEMON_MODE
+        if os.path.exists(self.path):
+            try:
+                DaemonClient(self.path, timeout=2).call("ping")
+                raise RuntimeError(f"守护进程已在运行: {self.path}")
+            except (DaemonUnavailable, DaemonRPCError, ValueError):
+                os.remove(self.path)   # 上次异常退出留下的套接字文件
+        _DAEMON_MODE = True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, DaemonRequestHandler)
+        self.server.daemon_threads = True
+        self.server.manager = self
+        os.chmod(self.path, int(get_config()["daemon"]["socket_mode"], 8))
+        get_model_inventory()
+        get_pull_scheduler().start()
+        threading.Thread(target=self._poll_status, name="daemon-status", daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, name="daemon-rpc", daemon=True).start()
+        return self
+    
+    def wait(self):
+        while not self._stop.wait(3600):
+            pass
+    
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        get_pull_scheduler().stop()
+        # 最后才唤醒 wait()，否则进程可能在清理完成前退出
+        self._stop.set()
+
+def start_daemon_background():
+    """在后台启动独立的守护进程，输出写入日志文件"""
+    log_path = os.path.join(get_manager_dir(), "daemon.log")
+    with open(log_path, 'ab') as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "daemon", "start"],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+    _daemon_probe["failed_at"] = 0.0
+    return log_path
+
+@traced("menu.daemon_menu")
+def daemon_menu():
+    """管理器守护进程"""
+    clear_screen()
+    print_header()
+    print("\n🛰️  管理器守护进程\n")
+    if not hasattr(socket, "AF_UNIX"):
+        print("❌ 当前平台不支持 Unix 套接字，无法使用守护进程")
+        input("\n按回车键返回...")
+        return
+    print(f"套接字: {get_daemon_socket_path()}\n")
+    _daemon_probe["failed_at"] = 0.0
+    try:
+        info = daemon_call("ping")
+        status = daemon_call("status")
+        print(f"✅ 守护进程运行中 (PID {info['pid']}，已运行 {info['uptime'] / 60:.0f} 分钟)")
+        print(f"   当前连接 {info['clients']} 个，累计请求 {info['requests']} 次")
+        print(f"   Ollama 服务: {'运行中 v' + status['version'] if status['up'] else '未运行'}，"
+              f"已加载 {len(status['loaded'])} 个模型")
+        print("   本程序的 API 调用、服务状态和模型清单都通过守护进程获取")
+        if input("\n是否停止守护进程? (y/N): ").strip().lower() in ['y', 'yes']:
+            daemon_call("shutdown")
+            print("🛑 已发送停止请求")
+    except DaemonUnavailable:
+        print("守护进程未运行。启动后多个终端的管理器共享连接池、模型清单、下载队列和指标。")
+        if input("\n是否在后台启动守护进程? (y/N): ").strip().lower() in ['y', 'yes']:
+            log_path = start_daemon_background()
+            time.sleep(1)
+            print(f"✅ 已启动，日志: {log_path}")
+        print(f"如需随系统运行: python {os.path.basename(__file__)} daemon start")
+        if get_config()["daemon"]["socket_mode"] == "600":
+            print("其他用户也要使用时，在配置文件中把 daemon.socket 设为组可写目录中的路径"
+                  "（如 /run/ollama-manager/manager.sock），daemon.socket_mode 设为 660")
+    except (DaemonRPCError, OllamaAPIError) as e:
+        print(f"❌ 请求失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 负载测试 ------------
+LOADTEST_MAX_WORKERS = 256       # 开环模式下同时在途请求的上限（超出后在本地排队，排队时间计入延迟）
+LOADTEST_ERROR_PAUSE = 0.1       # 闭环模式下请求失败后的等待时间，避免服务不可用时空转
+LOADTEST_DEFAULT_PROMPTS = [
+    # (权重, 提示词)：短问答为主，夹杂较长的生成任务
+    (5, "用一句话介绍你自己。"),
+    (3, "解释一下什么是向量数据库，以及它适合哪些场景。"),
+    (2, "写一段 Python 代码，读取 CSV 文件并统计每一列的平均值，并解释关键步骤。"),
+    (1, "请写一篇约 500 字的短文，讨论本地部署大语言模型的优点和需要注意的问题。"),
+]
+LOADTEST_PERCENTILES = (50, 90, 99, 99.9)
+
+class LatencyHistogram:
+    """HDR 风格的对数-线性直方图（微秒精度，相对误差约 1.6%）
+    
+    每个 2 的幂区间再等分为 64 格，内存占用与样本数无关，可以合并，
+    百分位从计数直接算出，不需要保存全部样本。
+    """
+    
+    SUB_BUCKET_BITS = 7
+    HALF = 1 << (SUB_BUCKET_BITS - 1)
+    
+    def __init__(self):
+        self.counts = {}     # 格子序号 -> 计数
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+    
+    def _index(self, micros):
+        bucket = max(0, micros.bit_length() - self.SUB_BUCKET_BITS)
+        return bucket * self.HALF + (micros >> bucket)
+    
+    def _value(self, index):
+        """格子对应区间的上界（秒）"""
+        bucket = max(0, index // self.HALF - 1)
+        sub = index - bucket * self.HALF
+        return (((sub + 1) << bucket) - 1) / 1e6
+    
+    def record(self, seconds):
+        index = self._index(max(0, int(seconds * 1e6)))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+    
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+    
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(pct / 100.0 * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
+    
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+    
+    def summary(self):
+        """{"p50", "p90", "p99", "p99.9", "mean", "max"}（秒）"""
+        result = {f"p{pct:g}": self.percentile(pct) for pct in LOADTEST_PERCENTILES}
+        result.update(mean=self.mean(), max=self.max)
+        return result
+
+def load_prompt_distribution(path=None):
+    """读取提示词分布，返回 (提示词列表, 权重列表)
+    
+    文件每行一个提示词，可以写成 "权重<Tab>提示词"；未指定文件时使用内置的混合分布。
+    """
+    if not path:
+        return [p for _, p in LOADTEST_DEFAULT_PROMPTS], [w for w, _ in LOADTEST_DEFAULT_PROMPTS]
+    prompts, weights = [], []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            weight, sep, text = line.partition("\t")
+            try:
+                weight = float(weight) if sep else 1.0
+            except ValueError:
+                weight, text = 1.0, line
+            prompts.append((text if sep else line).strip())
+            weights.append(weight)
+    if not prompts:
+        raise ValueError(f"提示词文件为空: {path}")
+    return prompts, weights
+
+def loadtest_request(model, prompt, max_tokens=None, timeout=None, base_url=None):
+    """发送一个流式生成请求，返回 (首 token 耗时, 总耗时, 输出 token 数, 服务端生成速度)
+    
+    直接访问服务，不经过守护进程和本地请求调度，测到的是服务本身在并发下的表现。
+    """
+    base_url = base_url or get_ollama_base_url()
+    payload = {"model": model, "prompt": prompt, "stream": True}
+    if max_tokens:
+        payload["options"] = {"num_predict": max_tokens}
+    started = time.perf_counter()
+    ttft = None
+    final = None
+    response = ollama_request("/api/generate", payload, "POST", timeout or get_timeout("stream"), base_url)
+    try:
+        while final is None:
+            line = response.readline()
+            if not line:
+                raise OllamaAPIError("流式响应意外结束")
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if message.get("error"):
+                raise OllamaAPIError(message["error"])
+            if ttft is None and message.get("response"):
+                ttft = time.perf_counter() - started
+            if message.get("done"):
+                final = message
+        # 读完分块结尾，连接才能复用
+        response.read()
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        raise OllamaAPIError(f"读取流式响应失败: {e}") from e
+    finally:
+        if final is None:
+            _drop_http_connection(base_url)
+    elapsed = time.perf_counter() - started
+    return (ttft if ttft is not None else elapsed, elapsed, final.get("eval_count", 0),
+            tokens_per_second(final.get("eval_count"), final.get("eval_duration")))
+
+class LoadTest:
+    """对一个模型施加负载并记录延迟分布
+    
+    闭环 (closed)：concurrency 个虚拟用户，每个收到响应后立即发下一个请求。
+    开环 (open)：按泊松过程以 rate 个/秒到达，不管之前的请求是否完成；
+    延迟从计划发送时刻算起，客户端排队的时间也计入（避免协调遗漏）。
+    """
+    
+    def __init__(self, model, mode="closed", concurrency=4, rate=1.0, duration=60,
+                 prompts=None, weights=None, max_tokens=128, interval=5, seed=None):
+        if mode not in ("open", "closed"):
+            raise ValueError(f"未知模式: {mode}")
+        self.model = model
+        self.mode = mode
+        self.concurrency = max(1, int(concurrency))
+        self.rate = float(rate)
+        self.duration = float(duration)
+        self.prompts, self.weights = (prompts, weights) if prompts else load_prompt_distribution()
+        self.max_tokens = max_tokens
+        self.interval = float(interval)
+        self.random = random.Random(seed)
+        self.base_url = get_ollama_base_url()
+        self.latency = LatencyHistogram()
+        self.ttft = LatencyHistogram()
+        self.intervals = []     # 每个时间段: {"requests", "errors", "tokens", "latency", "ttft"}
+        self.samples = []       # 成功请求: (总耗时, 首 token 耗时, 输出 token 数, 生成速度)
+        self.errors = {}        # 错误信息 -> 次数
+        self.dropped = 0        # 开环模式下测试结束时仍未发出的请求
+        self.started = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+    
+    def _slot(self, offset):
+        index = max(0, int(offset // self.interval))
+        while len(self.intervals) <= index:
+            self.intervals.append({"requests": 0, "errors": 0, "tokens": 0,
+                                   "latency": LatencyHistogram(), "ttft": LatencyHistogram()})
+        return self.intervals[index]
+    
+    def _one(self, scheduled):
+        """发送一个请求，返回是否成功；scheduled 为计划发送时刻（perf_counter）"""
+        prompt = self.random.choices(self.prompts, self.weights)[0]
+        queued = time.perf_counter() - scheduled
+        try:
+            ttft, elapsed, tokens, tps = loadtest_request(self.model, prompt, self.max_tokens,
+                                                          base_url=self.base_url)
+            error = None
+        except OllamaAPIError as e:
+            error = str(e)[:120]
+        finished = time.perf_counter()
+        with self._lock:
+            slot = self._slot(finished - self.started)
+            slot["requests"] += 1
+            if error:
+                slot["errors"] += 1
+                self.errors[error] = self.errors.get(error, 0) + 1
+                return False
+            latency, first = elapsed + queued, ttft + queued
+            slot["tokens"] += tokens
+            slot["latency"].record(latency)
+            slot["ttft"].record(first)
+            self.latency.record(latency)
+            self.ttft.record(first)
+            self.samples.append((latency, first, tokens, tps))
+        return True
+    
+    def warmup(self):
+        """发送一个请求让模型加载进内存（不计入结果）"""
+        loadtest_request(self.model, self.prompts[0], 1, base_url=self.base_url)
+    
+    def _closed_worker(self, deadline):
+        while not self._stop.is_set() and time.perf_counter() < deadline:
+            if not self._one(time.perf_counter()):
+                self._stop.wait(LOADTEST_ERROR_PAUSE)
+    
+    def _run_closed(self, deadline):
+        workers = [threading.Thread(target=self._closed_worker, args=(deadline,), daemon=True)
+                   for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    
+    def _run_open(self, deadline):
+        pending = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=LOADTEST_MAX_WORKERS) as executor:
+            scheduled = self.started
+            while not self._stop.is_set():
+                scheduled += self.random.expovariate(self.rate)
+                if scheduled >= deadline:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0 and self._stop.wait(delay):
+                    break
+                pending.append(executor.submit(self._one, scheduled))
+            # 到时还没开始的请求不再发送，正在进行的等待完成
+            self.dropped = sum(1 for future in pending if future.cancel())
+    
+    def run(self, on_interval=None):
+        """运行测试并返回结果；on_interval(序号, 时间段) 在每个时间段结束后调用"""
+        self.started = time.perf_counter()
+        deadline = self.started + self.duration
+        runner = threading.Thread(target=self._run_open if self.mode == "open" else self._run_closed,
+                                  args=(deadline,), daemon=True)
+        runner.start()
+        reported = 0
+        try:
+            while runner.is_alive():
+                runner.join(timeout=0.2)
+                # 时间段结束后再汇报（之后完成的请求计入下一个时间段）
+                current = int((time.perf_counter() - self.started) // self.interval)
+                while on_interval and reported < current:
+                    with self._lock:
+                        slot = self._slot(reported * self.interval)
+                    on_interval(reported, slot)
+                    reported += 1
+        except KeyboardInterrupt:
+            self._stop.set()
+            runner.join()
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            while on_interval and reported < len(self.intervals):
+                on_interval(reported, self.intervals[reported])
+                reported += 1
+        return self.result(elapsed)
+    
+    def result(self, elapsed):
+        requests = sum(slot["requests"] for slot in self.intervals)
+        errors = sum(slot["errors"] for slot in self.intervals)
+        tokens = sum(slot["tokens"] for slot in self.intervals)
+        return {
+            "model": self.model,
+            "mode": self.mode,
+            "concurrency": self.concurrency if self.mode == "closed" else None,
+            "rate": self.rate if self.mode == "open" else None,
+            "duration": elapsed,
+            "max_tokens": self.max_tokens,
+            "requests": requests,
+            "errors": errors,
+            "dropped": self.dropped,
+            "error_rate": errors / requests if requests else 0.0,
+            "throughput_rps": (requests - errors) / elapsed if elapsed else 0.0,
+            "tokens_per_second": tokens / elapsed if elapsed else 0.0,
+            "latency": self.latency.summary(),
+            "ttft": self.ttft.summary(),
+            "error_messages": dict(self.errors),
+            "intervals": [interval_summary(i * self.interval, slot, self.interval)
+                          for i, slot in enumerate(self.intervals)],
+            "samples": list(self.samples),
+        }
+
+def interval_summary(offset, slot, interval):
+    """时间段的汇总（用于显示和保存）"""
+    ok = slot["requests"] - slot["errors"]
+    return {"t": offset, "requests": slot["requests"], "errors": slot["errors"],
+            "rps": ok / interval, "tokens_per_second": slot["tokens"] / interval,
+            "p50": slot["latency"].percentile(50), "p99": slot["latency"].percentile(99),
+            "ttft_p50": slot["ttft"].percentile(50)}
+
+def make_interval_printer(interval):
+    """生成逐时间段打印的回调"""
+    print(f"{'时间':>8}{'请求':>7}{'错误':>6}{'请求/秒':>9}{'tokens/秒':>11}"
+          f"{'P50':>10}{'P99':>10}{'首token P50':>13}")
+    
+    def on_interval(index, slot):
+        row = interval_summary(index * interval, slot, interval)
+        print(f"{row['t']:>7.0f}s{row['requests']:>7}{row['errors']:>6}{row['rps']:>9.2f}"
+              f"{row['tokens_per_second']:>11.1f}{format_seconds(row['p50']):>10}"
+              f"{format_seconds(row['p99']):>10}{format_seconds(row['ttft_p50']):>13}", flush=True)
+    return on_interval
+
+def print_loadtest_report(result):
+    """打印负载测试汇总"""
+    print("\n" + "=" * 60)
+    load = (f"闭环 {result['concurrency']} 并发" if result["mode"] == "closed"
+            else f"开环 {result['rate']:g} 请求/秒")
+    print(f"📊 {result['model']}  {load}  {result['duration']:.0f} 秒")
+    print("=" * 60)
+    print(f"请求数: {result['requests']}   错误: {result['errors']} ({result['error_rate'] * 100:.1f}%)"
+          + (f"   未发出: {result['dropped']}" if result["dropped"] else ""))
+    print(f"吞吐量: {result['throughput_rps']:.2f} 请求/秒，{result['tokens_per_second']:.1f} tokens/秒")
+    if result["samples"]:
+        mean_tps = sum(sample[3] for sample in result["samples"]) / len(result["samples"])
+        print(f"单请求生成速度: 平均 {mean_tps:.1f} tokens/秒")
+    print()
+    print(f"{'':<10}" + "".join(f"{name:>10}" for name in result["latency"]))
+    for title, key in (("总延迟", "latency"), ("首 token", "ttft")):
+        print(pad_display(title, 10) + "".join(f"{format_seconds(value):>10}"
+                                               for value in result[key].values()))
+    if result["error_messages"]:
+        print("\n错误:")
+        for message, count in sorted(result["error_messages"].items(), key=lambda item: -item[1])[:5]:
+            print(f"  {count:>5} × {message}")
+
+def run_loadtest(model, mode="closed", concurrency=4, rate=1.0, duration=60, prompt_file=None,
+                 max_tokens=128, interval=5, warmup=True):
+    """运行负载测试，逐时间段打印进度，返回结果"""
+    prompts, weights = load_prompt_distribution(prompt_file)
+    test = LoadTest(model, mode, concurrency, rate, duration, prompts, weights, max_tokens, interval)
+    if warmup:
+        print("预热中（加载模型）...", flush=True)
+        test.warmup()
+    print()
+    result = test.run(make_interval_printer(test.interval))
+    print_loadtest_report(result)
+    if result["requests"] > result["errors"]:
+        result["run_id"] = record_loadtest(result, test.interval)
+    return result
+
+@traced("menu.loadtest_menu")
+def loadtest_menu():
+    """负载测试"""
+    clear_screen()
+    print_header()
+    print("\n🏋️  负载测试\n")
+    print("向服务持续发送请求，统计延迟分位数、首 token 时间、吞吐量和错误率，")
+    print("用于评估节点容量和设置并发上限。请求直接发给服务，不经过本程序的请求调度。\n")
+    
+    model = input("模型名称: ").strip()
+    if not model:
+        print("❌ 模型名称不能为空")
+        input("\n按回车键返回...")
+        return
+    print("\n负载方式:")
+    print("  1. 闭环（固定并发数，收到响应后立即发送下一个）")
+    print("  2. 开环（固定到达速率，不等待之前的请求）")
+    mode = "open" if input("请选择 [1-2] (默认 1): ").strip() == "2" else "closed"
+    try:
+        if mode == "closed":
+            concurrency, rate = int(input("并发数 (默认 4): ").strip() or 4), 1.0
+        else:
+            concurrency, rate = 1, float(input("每秒请求数 (默认 1): ").strip() or 1)
+        duration = float(input("持续时间，秒 (默认 60): ").strip() or 60)
+        max_tokens = int(input("每个请求最多生成 token 数 (默认 128): ").strip() or 128)
+    except ValueError:
+        print("❌ 请输入数字")
+        input("\n按回车键返回...")
+        return
+    if rate <= 0 or concurrency <= 0 or duration <= 0:
+        print("❌ 数值必须大于 0")
+        input("\n按回车键返回...")
+        return
+    prompt_file = input("提示词文件 (每行一个，可写 权重<Tab>提示词；回车使用内置分布): ").strip() or None
+    
+    print("\n按 Ctrl+C 可提前结束\n")
+    try:
+        run_loadtest(model, mode, concurrency, rate, duration, prompt_file, max_tokens)
+    except (OSError, ValueError) as e:
+        print(f"❌ {str(e)}")
+    except OllamaAPIError as e:
+        print(f"❌ 预热失败: {str(e)}")
+    input("\n按回车键返回...")
+
+# ------------ 基准测试记录 ------------
+BENCHMARK_DB_FILE = "benchmarks.db"
+# 指标 -> (说明, 方向)：1 表示越大越好，-1 表示越小越好
+BENCHMARK_METRICS = {
+    "latency": ("总延迟 (秒)", -1),
+    "ttft": ("首 token (秒)", -1),
+    "tps": ("单请求生成速度 (tokens/秒)", 1),
+    "prompt_tps": ("提示词处理速度 (tokens/秒)", 1),
+    "throughput": ("总吞吐量 (tokens/秒)", 1),
+}
+BENCHMARK_ALPHA = 0.05          # 显著性水平
+BENCHMARK_MIN_CHANGE = 0.03     # 变化小于 3% 时即使显著也不算回归
+
+BENCHMARK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    model_digest TEXT,
+    started TEXT NOT NULL,
+    host_id TEXT,
+    cpu TEXT,
+    cores INTEGER,
+    ram_bytes INTEGER,
+    ollama_version TEXT,
+    server_version TEXT,
+    params TEXT,
+    summary TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_run ON samples(run_id, metric);
+CREATE INDEX IF NOT EXISTS runs_model ON runs(model, kind);
+"""
+
+_host_fingerprint = None
+
+def get_cpu_model():
+    """CPU 型号"""
+    try:
+        with open("/proc/cpuinfo", 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if line.lower().startswith(("model name", "hardware", "cpu model")):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def get_host_fingerprint():
+    """本机指纹：CPU、内存、Ollama 版本；对比时用来判断两次测试是否在相同环境下运行"""
+    global _host_fingerprint
+    if _host_fingerprint is None:
+        total, _ = get_memory_info()
+        installed, version = check_ollama()
+        cpu = get_cpu_model()
+        fingerprint = {
+            "cpu": cpu,
+            "cores": get_cpu_cores(),
+            "ram_bytes": total or 0,
+            "ollama_version": version if installed else "",
+        }
+        key = f"{platform.node()}|{cpu}|{fingerprint['cores']}|{fingerprint['ram_bytes']}"
+        fingerprint["host_id"] = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        _host_fingerprint = fingerprint
+    # 服务可能是远程的或刚升级过，每次记录时重新获取
+    up, server_version = check_server_alive()
+    return dict(_host_fingerprint, server_version=server_version if up else "")
+
+def get_model_digest(model):
+    """模型的摘要（来自 /api/tags），获取失败时返回空字符串"""
+    try:
+        models = ollama_api("/api/tags", timeout=10).get("models", [])
+    except OllamaAPIError:
+        return ""
+    for item in models:
+        if item.get("name") in (model, model + ":latest") or item.get("model") == model:
+            return item.get("digest", "")
+    return ""
+
+class BenchmarkDB:
+    """基准测试和负载测试结果库（SQLite）
+    
+    每次运行一行，附带本机指纹和模型摘要；逐请求的样本单独存放，用于显著性检验。
+    """
+    
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_manager_dir(), BENCHMARK_DB_FILE)
+        with self._connect() as conn:
+            conn.executescript(BENCHMARK_SCHEMA)
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        return contextlib.closing(conn)
+    
+    def record_run(self, kind, model, params, summary, samples, fingerprint=None, model_digest=None):
+        """保存一次运行，samples 为 {指标: [数值, ...]}，返回记录编号"""
+        fingerprint = fingerprint or get_host_fingerprint()
+        if model_digest is None:
+            model_digest = get_model_digest(model)
+        with self._connect() as conn, conn:
+            cursor = conn.execute(
+                "INSERT INTO runs (kind, model, model_digest, started, host_id, cpu, cores, ram_bytes,"
+                " ollama_version, server_version, params, summary)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, model, model_digest, datetime.now().isoformat(timespec='seconds'),
+                 fingerprint["host_id"], fingerprint["cpu"], fingerprint["cores"],
+                 fingerprint["ram_bytes"], fingerprint["ollama_version"],
+                 fingerprint["server_version"], json.dumps(params, ensure_ascii=False),
+                 json.dumps(summary, ensure_ascii=False)))
+            run_id = cursor.lastrowid
+            conn.executemany("INSERT INTO samples (run_id, metric, value) VALUES (?, ?, ?)",
+                             [(run_id, metric, float(value))
+                              for metric, values in samples.items() for value in values])
+        return run_id
+    
+    def list_runs(self, model=None, kind=None, limit=20):
+        query = "SELECT * FROM runs"
+        conditions, args = [], []
+        if model:
+            conditions.append("model = ?")
+            args.append(model)
+        if kind:
+            conditions.append("kind = ?")
+            args.append(kind)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC LIMIT ?"
+        with self._connect() as conn:
+            return [self._row(row) for row in conn.execute(query, args + [limit])]
+    
+    def get_run(self, run_id):
+        """读取一次运行及其样本，不存在时返回 None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+            if row is None:
+                return None
+            run = self._row(row)
+            run["samples"] = {}
+            for metric, value in conn.execute(
+                    "SELECT metric, value FROM samples WHERE run_id = ? ORDER BY rowid", (run_id,)):
+                run["samples"].setdefault(metric, []).append(value)
+        return run
+    
+    def previous_run(self, run):
+        """同一模型、同类测试、相同参数的上一次运行（默认的对比基线）"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM runs WHERE model = ? AND kind = ? AND id < ?"
+                                " ORDER BY id DESC", (run["model"], run["kind"], run["id"]))
+            for row in rows:
+                if self._row(row)["params"] == run["params"]:
+                    return self.get_run(row["id"])
+        return None
+    
+    @staticmethod
+    def _row(row):
+        run = dict(row)
+        run["params"] = json.loads(run["params"] or "{}")
+        run["summary"] = json.loads(run["summary"] or "{}")
+        return run
+
+def _betacf(a, b, x):
+    """不完全贝塔函数的连分式（Lentz 算法）"""
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        for numerator in (m * (b - m) * x / ((a + m2 - 1) * (a + m2)),
+                          -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1))):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1.0) < 1e-12:
+            break
+    return h
+
+def regularized_beta(a, b, x):
+    """正则化不完全贝塔函数 I_x(a, b)"""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                     + a * math.log(x) + b * math.log(1 - x))
+    if x < (a + 1) / (a + b + 2):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1 - x) / b
+
+def welch_t_test(a, b):
+    """Welch t 检验（不假设方差相等），返回 (t, 自由度, 双侧 p 值)"""
+    n1, n2 = len(a), len(b)
+    if n1 < 2 or n2 < 2:
+        return 0.0, 0.0, 1.0
+    m1, m2 = sum(a) / n1, sum(b) / n2
+    v1 = sum((x - m1) ** 2 for x in a) / (n1 - 1) / n1
+    v2 = sum((x - m2) ** 2 for x in b) / (n2 - 1) / n2
+    if v1 + v2 == 0:
+        return 0.0, 0.0, 1.0 if m1 == m2 else 0.0
+    t = (m2 - m1) / math.sqrt(v1 + v2)
+    df = (v1 + v2) ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1))
+    return t, df, regularized_beta(df / 2, 0.5, df / (df + t * t))
+
+def compare_runs(baseline, current, alpha=BENCHMARK_ALPHA, min_change=BENCHMARK_MIN_CHANGE):
+    """逐指标比较两次运行，返回 [{metric, base, current, change, p, status}]
+    
+    status 为 regression（显著变差）、improvement（显著变好）或 same。
+    """
+    rows = []
+    for metric, (_, direction) in BENCHMARK_METRICS.items():
+        a, b = baseline["samples"].get(metric), current["samples"].get(metric)
+        if not a or not b:
+            continue
+        base_mean, current_mean = sum(a) / len(a), sum(b) / len(b)
+        change = (current_mean - base_mean) / base_mean if base_mean else 0.0
+        _, _, p = welch_t_test(a, b)
+        status = "same"
+        if p < alpha and abs(change) >= min_change:
+            status = "improvement" if change * direction > 0 else "regression"
+        rows.append({"metric": metric, "base": base_mean, "current": current_mean,
+                     "change": change, "p": p, "n": (len(a), len(b)), "status": status})
+    return rows
+
+def describe_run(run):
+    """一行描述：编号、时间、模型、测试参数"""
+    params = run["params"]
+    if run["kind"] == "loadtest":
+        load = (f"{params.get('concurrency')} 并发" if params.get("mode") == "closed"
+                else f"{params.get('rate')} 请求/秒")
+        detail = f"负载测试 {load}"
+    elif run["kind"] == "tune":
+        detail = f"参数调优 {format_options(params.get('options', {}))}"
+    else:
+        detail = f"多模型对比 {params.get('prompts', 0)} 个提示词"
+    return f"#{run['id']:<5} {run['started'].replace('T', ' ')}  {run['model']:<24} {detail}"
+
+def print_run_comparison(baseline, current, rows):
+    """打印对比结果，返回回归的指标数"""
+    print(f"基线: {describe_run(baseline)}")
+    print(f"当前: {describe_run(current)}")
+    for key, title in (("host_id", "主机"), ("ollama_version", "Ollama 版本"),
+                       ("server_version", "服务版本"), ("model_digest", "模型摘要")):
+        if baseline.get(key) != current.get(key):
+            print(f"  • {title}不同: {str(baseline.get(key))[:19] or '-'} → {str(current.get(key))[:19] or '-'}")
+    print()
+    # 中文标题占两列，右对齐宽度相应减少
+    print(f"{pad_display('指标', 30)}{'基线':>10}{'当前':>10}{'变化':>7}{'p 值':>8}  结论")
+    print("-" * 84)
+    icons = {"regression": "❌ 回归", "improvement": "✅ 提升", "same": "  无显著差异"}
+    for row in rows:
+        print(f"{pad_display(BENCHMARK_METRICS[row['metric']][0], 30)}{row['base']:>12.4g}"
+              f"{row['current']:>12.4g}{row['change'] * 100:>+8.1f}%{row['p']:>9.3f}  {icons[row['status']]}")
+    if not rows:
+        print("两次运行没有共同的指标样本")
+    return sum(1 for row in rows if row["status"] == "regression")
+
+def record_benchmark(kind, model, params, summary, samples):
+    """保存结果并打印记录编号；保存失败只提示，不影响测试本身"""
+    try:
+        run_id = BenchmarkDB().record_run(kind, model, params, summary, samples)
+        print(f"💾 结果已保存为记录 #{run_id}（可在 基准测试记录 中与之前的运行对比）")
+        return run_id
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️  结果保存失败: {str(e)}")
+        return None
+
+def record_loadtest(result, interval):
+    """保存负载测试结果；完整的时间段才计入吞吐量样本"""
+    params = {key: result[key] for key in ("mode", "concurrency", "rate", "max_tokens")}
+    summary = {key: value for key, value in result.items() if key not in ("samples", "intervals")}
+    full = [row for row in result["intervals"] if row["t"] + interval <= result["duration"]]
+    samples = {
+        "latency": [sample[0] for sample in result["samples"]],
+        "ttft": [sample[1] for sample in result["samples"]],
+        "tps": [sample[3] for sample in result["samples"] if sample[3]],
+        "throughput": [row["tokens_per_second"] for row in full],
+    }
+    return record_benchmark("loadtest", result["model"], params, summary, samples)
+
+def record_compare_results(results, prompts):
+    """把多模型对比中每个模型的结果各保存为一次运行"""
+    for model, items in results.items():
+        ok = [item for item in items if not item["error"]]
+        if not ok:
+            continue
+        summary = {"requests": len(items), "errors": len(items) - len(ok),
+                   "latency": sum(item["latency"] for item in ok) / len(ok),
+                   "tps": sum(item["tps"] for item in ok) / len(ok)}
+        params = {"prompts": len(prompts),
+                  "prompt_hash": hashlib.sha1("\n".join(prompts).encode('utf-8')).hexdigest()[:12]}
+        record_benchmark("compare", model, params, summary,
+                         {"latency": [item["latency"] for item in ok],
+                          "tps": [item["tps"] for item in ok if item["tps"]]})
+
+def resolve_comparison(db, base_id=None, current_id=None):
+    """确定要对比的两次运行：默认当前为最新一次，基线为同条件的上一次"""
+    if current_id is None:
+        runs = db.list_runs(limit=1)
+        if not runs:
+            raise ValueError("还没有任何记录")
+        current_id = runs[0]["id"]
+    current = db.get_run(current_id)
+    if current is None:
+        raise ValueError(f"记录 #{current_id} 不存在")
+    baseline = db.get_run(base_id) if base_id is not None else db.previous_run(current)
+    if baseline is None:
+        raise ValueError(f"记录 #{base_id} 不存在" if base_id is not None
+                         else f"记录 #{current_id} 没有同条件的历史记录可对比")
+    return baseline, current
+
+@traced("menu.benchmark_db_menu")
+def benchmark_db_menu():
+    """基准测试记录与回归对比"""
+    clear_screen()
+    print_header()
+    print("\n🗃️  基准测试记录\n")
+    try:
+        db = BenchmarkDB()
+        runs = db.list_runs(limit=15)
+    except (sqlite3.Error, OSError) as e:
+        print(f"❌ 无法打开记录库: {str(e)}")
+        input("\n按回车键返回...")
+        return
+    if not runs:
+        print("还没有记录。负载测试、多模型对比和参数调优的结果会自动保存在这里。")
+        input("\n按回车键返回...")
+        return
+    print(f"记录库: {db.path}\n")
+    for run in runs:
+        print("  " + describe_run(run))
+    
+    print("\n输入两个编号对比（基线 当前），只输入一个编号则与同条件的上一次对比")
+    choice = input("编号 (回车对比最新一次与上一次): ").strip().replace("#", "").split()
+    try:
+        ids = [int(item) for item in choice]
+        if len(ids) > 2:
+            raise ValueError("最多输入两个编号")
+        base_id, current_id = (ids[0], ids[1]) if len(ids) == 2 else (None, ids[0] if ids else None)
+        baseline, current = resolve_comparison(db, base_id, current_id)
+    except ValueError as e:
+        print(f"❌ {str(e)}")
+        input("\n按回车键返回...")
+        return
+    print()
+    regressions = print_run_comparison(baseline, current, compare_runs(baseline, current))
+    if regressions:
+        print(f"\n⚠️  {regressions} 项指标显著变差 (p < {BENCHMARK_ALPHA})")
+    input("\n按回车键返回...")
+
+# ------------ 运行参数调优 ------------
+TUNE_REPEATS = 3
+TUNE_MAX_TOKENS = 128
+TUNE_PARAMETERS = ("num_thread", "num_batch", "num_ctx")
+TUNE_DEFAULT_PROMPT = (
+    "请阅读下面的材料，然后用三句话总结要点，并给出一个改进建议。\n\n"
+    + "本地部署大语言模型可以让数据留在自己的机器上，不依赖网络，也没有按次计费。"
+      "但 CPU 推理的速度受内存带宽和线程调度影响很大：线程数超过物理核心后往往变慢，"
+      "批处理大小决定了处理提示词时每次送入多少 token，上下文长度则影响 KV 缓存的内存占用。"
+      "不同的机器、不同的模型，最合适的参数并不相同，需要实际测量。\n" * 4
+)
+# 目标 -> (说明, 由 (提示词速度, 生成速度) 计算得分)
+TUNE_OBJECTIVES = {
+    "generation": ("生成速度", lambda prompt_tps, tps: tps),
+    "prompt": ("提示词处理速度", lambda prompt_tps, tps: prompt_tps),
+    "both": ("两者兼顾 (几何平均)", lambda prompt_tps, tps: math.sqrt(prompt_tps * tps)),
+}
+
+def default_tune_grid():
+    """按本机核心数生成候选值"""
+    cores = get_cpu_cores()
+    logical = os.cpu_count() or cores
+    threads = sorted({max(1, cores // 2), max(1, cores * 3 // 4), cores, logical})
+    return {"num_thread": threads, "num_batch": [128, 256, 512, 1024], "num_ctx": [2048, 4096, 8192]}
+
+def format_options(options):
+    """把参数字典格式化为 num_thread=8 num_batch=512"""
+    return " ".join(f"{key}={options[key]}" for key in TUNE_PARAMETERS if key in options) or "服务默认"
+
+def measure_options(model, prompt, options, repeats=TUNE_REPEATS, max_tokens=TUNE_MAX_TOKENS):
+    """用指定参数运行 repeats 次，返回样本 {"prompt_tps", "tps", "latency"}
+    
+    参数变化时服务会重新加载模型，所以先用同样的参数预热一次。每次在提示词前加随机前缀，
+    避免服务复用上一次的提示词缓存，否则提示词处理速度测不准。
+    """
+    samples = {"prompt_tps": [], "tps": [], "latency": []}
+    with request_priority(PRIORITY_BATCH):
+        generate_text(model, prompt, options=dict(options, num_predict=1))
+        for _ in range(repeats):
+            nonce = f"[{random.getrandbits(32):08x}] "
+            response = generate_text(model, nonce + prompt, options=dict(options, num_predict=max_tokens))
+            samples["prompt_tps"].append(tokens_per_second(response.get("prompt_eval_count"),
+                                                           response.get("prompt_eval_duration")))
+            samples["tps"].append(tokens_per_second(response.get("eval_count"), response.get("eval_duration")))
+            samples["latency"].append(response["wall_seconds"])
+    return samples
+
+class AutoTuner:
+    """在 num_thread、num_batch、num_ctx 的候选值中寻找最快的组合
+    
+    默认逐个参数搜索（先定线程数，再定批大小，最后定上下文长度，每步保留之前选出的值），
+    比全组合少测很多次；full=True 时测试全部组合。"服务默认"（不设置该参数）也参与比较。
+    """
+    
+    def __init__(self, model, prompt=None, grid=None, objective="generation", repeats=TUNE_REPEATS,
+                 max_tokens=TUNE_MAX_TOKENS, full=False, record=True):
+        if objective not in TUNE_OBJECTIVES:
+            raise ValueError(f"未知目标: {objective}")
+        self.model = model
+        self.prompt = prompt or TUNE_DEFAULT_PROMPT
+        self.grid = grid or default_tune_grid()
+        self.objective = objective
+        self.repeats = repeats
+        self.max_tokens = max_tokens
+        self.full = full
+        self.record = record
+        self.trials = {}     # 参数元组 -> 结果
+        self.fingerprint = None
+        self.digest = None
+    
+    def score(self, trial):
+        return TUNE_OBJECTIVES[self.objective][1](trial["prompt_tps"], trial["tps"]) if trial["ok"] else -1.0
+    
+    def trial(self, options, progress=None):
+        """测试一组参数（相同参数只测一次）"""
+        key = tuple(sorted(options.items()))
+        if key in self.trials:
+            return self.trials[key]
+        try:
+            samples = measure_options(self.model, self.prompt, options, self.repeats, self.max_tokens)
+            result = {"options": dict(options), "ok": True, "error": "", "samples": samples,
+                      "prompt_tps": sum(samples["prompt_tps"]) / len(samples["prompt_tps"]),
+                      "tps": sum(samples["tps"]) / len(samples["tps"]),
+                      "latency": sum(samples["latency"]) / len(samples["latency"])}
+        except OllamaAPIError as e:
+            # 上下文过大时可能内存不足，记为失败继续测试其他组合
+            result = {"options": dict(options), "ok": False, "error": str(e)[:120], "samples": {},
+                      "prompt_tps": 0.0, "tps": 0.0, "latency": 0.0}
+        self.trials[key] = result
+        if result["ok"] and self.record:
+            self._record(result)
+        if progress:
+            progress(result)
+        return result
+    
+    def _record(self, result):
+        """保存到基准测试记录，升级 Ollama 后可以与同参数的历史结果对比"""
+        if self.fingerprint is None:
+            self.fingerprint = get_host_fingerprint()
+            self.digest = get_model_digest(self.model)
+        params = {"options": result["options"], "max_tokens": self.max_tokens,
+                  "prompt_hash": hashlib.sha1(self.prompt.encode('utf-8')).hexdigest()[:12]}
+        summary = {key: result[key] for key in ("prompt_tps", "tps", "latency")}
+        try:
+            BenchmarkDB().record_run("tune", self.model, params, summary, result["samples"],
+                                     self.fingerprint, self.digest)
+        except (sqlite3.Error, OSError):
+            pass
+    
+    def run(self, progress=None):
+        """运行调优，返回 (基线结果, 最佳结果)"""
+        baseline = self.trial({}, progress)
+        if not baseline["ok"]:
+            raise OllamaAPIError(f"使用服务默认参数运行失败: {baseline['error']}")
+        if self.full:
+            names = [name for name in TUNE_PARAMETERS if self.grid.get(name)]
+            for values in itertools.product(*(self.grid[name] for name in names)):
+                self.trial(dict(zip(names, values)), progress)
+        else:
+            current = {}
+            for name in TUNE_PARAMETERS:
+                candidates = [current] + [dict(current, **{name: value}) for value in self.grid.get(name, [])]
+                current = max((self.trial(options, progress) for options in candidates),
+                              key=self.score)["options"]
+        best = max(self.trials.values(), key=self.score)
+        return baseline, best
+
+def print_tune_trial(result):
+    """打印一组参数的测试结果"""
+    if result["ok"]:
+        print(f"  {pad_display(format_options(result['options']), 44)}"
+              f"提示词 {result['prompt_tps']:>8.1f}  生成 {result['tps']:>7.1f} tokens/秒", flush=True)
+    else:
+        print(f"  {pad_display(format_options(result['options']), 44)}❌ {result['error']}", flush=True)
+
+def print_tune_report(tuner, baseline, best):
+    """打印调优结果和使用方法"""
+    print("\n" + "=" * 60)
+    print(f"📊 {tuner.model}  目标: {TUNE_OBJECTIVES[tuner.objective][0]}  "
+          f"共测试 {len(tuner.trials)} 组参数")
+    print("=" * 60)
+    print(f"{pad_display('参数', 44)}{'提示词':>6}{'生成':>8}{'提升':>7}")
+    base_score = tuner.score(baseline)
+    ranked = sorted((t for t in tuner.trials.values() if t["ok"]), key=tuner.score, reverse=True)
+    for trial in ranked[:10]:
+        gain = (tuner.score(trial) / base_score - 1) * 100 if base_score > 0 else 0.0
+        print(f"{pad_display(format_options(trial['options']), 44)}{trial['prompt_tps']:>9.1f}"
+              f"{trial['tps']:>10.1f}{gain:>+8.1f}%")
+    
+    if not best["options"]:
+        print("\n✅ 服务默认参数已经是最快的，不需要调整")
+        return
+    print(f"\n🏆 最佳参数: {format_options(best['options'])}")
+    print(f"   提示词处理 {baseline['prompt_tps']:.1f} → {best['prompt_tps']:.1f} tokens/秒，"
+          f"生成 {baseline['tps']:.1f} → {best['tps']:.1f} tokens/秒")
+    print("\n使用方法（任选其一）:")
+    print(f"  • API 请求中加入 \"options\": {json.dumps(best['options'])}")
+    print("  • 创建带参数的模型：Modelfile 写入")
+    print(f"      FROM {tuner.model}")
+    for key, value in best["options"].items():
+        print(f"      PARAMETER {key} {value}")
+    print(f"    然后运行 ollama create {tuner.model.split(':')[0]}-tuned -f Modelfile")
+
+def run_autotune(model, prompt=None, grid=None, objective="generation", repeats=TUNE_REPEATS,
+                 max_tokens=TUNE_MAX_TOKENS, full=False):
+    """运行调优并打印过程和结果，返回 (调优器, 基线结果, 最佳结果)"""
+    tuner = AutoTuner(model, prompt, grid, objective, repeats, max_tokens, full)
+    print("候选值: " + "  ".join(f"{name}={','.join(map(str, tuner.grid[name]))}"
+                                 for name in TUNE_PARAMETERS if tuner.grid.get(name)))
+    print("每组参数先预热（参数变化时服务会重新加载模型），再测 "
+          f"{repeats} 次；结果同时保存到基准测试记录\n")
+    baseline, best = tuner.run(print_tune_trial)
+    print_tune_report(tuner, baseline, best)
+    return tuner, baseline, best
+
+def parse_tune_values(text):
+    """解析逗号分隔的候选值，如 4,8,16"""
+    return [int(item) for item in text.replace("，", ",").split(",") if item.strip()]
+
+@traced("menu.autotune_menu")
+def autotune_menu():
+    """运行参数自动调优"""
+    clear_screen()
+    print_header()
+    print("\n🎛️  运行参数自动调优\n")
+    print("测试不同的 num_thread / num_batch / num_ctx 组合，找出本机上最快的设置。")
+    print("每组参数都需要重新加载模型，大模型可能需要较长时间。\n")
+    
+    model = input("模型名称: ").strip()
+    if not model:
+        print("❌ 模型名称不能为空")
+        input("\n按回车键返回...")
+        return
+    prompt_file = input("代表性提示词文件 (回车使用内置提示词): ").strip()
+    print("\n优化目标:")
+    objectives = list(TUNE_OBJECTIVES)
+    for i, name in enumerate(objectives, 1):
+        print(f"  {i}. {TUNE_OBJECTIVES[name][0]}")
+    choice = input("请选择 (默认 1): ").strip()
+    objective = objectives[int(choice) - 1] if choice.isdigit() and 1 <= int(choice) <= len(objectives) \
+        else objectives[0]
+    
+    grid = default_tune_grid()
+    print("\n候选值（回车使用默认，逗号分隔）:")
+    try:
+        for name in TUNE_PARAMETERS:
+            text = input(f"  {name} (默认 {','.join(map(str, grid[name]))}): ").strip()
+            if text:
+                grid[name] = parse_tune_values(text)
+        full = input("\n测试全部组合? 默认逐个参数搜索 (y/N): ").strip().lower() in ['y', 'yes']
+        prompt = None
+        if prompt_file:
+            with open(prompt_file, 'r', encoding='utf-8') as f:
+                prompt = f.read()
+        print()
+        run_autotune(model, prompt, grid, objective, full=full)
+    except ValueError as e:
+        print(f"❌ 输入无效: {str(e)}")
+    except OSError as e:
+        print(f"❌ 无法读取提示词文件: {str(e)}")
+    except OllamaAPIError as e:
+        print(f"❌ {str(e)}")
+    except KeyboardInterrupt:
+        print("\n\n🛑 调优已取消")
+    input("\n按回车键返回...")
+
+# ============ 第六部分：主程序 ============
+def main():
+    """主程序"""
+    # 初始化程序（检查并询问安装）
+    if not initialize_program():
+        return
+    
+    # 主循环
+    while True:
+        try:
+            print_menu()
+            choice = input("\n请输入选项 [0-11]: ").strip()
+            
             if choice == "0":
                 # 直接退出
                 clear_screen()
@@ -1135,8 +8087,12 @@ def main():
                 open_model_folder()
             elif choice == "9":
                 system_settings()
+            elif choice == "10":
+                advanced_tools()
+            elif choice == "11":
+                tui_menu()
             else:
-                print("❌ 无效选项，请输入 0-9 之间的数字")
+                print("❌ 无效选项，请输入 0-11 之间的数字")
                 time.sleep(1)
                 
         except KeyboardInterrupt:
@@ -1148,8 +8104,320 @@ def main():
             print(f"\n❌ 发生错误: {str(e)}")
             input("\n按回车键继续...")
 
+def detect_psutil():
+    """静默检测 psutil（命令行模式不询问安装）"""
+    global HAS_PSUTIL, PSUTIL_VERSION
+    try:
+        import psutil
+        HAS_PSUTIL = True
+        PSUTIL_VERSION = psutil.__version__
+    except ImportError:
+        HAS_PSUTIL = False
+        PSUTIL_VERSION = None
+
+def build_cli_parser():
+    """命令行参数（用于无人值守运行）"""
+    parser = argparse.ArgumentParser(
+        description="Ollama AI 模型管理器。不带参数运行时进入交互菜单。")
+    commands = parser.add_subparsers(dest="command", metavar="命令")
+    
+    metrics = commands.add_parser("metrics", help="以 Prometheus 格式导出指标")
+    metrics.add_argument("--port", type=int, default=DEFAULT_METRICS_PORT, help="监听端口")
+    metrics.add_argument("--bind", default="0.0.0.0", help="监听地址")
+    
+    export = commands.add_parser("export", help="把模型打包为 tar 文件（离线传输）")
+    export.add_argument("models", nargs="+", help="模型名称")
+    export.add_argument("-o", "--output", required=True, help="输出文件")
+    export.add_argument("--models-dir", help="模型存储目录")
+    
+    imports = commands.add_parser("import", help="从 tar 文件导入模型")
+    imports.add_argument("bundle", help="导出的 tar 文件")
+    imports.add_argument("--models-dir", help="模型存储目录")
+    imports.add_argument("--no-verify", action="store_true", help="不校验数据块的 SHA-256")
+    
+    replicate = commands.add_parser("replicate", help="把模型复制到另一个存储目录（优先硬链接/reflink）")
+    replicate.add_argument("source", help="源存储目录")
+    replicate.add_argument("target", help="目标存储目录")
+    replicate.add_argument("models", nargs="*", help="模型名称，省略时复制全部")
+    
+    dedupe = commands.add_parser("dedupe", help="把多个存储目录中的重复数据块替换为硬链接")
+    dedupe.add_argument("dirs", nargs="+", help="存储目录")
+    dedupe.add_argument("--dry-run", action="store_true", help="只统计，不修改")
+    
+    verify = commands.add_parser("verify", help="校验数据块 SHA-256（适合定时任务，发现问题时退出码为 1）")
+    verify.add_argument("--models-dir", help="模型存储目录")
+    verify.add_argument("--workers", type=int, help="校验线程数")
+    verify.add_argument("--full", action="store_true", help="忽略缓存全部重新校验")
+    
+    gc = commands.add_parser("gc", help="清理未被引用的数据块和未完成的下载")
+    gc.add_argument("--models-dir", help="模型存储目录")
+    gc.add_argument("--dry-run", action="store_true", help="只列出，不删除")
+    gc.add_argument("--min-age", type=float, help="跳过最近多少小时内修改的文件")
+    
+    commands.add_parser("tui", help="全屏界面（实时刷新服务状态和模型列表）")
+    
+    pull_queue = commands.add_parser("pull-queue", help="计划下载队列（run 在前台持续处理，适合夜间运行）")
+    pull_queue.add_argument("action", choices=["list", "add", "run", "pause", "resume", "remove", "limit"],
+                            help="操作")
+    pull_queue.add_argument("value", nargs="?",
+                            help="add: 模型名称；pause/resume/remove: 任务编号（省略时作用于整个队列）；limit: Mbps")
+    pull_queue.add_argument("--window", default="", help="时间窗口，如 01:00-06:00")
+    
+    registry = commands.add_parser("registry-cache", help="局域网模型仓库缓存代理（其他节点通过它拉取）")
+    registry.add_argument("--port", type=int, default=DEFAULT_REGISTRY_CACHE_PORT, help="监听端口")
+    registry.add_argument("--bind", default="0.0.0.0", help="监听地址")
+    registry.add_argument("--upstream", help="上游仓库地址")
+    registry.add_argument("--dir", help="缓存目录")
+    registry.add_argument("--max-gb", type=float, help="缓存容量 (GB)")
+    
+    daemon = commands.add_parser("daemon", help="管理器守护进程（start 在前台运行，菜单和命令行自动通过它访问服务）")
+    daemon.add_argument("action", choices=["start", "status", "stop"], help="操作")
+    daemon.add_argument("--socket", help="Unix 套接字路径")
+    
+    loadtest = commands.add_parser("loadtest", help="负载测试：延迟分位数、首 token 时间、吞吐量和错误率")
+    loadtest.add_argument("model", help="模型名称")
+    loadtest.add_argument("--mode", choices=["closed", "open"], default="closed",
+                          help="closed: 固定并发；open: 固定到达速率")
+    loadtest.add_argument("--concurrency", type=int, default=4, help="闭环并发数")
+    loadtest.add_argument("--rps", type=float, default=1.0, help="开环每秒请求数")
+    loadtest.add_argument("--duration", type=float, default=60, help="持续时间（秒）")
+    loadtest.add_argument("--prompts", help="提示词文件（每行一个，可写 权重<Tab>提示词）")
+    loadtest.add_argument("--max-tokens", type=int, default=128, help="每个请求最多生成的 token 数")
+    loadtest.add_argument("--interval", type=float, default=5, help="进度汇报间隔（秒）")
+    loadtest.add_argument("--no-warmup", action="store_true", help="不预热模型")
+    loadtest.add_argument("--json", help="把完整结果写入 JSON 文件")
+    
+    bench = commands.add_parser("bench", help="基准测试记录：列出、对比（发现显著回归时退出码为 1）")
+    bench.add_argument("action", choices=["list", "compare"], help="操作")
+    bench.add_argument("runs", nargs="*", type=int,
+                       help="compare: [基线编号] [当前编号]，省略时对比最新一次与同条件的上一次")
+    bench.add_argument("--model", help="list: 只列出指定模型")
+    bench.add_argument("--limit", type=int, default=20, help="list: 显示条数")
+    bench.add_argument("--alpha", type=float, default=BENCHMARK_ALPHA, help="显著性水平")
+    bench.add_argument("--min-change", type=float, default=BENCHMARK_MIN_CHANGE * 100,
+                       help="视为回归的最小变化（百分比）")
+    
+    tune = commands.add_parser("tune", help="自动调优 num_thread / num_batch / num_ctx")
+    tune.add_argument("model", help="模型名称")
+    tune.add_argument("--prompt-file", help="代表性提示词文件（默认使用内置提示词）")
+    tune.add_argument("--objective", choices=list(TUNE_OBJECTIVES), default="generation", help="优化目标")
+    tune.add_argument("--threads", type=parse_tune_values, help="num_thread 候选值，如 4,8,16")
+    tune.add_argument("--batch", type=parse_tune_values, help="num_batch 候选值")
+    tune.add_argument("--ctx", type=parse_tune_values, help="num_ctx 候选值")
+    tune.add_argument("--repeats", type=int, default=TUNE_REPEATS, help="每组参数测量次数")
+    tune.add_argument("--max-tokens", type=int, default=TUNE_MAX_TOKENS, help="每次生成的 token 数")
+    tune.add_argument("--full", action="store_true", help="测试全部组合（默认逐个参数搜索）")
+    tune.add_argument("--json", help="把最佳参数写入 JSON 文件")
+    return parser
+
+def run_bench_command(args):
+    """bench 子命令"""
+    db = BenchmarkDB()
+    if args.action == "list":
+        for run in db.list_runs(args.model, limit=args.limit):
+            print(describe_run(run))
+        return 0
+    if len(args.runs) > 2:
+        print("❌ 最多指定两个编号", file=sys.stderr)
+        return 2
+    if len(args.runs) == 2:
+        base_id, current_id = args.runs
+    else:
+        base_id, current_id = None, (args.runs[0] if args.runs else None)
+    baseline, current = resolve_comparison(db, base_id, current_id)
+    rows = compare_runs(baseline, current, args.alpha, args.min_change / 100)
+    return 1 if print_run_comparison(baseline, current, rows) else 0
+
+def run_daemon_command(args):
+    """daemon 子命令"""
+    if not hasattr(socket, "AF_UNIX"):
+        print("❌ 当前平台不支持 Unix 套接字", file=sys.stderr)
+        return 1
+    if args.socket:
+        get_config()["daemon"]["socket"] = args.socket
+    if args.action == "start":
+        daemon = ManagerDaemon()
+        try:
+            daemon.start()
+        except (RuntimeError, OSError) as e:
+            print(f"❌ {str(e)}", file=sys.stderr)
+            return 1
+        print(f"守护进程已启动: {daemon.path} (PID {os.getpid()}，Ctrl+C 停止)", flush=True)
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+        try:
+            daemon.wait()
+        except KeyboardInterrupt:
+            daemon.stop()
+        return 0
+    try:
+        info = daemon_call("ping")
+    except DaemonUnavailable:
+        print("守护进程未运行")
+        return 1 if args.action == "status" else 0
+    if args.action == "stop":
+        daemon_call("shutdown")
+        print(f"已停止守护进程 (PID {info['pid']})")
+        return 0
+    status = daemon_call("status")
+    print(f"守护进程运行中: PID {info['pid']}，已运行 {info['uptime'] / 60:.0f} 分钟，"
+          f"连接 {info['clients']} 个，累计请求 {info['requests']} 次")
+    print(f"Ollama 服务: {'运行中 v' + status['version'] if status['up'] else '未运行'}，"
+          f"已加载 {len(status['loaded'])} 个模型")
+    print(f"请求调度: 每个模型最多 {info['max_in_flight']} 个在途请求")
+    for model, counts in sorted(info["scheduler"].items()):
+        print(f"  {model}: 在途 {counts['in_flight']}，排队 {counts['waiting']}")
+    return 0
+
+def run_pull_queue_command(args):
+    """pull-queue 子命令"""
+    scheduler = get_pull_scheduler()
+    if args.action == "add":
+        if not args.value:
+            print("❌ 需要模型名称", file=sys.stderr)
+            return 2
+        job = scheduler.add(args.value, args.window)
+        print(f"已添加任务 #{job['id']}: {job['model']}")
+    elif args.action in ("pause", "resume", "remove"):
+        if args.value and args.value.lstrip("#").isdigit():
+            job_id = int(args.value.lstrip("#"))
+            if args.action == "remove":
+                scheduler.remove(job_id)
+            else:
+                scheduler.set_job_paused(job_id, args.action == "pause")
+        elif args.action != "remove":
+            scheduler.set_paused(args.action == "pause")
+    elif args.action == "limit":
+        scheduler.set_bandwidth_limit(float(args.value or 0) * 1e6 / 8)
+    elif args.action == "run":
+        if not scheduler.start():
+            print("❌ 队列已在另一个进程中处理", file=sys.stderr)
+            return 1
+        print("正在处理下载队列 (Ctrl+C 停止，未完成的任务下次继续)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            scheduler.stop()
+        return 0
+    print_pull_queue(scheduler)
+    return 0
+
+def run_cli(argv):
+    """命令行模式入口，返回退出码"""
+    parser = build_cli_parser()
+    args = parser.parse_args(argv)
+    detect_psutil()
+    
+    if args.command == "metrics":
+        server = start_metrics_server(args.port, args.bind)
+        print(f"指标服务已启动: http://{args.bind}:{args.port}/metrics (Ctrl+C 停止)")
+        try:
+            daemon_call("ping")
+            print("守护进程运行中，导出它汇总的全部指标")
+        except DaemonUnavailable:
+            # 本进程自己不发推理请求，直方图只在请求经过的进程（守护进程或菜单）中累积
+            print("提示: 守护进程未运行，只导出服务状态、已加载模型和存储占用；"
+                  "请求延迟和 tokens/秒直方图需先运行 daemon start，之后抓取时自动改用守护进程的指标")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            stop_metrics_server()
+        return 0
+    
+    if args.command == "registry-cache":
+        max_bytes = int(args.max_gb * GB) if args.max_gb else None
+        server = start_registry_cache(args.port, args.bind, upstream=args.upstream,
+                                      cache_dir=args.dir, max_bytes=max_bytes)
+        print(f"仓库缓存代理已启动: http://{args.bind}:{args.port}  上游 {server.cache.upstream}"
+              f"  缓存目录 {server.cache.cache_dir} (Ctrl+C 停止)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            stop_registry_cache()
+        return 0
+    
+    if args.command == "daemon":
+        return run_daemon_command(args)
+    
+    if args.command == "tui":
+        if not run_tui():
+            print("❌ 当前环境没有 curses 模块（Windows 可运行 pip install windows-curses）",
+                  file=sys.stderr)
+            return 1
+        return 0
+    
+    try:
+        if args.command == "bench":
+            return run_bench_command(args)
+        if args.command == "tune":
+            grid = default_tune_grid()
+            for name, values in (("num_thread", args.threads), ("num_batch", args.batch), ("num_ctx", args.ctx)):
+                if values:
+                    grid[name] = values
+            prompt = None
+            if args.prompt_file:
+                with open(args.prompt_file, 'r', encoding='utf-8') as f:
+                    prompt = f.read()
+            _, baseline, best = run_autotune(args.model, prompt, grid, args.objective,
+                                             args.repeats, args.max_tokens, args.full)
+            if args.json:
+                save_json_file(args.json, {"model": args.model, "objective": args.objective,
+                                           "options": best["options"],
+                                           "baseline": {k: baseline[k] for k in ("prompt_tps", "tps")},
+                                           "best": {k: best[k] for k in ("prompt_tps", "tps")}})
+            return 0
+        if args.command == "loadtest":
+            result = run_loadtest(args.model, args.mode, args.concurrency, args.rps, args.duration,
+                                  args.prompts, args.max_tokens, args.interval, not args.no_warmup)
+            if args.json:
+                save_json_file(args.json, result)
+            return 1 if result["requests"] and result["errors"] == result["requests"] else 0
+        if args.command == "export":
+            count, blob_count, total = export_models(args.models, args.output, args.models_dir,
+                                                     progress=make_copy_progress())
+            print(f"已导出 {count} 个模型、{blob_count} 个数据块，共 {format_bytes(total)}")
+            return 0
+        if args.command == "import":
+            imported, written, skipped, written_bytes = import_bundle(
+                args.bundle, args.models_dir, verify=not args.no_verify,
+                progress=make_copy_progress())
+            print(f"已导入 {len(imported)} 个模型: {', '.join(imported)}；"
+                  f"新写入 {written} 个数据块 ({format_bytes(written_bytes)})，跳过 {skipped} 个")
+            return 0
+        if args.command == "replicate":
+            print_replicate_stats(replicate_store(args.source, args.target, args.models or None))
+            return 0
+        if args.command == "dedupe":
+            count, saved, corrupt = dedupe_stores(args.dirs, dry_run=args.dry_run)
+            action = "可处理" if args.dry_run else "已处理"
+            print(f"{action} {count} 个重复数据块，释放 {format_bytes(saved)}")
+            print_corrupt_blobs(corrupt)
+            return 1 if corrupt else 0
+        if args.command == "verify":
+            started = time.perf_counter()
+            result = verify_store(args.models_dir, args.workers, args.full)
+            print_verify_result(result, time.perf_counter() - started)
+            return 1 if result["bad"] or result["missing"] else 0
+        if args.command == "pull-queue":
+            return run_pull_queue_command(args)
+        if args.command == "gc":
+            garbage, freed = collect_garbage(args.models_dir, args.dry_run, args.min_age)
+            print_garbage(garbage, freed, args.dry_run)
+            return 0
+    except (OSError, ValueError, EOFError, tarfile.TarError, OllamaAPIError, sqlite3.Error) as e:
+        print(f"❌ {str(e)}", file=sys.stderr)
+        return 1
+    
+    parser.print_help()
+    return 2
+
 # ============ 程序入口 ============
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # 命令行模式
+        sys.exit(run_cli(sys.argv[1:]))
     try:
         main()
     except KeyboardInterrupt:
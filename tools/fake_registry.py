@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用于测试仓库缓存代理 (registry-cache) 的本地假仓库
+
+提供 library/tiny:1b 一个模型：一个大数据块、一个小数据块和配置。
+数据块请求先 307 跳转到 /cdn/，与 registry.ollama.ai 的行为一致；/cdn/ 按约 30 MB/s 限速发送，
+方便观察多个客户端同时未命中时是否只向上游下载一次。
+
+用法:
+    python tools/fake_registry.py 11600 &
+    python ollama_manager_v2.0.py registry-cache --port 9878 --upstream http://127.0.0.1:11600
+    curl http://127.0.0.1:9878/v2/library/tiny/manifests/1b
+
+控制接口（用于复现故障）:
+    GET /_counts                      各类请求次数 {"manifest", "blob_get", "head"}
+    GET /_manifest_status/503         之后的清单请求返回 503（200 恢复）
+    GET /_abort_blobs/1               之后的数据块下载发送一半后断开（0 恢复）
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BLOB_SIZE_MB = 30
+CHUNK = 1 << 20
+
+BLOBS = {}
+COUNTS = {"manifest": 0, "blob_get": 0, "head": 0}
+STATE = {"manifest_status": 200, "abort_blobs": False}
+
+
+def add_blob(data):
+    digest = "sha256:" + hashlib.sha256(data).hexdigest()
+    BLOBS[digest] = data
+    return digest
+
+
+def build_manifest():
+    layers = [os.urandom(BLOB_SIZE_MB * CHUNK), b"{{ .Prompt }}"]
+    config = b'{"model_format":"gguf","model_family":"llama"}'
+    return json.dumps({
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        "config": {"digest": add_blob(config), "size": len(config)},
+        "layers": [{"digest": add_blob(data), "size": len(data)} for data in layers],
+    }).encode()
+
+
+MANIFEST = build_manifest()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path = self.path
+        if path == "/_counts":
+            return self.reply(200, json.dumps(COUNTS).encode())
+        if path.startswith("/_manifest_status/"):
+            STATE["manifest_status"] = int(path.rsplit("/", 1)[1])
+            return self.reply(200)
+        if path.startswith("/_abort_blobs/"):
+            STATE["abort_blobs"] = path.endswith("/1")
+            return self.reply(200)
+
+        if "/manifests/" in path:
+            COUNTS["manifest"] += 1
+            if STATE["manifest_status"] != 200:
+                return self.reply(STATE["manifest_status"])
+            if not path.endswith("/tiny/manifests/1b"):
+                return self.reply(404, b'{"errors":[{"code":"MANIFEST_UNKNOWN"}]}')
+            return self.reply(200, MANIFEST, {
+                "Content-Type": "application/vnd.docker.distribution.manifest.v2+json"})
+        if "/blobs/" in path:
+            return self.reply(307, headers={"Location": "/cdn/" + path.rsplit("/", 1)[1]})
+        if path.startswith("/cdn/"):
+            data = BLOBS.get(path[5:])
+            if data is None:
+                return self.reply(404)
+            if self.command == "HEAD":
+                COUNTS["head"] += 1
+                return self.reply(200, data)
+            COUNTS["blob_get"] += 1
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            end = len(data) // 2 if STATE["abort_blobs"] else len(data)
+            for offset in range(0, end, CHUNK):
+                self.wfile.write(data[offset:min(offset + CHUNK, end)])
+                time.sleep(0.03)
+            if STATE["abort_blobs"]:
+                self.close_connection = True
+            return
+        self.reply(404)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 11600
+    print(f"fake registry on http://127.0.0.1:{port}  model library/tiny:1b")
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()